@@ -0,0 +1,96 @@
+"""Benchmark attention-check injection against the original implementation.
+
+The original implementation (kept here as legacy_inject_attention_check)
+works on lists of trial dictionaries and scans the whole run for every
+category; Schedule.inject_attention_check finds all the blocks in one pass
+over all runs.
+"""
+import argparse
+from copy import deepcopy
+from random import shuffle, sample
+import time
+import numpy as np
+from schedule import Schedule
+
+
+def legacy_inject_attention_check(exp):
+    """inject_attention_check as it was before the array-backed schedule"""
+    exp_ = deepcopy(exp)
+    run_idx = sorted(exp_.keys())
+    run1 = exp_[run_idx[0]]
+    categories = map(lambda x: x['stim_type'], run1)
+    categories = np.unique(filter(lambda x: x != 'fixation', categories))
+    n_categories = len(categories)
+    for run in exp_.itervalues():
+        categories_ = categories.copy()
+        shuffle(categories_)
+        categories_ = [
+            categories_[:n_categories//2],
+            categories_[n_categories//2:]]
+        shuffle(categories_)
+        for check_cat, where_to_check in zip(
+                categories_,
+                (lambda x: 1 < x < len(run)//2, lambda x: x >= len(run)//2)):
+            for cat in check_cat:
+                idx_ok = np.where(map(lambda x: x['stim_type'] == cat, run))[0]
+                idx_ok = sorted(filter(where_to_check, idx_ok))
+                idx_ok = idx_ok[1:]
+                idx_check = sample(idx_ok, 1)[0]
+                run[idx_check] = run[idx_check - 1].copy()
+                run[idx_check]['repetition'] = 1
+    return exp_
+
+
+def make_stimuli(ncat, nstims=12):
+    return {'cat{0:03d}'.format(i): ['cat{0:03d}/{1:03d}.mp4'.format(i, j)
+                                     for j in range(nstims)]
+            for i in range(ncat)}
+
+
+def best_of(func, repeat):
+    times = []
+    for _ in range(repeat):
+        tstart = time.time()
+        func()
+        times.append(time.time() - tstart)
+    return min(times)
+
+
+def main():
+    parsed = parse_args()
+    print('{0:>10} {1:>6} {2:>8} {3:>12} {4:>12} {5:>8}'.format(
+        'categories', 'runs', 'trials', 'legacy (s)', 'array (s)',
+        'speedup'))
+    for ncat in parsed.categories:
+        for nruns in parsed.runs:
+            schedule = Schedule.create(make_stimuli(ncat), nruns,
+                                       np.random.RandomState(0))
+            exp = schedule.to_json()
+            t_legacy = best_of(lambda: legacy_inject_attention_check(exp),
+                               parsed.repeat)
+            t_array = best_of(lambda: schedule.inject_attention_check(),
+                              parsed.repeat)
+            print('{0:>10} {1:>6} {2:>8} {3:>12.4f} {4:>12.4f} '
+                  '{5:>7.0f}x'.format(ncat, nruns, schedule.runs.size,
+                                      t_legacy, t_array,
+                                      t_legacy / max(t_array, 1e-9)))
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description=__doc__)
+
+    parser.add_argument('--categories', type=int, nargs='+',
+                        help='numbers of categories',
+                        default=[5, 20, 40])
+    parser.add_argument('--runs', type=int, nargs='+',
+                        help='numbers of runs',
+                        default=[4, 64, 512])
+    parser.add_argument('--repeat', type=int,
+                        help='repetitions of each measurement (the best '
+                             'is reported)',
+                        default=3)
+    return parser.parse_args()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,334 @@
+"""Benchmarks of schedule generation and of the presentation loop.
+
+Each benchmark times a function of make_stim_order (get_stimuli, with and
+without a stored manifest, create_run, create_experiment,
+inject_attention_check, save_json) on synthetic stimuli, for growing
+numbers of categories, stimuli per category and runs, and the time the
+presentation loop is busy per trial, on a simulated run (see simulate.py).
+Results are saved as json, so that they can be kept as a baseline and
+compared with later results:
+
+    python benchmarks.py run -o baseline.json
+    python benchmarks.py compare baseline.json
+
+`compare` runs the benchmarks again (or loads them from a second file), and
+exits with an error if any of them is slower than in the baseline by more
+than --threshold.
+"""
+import argparse
+import datetime
+from itertools import product
+import json
+import os
+from os.path import join as pjoin
+import platform
+import shutil
+import sys
+import tempfile
+import time
+import numpy as np
+from make_stim_order import get_stimuli, create_run, create_experiment, \
+    inject_attention_check, save_json
+from schedule import Schedule
+
+BENCHMARKS_VERSION = 1
+# slowdown above which a benchmark is reported as a regression
+THRESHOLD = 0.2
+# duration of the trials of the simulated runs, shorter than in the
+# experiment so that the benchmark doesn't take minutes
+SIM_TRIAL_DURATION = 0.5
+DEFAULT_GRID = {
+    'categories': [5, 20, 40],
+    'stimuli': [12, 48],
+    'runs': [4, 64, 512],
+    'repeat': 5,
+    'presentation': True,
+}
+
+
+def make_stimuli(ncat, nstims):
+    return {'cat{0:03d}'.format(i): ['cat{0:03d}/{1:03d}.mp4'.format(i, j)
+                                     for j in range(nstims)]
+            for i in range(ncat)}
+
+
+def make_stim_dir(ncat, nstims):
+    """Returns a temporary directory with ncat category subdirectories of
+    nstims small files"""
+    stim_dir = tempfile.mkdtemp(prefix='bench_stimuli')
+    for cat, fns in make_stimuli(ncat, nstims).items():
+        os.mkdir(pjoin(stim_dir, cat))
+        for fn in fns:
+            with open(pjoin(stim_dir, fn), 'wb') as f:
+                f.write(fn)
+    return stim_dir
+
+
+def best_of(func, repeat, min_time=0.02):
+    """Returns the time per call of func, in s: func is called repeatedly
+    for at least min_time, repeat times, and the best is kept"""
+    times = []
+    for _ in range(repeat):
+        ncalls = 0
+        tstart = time.time()
+        while True:
+            func()
+            ncalls += 1
+            elapsed = time.time() - tstart
+            if elapsed >= min_time:
+                break
+        times.append(elapsed / ncalls)
+    return min(times)
+
+
+def bench_get_stimuli(ncat, nstims, repeat):
+    """get_stimuli listing the stimuli without a manifest ('cold'), and
+    reading them from an up-to-date manifest ('warm')"""
+    stim_dir = make_stim_dir(ncat, nstims)
+    manifest_fn = pjoin(stim_dir, 'manifest.json')
+    try:
+        cold = best_of(lambda: get_stimuli(stim_dir), repeat)
+        get_stimuli(stim_dir, manifest_fn)
+        warm = best_of(lambda: get_stimuli(stim_dir, manifest_fn), repeat)
+    finally:
+        shutil.rmtree(stim_dir)
+    return cold, warm
+
+
+def bench_presentation(ncat, repeat):
+    """Returns the real time the presentation loop is busy per trial, on a
+    simulated run with ncat categories"""
+    from simulate import Scenario, simulate_run
+    trials = Schedule.create(make_stimuli(ncat, 12), 1,
+                             np.random.RandomState(0)).run(1)
+    for trial in trials:
+        trial['duration'] = SIM_TRIAL_DURATION
+    scenario = Scenario(speed=20., decode_time=0., trigger_delay=0.)
+    times = []
+    for _ in range(repeat):
+        out_dir = tempfile.mkdtemp(prefix='bench_sim')
+        try:
+            metrics = simulate_run(trials, out_dir, 'bench', 1, scenario)
+        finally:
+            shutil.rmtree(out_dir)
+        times.append(metrics['loop_time_per_trial'])
+    return min(times)
+
+
+def benchmark_id(name, **params):
+    return '{0}[{1}]'.format(name, ','.join(
+        '{0}={1}'.format(key, params[key]) for key in sorted(params)))
+
+
+def run_benchmarks(categories, stimuli, runs, repeat=5, presentation=True,
+                   verbose=True):
+    """Runs all the benchmarks.
+
+    Arguments
+    ---------
+    categories : list
+        numbers of categories
+    stimuli : list
+        numbers of stimuli per category
+    runs : list
+        numbers of runs
+    repeat : int
+        repetitions of each measurement (the best is kept)
+    presentation : bool
+        also time the presentation loop on simulated runs
+    verbose : bool
+        print each result as it is measured
+
+    Returns
+    -------
+    results : dict
+        the time of each benchmark, in s, by benchmark id
+        (e.g. 'create_run[categories=5,stimuli=12]'), with information on
+        the machine
+    """
+    times = dict()
+
+    def record(name, seconds, **params):
+        key = benchmark_id(name, **params)
+        times[key] = seconds
+        if verbose:
+            print('{0:<60} {1:12.6f}s'.format(key, seconds))
+            sys.stdout.flush()
+
+    rng = np.random.RandomState(0)
+    out_dir = tempfile.mkdtemp(prefix='bench_json')
+    try:
+        for ncat, nstims in product(categories, stimuli):
+            cold, warm = bench_get_stimuli(ncat, nstims, repeat)
+            record('get_stimuli', cold, categories=ncat, stimuli=nstims)
+            record('get_stimuli_manifest', warm, categories=ncat,
+                   stimuli=nstims)
+            stims = make_stimuli(ncat, nstims)
+            record('create_run',
+                   best_of(lambda: create_run(stims, rng), repeat),
+                   categories=ncat, stimuli=nstims)
+            for nruns in runs:
+                params = {'categories': ncat, 'stimuli': nstims,
+                          'runs': nruns}
+                record('create_experiment', best_of(
+                    lambda: create_experiment(stims, nruns, rng), repeat),
+                    **params)
+                exp = create_experiment(stims, nruns, rng)
+                record('inject_attention_check', best_of(
+                    lambda: inject_attention_check(exp, rng=rng), repeat),
+                    **params)
+                fn = pjoin(out_dir, 'exp.json')
+                record('save_json', best_of(
+                    lambda: save_json(exp, fn, overwrite=True), repeat),
+                    **params)
+        if presentation:
+            for ncat in categories:
+                record('presentation_per_trial',
+                       bench_presentation(ncat, min(repeat, 3)),
+                       categories=ncat)
+    finally:
+        shutil.rmtree(out_dir)
+    return {
+        'version': BENCHMARKS_VERSION,
+        'date': datetime.datetime.now().isoformat(),
+        'machine': {
+            'platform': platform.platform(),
+            'processor': platform.processor(),
+            'python': platform.python_version(),
+            'numpy': np.__version__,
+        },
+        'grid': {'categories': list(categories), 'stimuli': list(stimuli),
+                 'runs': list(runs), 'repeat': repeat,
+                 'presentation': presentation},
+        'times': times,
+    }
+
+
+def compare(baseline, current, threshold=THRESHOLD):
+    """Compares the times of two sets of results.
+
+    Returns
+    -------
+    rows : list
+        (benchmark id, baseline time, current time, ratio, status) for the
+        benchmarks in both, where status is 'regression' if the current
+        time is more than (1 + threshold) times the baseline, 'improvement'
+        if it is less than 1 / (1 + threshold) times, and 'ok' otherwise
+    missing : list
+        benchmarks in the baseline but not in the current results
+    """
+    rows = []
+    for key in sorted(set(baseline['times']) & set(current['times'])):
+        before = baseline['times'][key]
+        after = current['times'][key]
+        ratio = after / before if before > 0 else float('inf')
+        if ratio > 1 + threshold:
+            status = 'regression'
+        elif ratio < 1 / (1 + threshold):
+            status = 'improvement'
+        else:
+            status = 'ok'
+        rows.append((key, before, after, ratio, status))
+    missing = sorted(set(baseline['times']) - set(current['times']))
+    return rows, missing
+
+
+def load_results(fn):
+    with open(fn, 'rb') as f:
+        results = json.load(f)
+    if results.get('version') != BENCHMARKS_VERSION:
+        raise ValueError("{0} was saved by a different version of the "
+                         "benchmarks".format(fn))
+    return results
+
+
+def save_results(results, fn):
+    with open(fn, 'wb') as f:
+        json.dump(results, f, indent=True, sort_keys=True)
+
+
+def grid_args(parsed, default=None):
+    """Returns the arguments of run_benchmarks given on the command line,
+    taking the others from default"""
+    grid = dict(default or dict())
+    for name in ('categories', 'stimuli', 'runs', 'repeat'):
+        if getattr(parsed, name) is not None:
+            grid[name] = getattr(parsed, name)
+    if parsed.no_presentation:
+        grid['presentation'] = False
+    return grid
+
+
+def main():
+    parsed = parse_args()
+    if parsed.command == 'run':
+        results = run_benchmarks(**grid_args(parsed, DEFAULT_GRID))
+        if parsed.output is not None:
+            save_results(results, parsed.output)
+        return
+    baseline = load_results(parsed.baseline)
+    if parsed.current is not None:
+        current = load_results(parsed.current)
+    else:
+        # the same grid as the baseline, unless given
+        current = run_benchmarks(verbose=False,
+                                 **grid_args(parsed, baseline['grid']))
+        if parsed.output is not None:
+            save_results(current, parsed.output)
+    if baseline['machine'] != current['machine']:
+        print("Warning: the baseline was measured on a different machine "
+              "or setup")
+    rows, missing = compare(baseline, current, parsed.threshold)
+    print('{0:<60} {1:>12} {2:>12} {3:>7}'.format(
+        'benchmark', 'baseline', 'current', 'ratio'))
+    for key, before, after, ratio, status in rows:
+        print('{0:<60} {1:11.6f}s {2:11.6f}s {3:6.2f}x{4}'.format(
+            key, before, after, ratio,
+            '' if status == 'ok' else '  ' + status.upper()))
+    for key in missing:
+        print("{0} is not in the current results".format(key))
+    regressions = [row[0] for row in rows if row[4] == 'regression']
+    print("{0} benchmarks, {1} regressions (threshold {2:.0%})".format(
+        len(rows), len(regressions), parsed.threshold))
+    if regressions:
+        raise SystemExit(1)
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(
+        description=__doc__,
+        formatter_class=argparse.RawDescriptionHelpFormatter)
+    subparsers = parser.add_subparsers(dest='command')
+    run_parser = subparsers.add_parser(
+        'run', help='run the benchmarks')
+    compare_parser = subparsers.add_parser(
+        'compare', help='compare with a baseline')
+    compare_parser.add_argument('baseline', type=str,
+                                help='baseline results')
+    compare_parser.add_argument('current', type=str, nargs='?',
+                                help='results to compare (default: run the '
+                                     'benchmarks now)')
+    compare_parser.add_argument('--threshold', type=float,
+                                help='relative slowdown reported as a '
+                                     'regression',
+                                default=THRESHOLD)
+    # by default, run uses DEFAULT_GRID and compare the grid of the baseline
+    for sub in (run_parser, compare_parser):
+        sub.add_argument('--categories', type=int, nargs='+',
+                         help='numbers of categories')
+        sub.add_argument('--stimuli', type=int, nargs='+',
+                         help='numbers of stimuli per category')
+        sub.add_argument('--runs', type=int, nargs='+',
+                         help='numbers of runs')
+        sub.add_argument('--repeat', type=int,
+                         help='repetitions of each measurement (the best '
+                              'is kept)')
+        sub.add_argument('--no-presentation', action='store_true',
+                         help='skip the simulated presentation loop')
+        sub.add_argument('--output', '-o', type=str,
+                         help='save the results to this file')
+    return parser.parse_args()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,167 @@
+"""Writer for BIDS _events.tsv files.
+
+Events are appended to a preallocated in-memory queue by the presentation
+loop, and written to disk by a background thread, so that the loop never
+waits on I/O (nor grows the queue). Rows are appended to the file and
+synced to disk at every flush, so that everything up to the last flush
+survives a crash; on close, the rows are sorted by onset (button presses
+are received out of order). Files are named following BIDS (see
+events_name).
+"""
+import json
+import os
+import threading
+
+COLUMNS = ('onset', 'duration', 'stim_type', 'stim_fn', 'repetition')
+# number of events the queue holds between two flushes; a whole run has a
+# few hundred events
+QUEUE_SIZE = 1024
+SIDECAR = {
+    'onset': {
+        'Description': 'Onset of the event from the first trigger',
+        'Units': 's',
+    },
+    'duration': {
+        'Description': 'Planned duration of the event',
+        'Units': 's',
+    },
+    'stim_type': {
+        'Description': 'Category of the clip, fixation, or button_press',
+    },
+    'stim_fn': {
+        'Description': 'Clip presented, relative to the directory of the '
+                       'presentation script',
+    },
+    'repetition': {
+        'Description': 'Whether the clip repeats the previous one (target '
+                       'of the 1-back task)',
+        'Levels': {'0': 'not a repetition', '1': 'repetition'},
+    },
+}
+
+
+def format_row(onset, duration, stim_type, stim_fn=None, repetition=0):
+    return '{0:.3f}\t{1:.3f}\t{2}\t{3}\t{4}\n'.format(
+        onset, duration, stim_type,
+        stim_fn if stim_fn is not None else 'n/a', repetition)
+
+
+def events_name(subject, run, task='localizer', acq=None):
+    """Returns the BIDS name of the events file of a run, e.g.
+    sub-01_task-localizer_run-1_events.tsv (with an acq-<acq> entity if
+    acq is given)"""
+    entities = ['sub-' + subject, 'task-' + task]
+    if acq is not None:
+        entities.append('acq-' + acq)
+    entities.append('run-{0}'.format(run))
+    return '_'.join(entities) + '_events.tsv'
+
+
+def sidecar_fn(fn):
+    return os.path.splitext(fn)[0] + '.json'
+
+
+def write_sidecar(fn):
+    with open(sidecar_fn(fn), 'wb') as f:
+        json.dump(SIDECAR, f, indent=True, sort_keys=True)
+
+
+def sort_events(fn):
+    """Sorts the rows of an events file by onset, atomically"""
+    with open(fn, 'rb') as f:
+        header = f.readline()
+        rows = f.readlines()
+    rows.sort(key=lambda row: float(row.split('\t', 1)[0]))
+    tmp_fn = fn + '.tmp'
+    with open(tmp_fn, 'wb') as f:
+        f.write(header)
+        f.writelines(rows)
+        f.flush()
+        os.fsync(f.fileno())
+    os.rename(tmp_fn, fn)
+
+
+class EventWriter(object):
+    """Writes a BIDS _events.tsv file (and its .json sidecar) in a
+    background thread.
+
+    Arguments
+    ---------
+    fn : str
+        events file
+    flush_interval : float
+        how often the background thread writes the queued events, in s
+    queue_size : int
+        number of events the queue holds; if it fills up before the
+        background thread flushes it, add() flushes it itself
+    """
+    def __init__(self, fn, flush_interval=0.5, queue_size=QUEUE_SIZE):
+        self.fn = fn
+        self.flush_interval = flush_interval
+        self.n_events = 0
+        # ring buffer of the events queued, between the number of events
+        # taken by flush() and the number added by add(); each count is
+        # only advanced by one of them
+        self._queue = [None] * queue_size
+        self._added = 0
+        self._taken = 0
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+        self._thread = None
+        self._f = None
+
+    def start(self):
+        """Writes the header and the sidecar, and starts the thread"""
+        self._f = open(self.fn, 'wb')
+        self._f.write('\t'.join(COLUMNS) + '\n')
+        self._f.flush()
+        write_sidecar(self.fn)
+        self._thread = threading.Thread(target=self._run,
+                                        name='EventWriter')
+        self._thread.daemon = True
+        self._thread.start()
+
+    def add(self, onset, duration, stim_type, stim_fn=None, repetition=0):
+        """Queues an event; only blocks on I/O if the queue is full"""
+        size = len(self._queue)
+        if self._added - self._taken >= size:
+            self.flush()
+        self._queue[self._added % size] = (onset, duration, stim_type,
+                                           stim_fn, repetition)
+        self._added += 1
+
+    def _run(self):
+        while not self._stop.wait(self.flush_interval):
+            self.flush()
+
+    def flush(self):
+        """Writes the queued events to disk"""
+        with self._lock:
+            if self._f is None:
+                return
+            size = len(self._queue)
+            added = self._added
+            rows = [format_row(*self._queue[i % size])
+                    for i in range(self._taken, added)]
+            self._taken = added
+            if not rows:
+                return
+            self._f.writelines(rows)
+            self._f.flush()
+            os.fsync(self._f.fileno())
+            self.n_events += len(rows)
+
+    def close(self):
+        """Stops the thread, writes the remaining events, and sorts the
+        file by onset"""
+        if self._f is None:
+            return
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+        self.flush()
+        with self._lock:
+            self._f.close()
+            self._f = None
+        sort_events(self.fn)
@@ -0,0 +1,396 @@
+"""Streaming loader for the clips of a run.
+
+Only the first block of clips is loaded before the trigger; the following
+blocks are opened by a background thread while the current block (or the
+fixation before it) is being presented, at most `lookahead` blocks ahead.
+Clips of blocks that have been presented are released.
+"""
+from collections import OrderedDict
+import threading
+from timeit import default_timer
+
+# default memory budget and number of clips of the pool, which cover the
+# clips in use as well as the idle ones; kept low for the stimulus laptops.
+# Clips opened with moviepy take about 36 MB, clips from the frame cache
+# about 325 MB (3 s at 1280x940 and 30 fps)
+POOL_MB = 1024
+POOL_MAX_CLIPS = 60
+
+
+def split_blocks(trials):
+    """Splits the trials of a run into blocks of consecutive clips of the
+    same category.
+
+    Arguments
+    ---------
+    trials : list
+        trials of a run, as stored in the schedule json
+
+    Returns
+    -------
+    blocks : list
+        for each block, the list of its (unique) stimulus filenames
+    trial_block : list
+        for each trial, the index of its block; fixations get the index of
+        the block that follows them
+    """
+    blocks = []
+    trial_block = []
+    prev_type = None
+    for trial in trials:
+        stim_type = trial['stim_type']
+        if stim_type == 'fixation':
+            prev_type = None
+            trial_block.append(len(blocks))
+            continue
+        if stim_type != prev_type:
+            blocks.append([])
+            prev_type = stim_type
+        if trial['stim_fn'] not in blocks[-1]:
+            blocks[-1].append(trial['stim_fn'])
+        trial_block.append(len(blocks) - 1)
+    return blocks, trial_block
+
+
+class ClipPool(object):
+    """Pool of prepared clips, with LRU eviction of the clips not in use
+    once the total size of the clips (in use or not) exceeds a memory
+    budget, or their number exceeds max_clips. Clips are taken out of the
+    pool while in use and put back afterwards, so that clips that are
+    presented again (e.g., in a later run) don't need to be loaded again;
+    newly prepared clips are charged to the pool until they are put in it.
+    Thread-safe.
+
+    Arguments
+    ---------
+    budget : int
+        memory budget in bytes for the clips in use and in the pool
+    size_of : callable
+        size_of(clip) -> size in bytes
+    evict : callable or None
+        evict(clip), called on the clips evicted from the pool
+    max_clips : int or None
+        maximum number of clips in the pool (e.g., to bound the number of
+        open readers); None for no limit
+    """
+    def __init__(self, budget, size_of, evict=None, max_clips=None):
+        self.budget = budget
+        self.max_clips = max_clips
+        self._size_of = size_of
+        self._evict = evict
+        self._clips = OrderedDict()
+        # key -> size of the clips in use
+        self._in_use = dict()
+        self._lock = threading.Lock()
+        self.nbytes = 0
+        self.nbytes_in_use = 0
+        # size of the largest clip seen, used to estimate the size of the
+        # next one (see has_room)
+        self.largest = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def __len__(self):
+        return len(self._clips)
+
+    def __contains__(self, key):
+        with self._lock:
+            return key in self._clips
+
+    def _use(self, key, nbytes):
+        self._in_use[key] = nbytes
+        self.nbytes_in_use += nbytes
+        self.largest = max(self.largest, nbytes)
+
+    def _shrink(self):
+        """Evicts the least recently used clips while over budget; returns
+        them"""
+        evicted = []
+        while self._clips and (
+                self.nbytes + self.nbytes_in_use > self.budget or
+                (self.max_clips is not None and
+                 len(self._clips) > self.max_clips)):
+            _, (old_clip, old_nbytes) = self._clips.popitem(last=False)
+            self.nbytes -= old_nbytes
+            self.evictions += 1
+            evicted.append(old_clip)
+        return evicted
+
+    def _evict_all(self, evicted):
+        if self._evict is not None:
+            for old_clip in evicted:
+                self._evict(old_clip)
+
+    def take(self, key):
+        """Removes the clip from the pool and returns it, or returns None if
+        it isn't in the pool; the clip is in use until put back"""
+        with self._lock:
+            entry = self._clips.pop(key, None)
+            if entry is None:
+                self.misses += 1
+                return None
+            self.hits += 1
+            self.nbytes -= entry[1]
+            self._use(key, entry[1])
+        return entry[0]
+
+    def charge(self, key, clip):
+        """Counts a newly prepared clip as in use until it is put in the
+        pool, evicting the least recently used clips if over budget"""
+        nbytes = self._size_of(clip)
+        with self._lock:
+            self._use(key, nbytes)
+            evicted = self._shrink()
+        self._evict_all(evicted)
+
+    def has_room(self):
+        """Returns whether another clip (as large as the largest one seen)
+        can be prepared without exceeding the budget with the clips in use;
+        clips in the pool would be evicted to make room"""
+        with self._lock:
+            return self.nbytes_in_use + self.largest <= self.budget
+
+    def put(self, key, clip):
+        """Puts a clip that is no longer in use in the pool, evicting the
+        least recently used clips if over budget"""
+        nbytes = self._size_of(clip)
+        evicted = []
+        with self._lock:
+            self.nbytes_in_use -= self._in_use.pop(key, 0)
+            old = self._clips.pop(key, None)
+            if old is not None:
+                self.nbytes -= old[1]
+                if old[0] is not clip:
+                    evicted.append(old[0])
+            self._clips[key] = (clip, nbytes)
+            self.nbytes += nbytes
+            self.largest = max(self.largest, nbytes)
+            evicted.extend(self._shrink())
+        self._evict_all(evicted)
+
+    def clear(self):
+        with self._lock:
+            evicted = [clip for clip, _ in self._clips.values()]
+            self._clips.clear()
+            self.nbytes = 0
+        self._evict_all(evicted)
+
+    def stats(self):
+        return {'hits': self.hits, 'misses': self.misses,
+                'evictions': self.evictions, 'clips': len(self),
+                'nbytes': self.nbytes}
+
+
+class ClipLoader(object):
+    """Loads the clips of a run block by block.
+
+    Loading is split in two steps: `prepare(stim_fn)` does the expensive
+    work (opening, decoding or paging in the clip) and is called from the
+    background thread, so it must not touch OpenGL; `finalize(stim_fn,
+    prepared)` creates the stimulus and is only called from the main
+    thread. `release(stimulus)`, if given, is called on the clips of blocks
+    that were presented. If a ClipPool is given, prepared clips are taken
+    from it when available, and are put back in it once presented; the
+    clips held by the loader count against the budget of the pool, and the
+    following blocks are only loaded while they fit in it (the current
+    block is always loaded).
+
+    Arguments
+    ---------
+    trials : list
+        trials of a run, as stored in the schedule json
+    prepare : callable
+        prepare(stim_fn) -> prepared clip
+    finalize : callable
+        finalize(stim_fn, prepared clip) -> stimulus
+    release : callable or None
+        release(stimulus)
+    lookahead : int
+        how many blocks after the current one to load
+    pool : ClipPool or None
+        pool of prepared clips shared across runs
+    clock : callable
+        returns the current time in s; used to time the waits for clips
+        that were not ready
+    """
+    def __init__(self, trials, prepare, finalize, release=None,
+                 lookahead=1, pool=None, clock=default_timer):
+        self.blocks, self.trial_block = split_blocks(trials)
+        self.lookahead = lookahead
+        self.clock = clock
+        self._prepare = prepare
+        self._finalize = finalize
+        self._release = release
+        self.pool = pool
+        # stim_fn -> prepared clip, filled by the background thread
+        self._prepared = dict()
+        # stim_fn -> (prepared clip, stimulus), only used from the main
+        # thread
+        self._clips = dict()
+        self._current = 0
+        self._next = 0
+        self._stop = False
+        self._cond = threading.Condition()
+        self._thread = None
+        # (trial index, stim_fn, seconds waited) for every clip that was not
+        # ready at its onset
+        self.late = []
+
+    def _load_block(self, iblock, wait=True):
+        for stim_fn in self.blocks[iblock]:
+            with self._cond:
+                # skip blocks that were presented in the meantime
+                if stim_fn in self._prepared or self._stop or \
+                        iblock < self._current:
+                    continue
+            prepared = self._take_or_prepare(
+                stim_fn, iblock if wait else None)
+            if prepared is None:
+                continue
+            with self._cond:
+                if iblock >= self._current:
+                    self._prepared[stim_fn] = prepared
+                    prepared = None
+                self._cond.notify_all()
+            if prepared is not None:
+                self._put_back(stim_fn, prepared)
+
+    def _take_or_prepare(self, stim_fn, iblock=None):
+        """Returns the prepared clip, from the pool or newly prepared. If
+        iblock is given and the pool is full, first waits for room, or for
+        iblock to become the current block; returns None if the loader was
+        stopped or the block presented in the meantime."""
+        if self.pool is None:
+            return self._prepare(stim_fn)
+        prepared = self.pool.take(stim_fn)
+        if prepared is not None:
+            return prepared
+        if iblock is not None:
+            with self._cond:
+                while not self._stop and iblock > self._current and \
+                        not self.pool.has_room():
+                    self._cond.wait()
+                if self._stop or iblock < self._current:
+                    return None
+        prepared = self._prepare(stim_fn)
+        self.pool.charge(stim_fn, prepared)
+        return prepared
+
+    def _put_back(self, stim_fn, prepared, clip=None):
+        if clip is not None and self._release is not None:
+            self._release(clip)
+        if self.pool is not None:
+            self.pool.put(stim_fn, prepared)
+
+    def preload(self, nblocks=1):
+        """Loads the first nblocks synchronously, in the main thread"""
+        for iblock in range(min(nblocks, len(self.blocks))):
+            self._load_block(iblock, wait=False)
+            self._next = iblock + 1
+        self.poll()
+
+    def start(self):
+        """Starts loading the following blocks in the background"""
+        self._thread = threading.Thread(target=self._run,
+                                        name='ClipLoader')
+        self._thread.daemon = True
+        self._thread.start()
+
+    def stop(self):
+        """Stops the background thread, and releases all the clips"""
+        with self._cond:
+            self._stop = True
+            self._cond.notify_all()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+        for stim_fn, (prepared, clip) in self._clips.items():
+            self._put_back(stim_fn, prepared, clip)
+        for stim_fn, prepared in self._prepared.items():
+            if stim_fn not in self._clips:
+                self._put_back(stim_fn, prepared)
+        self._clips.clear()
+        self._prepared.clear()
+
+    def _run(self):
+        while True:
+            with self._cond:
+                while not self._stop and \
+                        self._next > self._current + self.lookahead:
+                    self._cond.wait()
+                if self._stop or self._next >= len(self.blocks):
+                    return
+                iblock = max(self._next, self._current)
+                self._next = iblock + 1
+            self._load_block(iblock)
+
+    def set_trial(self, itrial):
+        """Tells the loader which trial is being presented, so that it can
+        load ahead and release the blocks already presented"""
+        iblock = self.trial_block[itrial]
+        with self._cond:
+            if iblock == self._current:
+                return
+            done = range(self._current, iblock)
+            self._current = iblock
+            self._cond.notify_all()
+            released = []
+            for jblock in done:
+                for stim_fn in self.blocks[jblock]:
+                    prepared = self._prepared.pop(stim_fn, None)
+                    if prepared is not None:
+                        released.append((stim_fn, prepared))
+        for stim_fn, prepared in released:
+            entry = self._clips.pop(stim_fn, None)
+            self._put_back(stim_fn, prepared,
+                           entry[1] if entry is not None else None)
+        if released and self.pool is not None:
+            # there may be room for the next blocks now
+            with self._cond:
+                self._cond.notify_all()
+
+    def poll(self, limit=None):
+        """Creates the stimuli of the clips prepared so far (at most limit
+        of them, if given); call this from the main thread when there is
+        time to spare (e.g., at fixation, or while waiting for the next
+        frame)"""
+        with self._cond:
+            ready = [(fn, clip) for fn, clip in self._prepared.items()
+                     if fn not in self._clips]
+        for stim_fn, prepared in ready[:limit]:
+            self._clips[stim_fn] = \
+                (prepared, self._finalize(stim_fn, prepared))
+
+    def get(self, itrial, stim_fn):
+        """Returns the stimulus for stim_fn, presented at trial itrial. If
+        the clip is not ready, waits for it (or loads it if the background
+        thread isn't running); if its stimulus wasn't created by poll(), it
+        is created now. Either way the clip is recorded in self.late, with
+        the time it took."""
+        entry = self._clips.get(stim_fn)
+        if entry is not None:
+            return entry[1]
+        tstart = self.clock()
+        with self._cond:
+            prepared = self._prepared.get(stim_fn)
+        if prepared is None:
+            if self._thread is not None and self._thread.is_alive():
+                with self._cond:
+                    while stim_fn not in self._prepared and \
+                            self._thread.is_alive():
+                        self._cond.wait(0.01)
+                    prepared = self._prepared.get(stim_fn)
+            if prepared is None:
+                prepared = self._take_or_prepare(stim_fn)
+                with self._cond:
+                    self._prepared[stim_fn] = prepared
+        clip = self._finalize(stim_fn, prepared)
+        self._clips[stim_fn] = (prepared, clip)
+        self.late.append((itrial, stim_fn, self.clock() - tstart))
+        return clip
+
+    def loaded(self):
+        """Returns the filenames of the clips currently held"""
+        with self._cond:
+            return sorted(set(self._prepared) | set(self._clips))
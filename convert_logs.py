@@ -0,0 +1,336 @@
+"""Convert the logs of the localizer to BIDS _events.tsv files.
+
+The BIDS lines of each log are read line by line, the durations of the
+trials are replaced with the actual ones (the time between successive
+onsets), and the events are written, sorted by onset, next to the log (or
+in --output), under the BIDS name of the run (see bidsevents.events_name).
+If a run was presented several times, only its last complete presentation
+(or its last one, if they were all halted) is converted, and the other logs
+are reported as skipped. Logs are converted in parallel, and a report with
+the problems found in each log is written in the results directory.
+"""
+import argparse
+from glob import glob
+import multiprocessing
+import os
+from os.path import join as pjoin, exists as pexists, basename
+import re
+import time
+from bidsevents import COLUMNS, format_row, write_sidecar, events_name
+
+PWD = os.path.dirname(os.path.abspath(__file__))
+RESDIR = pjoin(PWD, 'res')
+LOG_GLOB = pjoin('sub-*', 'sub-*_task-*_run-*_*.txt')
+# sub-{subj}_task-{task_name}_run-{runnr}_{timestamp}.txt, as set by
+# log_template in config.json, with a __halted suffix for halted runs
+LOG_RE = re.compile(r'^sub-(?P<subject>[^_]+)_task-(?P<task>[^_]+)_'
+                    r'run-(?P<run>\d+)_(?P<timestamp>[^_]+)'
+                    r'(?P<halted>__halted)?\.txt$')
+REPORT_COLUMNS = ('log', 'events', 'status', 'n_trials', 'n_button_presses',
+                  'halted', 'problems')
+# trials whose actual duration differs from the planned one by more than
+# this (in s) are reported
+DURATION_TOLERANCE = 0.05
+
+
+def find_logs(res_dir=RESDIR):
+    """Returns the logs in res_dir, including the halted ones"""
+    return sorted(glob(pjoin(res_dir, LOG_GLOB)))
+
+
+def parse_log_name(fn):
+    """Returns the subject, task, run number and timestamp of a log, and
+    whether the run was halted; None if the name doesn't follow
+    log_template"""
+    match = LOG_RE.match(basename(fn))
+    if match is None:
+        return None
+    return (match.group('subject'), match.group('task'),
+            int(match.group('run')), match.group('timestamp'),
+            match.group('halted') is not None)
+
+
+def events_fn(log_fn, out_dir=None):
+    """Returns the BIDS events file of the run of a log, next to the log
+    or in out_dir; None if the name of the log doesn't follow
+    log_template"""
+    parsed = parse_log_name(log_fn)
+    if parsed is None:
+        return None
+    subject, task, run = parsed[:3]
+    subj_dir = os.path.dirname(log_fn)
+    if out_dir is not None:
+        subj_dir = pjoin(out_dir, basename(subj_dir))
+    return pjoin(subj_dir, events_name(subject, run, task))
+
+
+def plan_conversion(logs, out_dir=None):
+    """Picks the log to convert for each events file: the last complete
+    presentation of the run, or its last presentation if they were all
+    halted.
+
+    Returns
+    -------
+    chosen : dict
+        events file -> log to convert
+    superseded : dict
+        log not converted -> log converted instead; logs whose name
+        doesn't follow log_template are mapped to None
+    """
+    candidates = dict()
+    superseded = dict()
+    for fn in logs:
+        parsed = parse_log_name(fn)
+        if parsed is None:
+            superseded[fn] = None
+            continue
+        timestamp, halted = parsed[3:]
+        candidates.setdefault(events_fn(fn, out_dir), []).append(
+            (not halted, timestamp, fn))
+    chosen = dict()
+    for out_fn, logs_ in candidates.items():
+        best = max(logs_)[2]
+        chosen[out_fn] = best
+        for _, _, fn in logs_:
+            if fn != best:
+                superseded[fn] = best
+    return chosen, superseded
+
+
+def _parse_value(value):
+    return 'n/a' if value in ('None', 'null', 'n/a', '') else value
+
+
+def parse_log(fn):
+    """Yields the BIDS events in a log, reading it line by line.
+
+    Yields
+    ------
+    event : tuple
+        (onset, duration, stim_type, stim_fn, repetition) for each BIDS
+        line, or None for BIDS lines that can't be parsed
+    """
+    with open(fn, 'rb') as f:
+        for line in f:
+            parts = line.rstrip('\r\n').split('\t')
+            if len(parts) < 3 or parts[1].strip() != 'BIDS':
+                continue
+            fields = [p.strip() for p in parts[2:]]
+            if fields[0] == 'onset':
+                # header
+                continue
+            if len(fields) != len(COLUMNS):
+                yield None
+                continue
+            try:
+                yield (float(fields[0]), float(fields[1]), fields[2],
+                       _parse_value(fields[3]), int(fields[4]))
+            except ValueError:
+                yield None
+
+
+def fill_durations(events):
+    """Returns the events sorted by onset, with the duration of each trial
+    set to the time until the onset of the next trial. The duration of the
+    last trial is left as planned.
+
+    Returns
+    -------
+    events : list
+        events sorted by onset
+    deviations : list
+        (onset, planned duration, actual duration) for each trial whose
+        actual duration differs from the planned one by more than
+        DURATION_TOLERANCE
+    """
+    events = sorted(events, key=lambda event: event[0])
+    trials = [i for i, event in enumerate(events)
+              if event[2] != 'button_press']
+    deviations = []
+    for i, inext in zip(trials[:-1], trials[1:]):
+        onset, planned, stim_type, stim_fn, repetition = events[i]
+        duration = events[inext][0] - onset
+        if abs(duration - planned) > DURATION_TOLERANCE:
+            deviations.append((onset, planned, duration))
+        events[i] = (onset, duration, stim_type, stim_fn, repetition)
+    return events, deviations
+
+
+def convert_log(fn, out_fn, overwrite=False):
+    """Converts a single log, and returns a report as a dictionary with
+    keys REPORT_COLUMNS"""
+    report = {
+        'log': fn,
+        'events': out_fn,
+        'status': 'ok',
+        'n_trials': 0,
+        'n_button_presses': 0,
+        'halted': int('__halted' in basename(fn)),
+        'problems': [],
+    }
+    if pexists(out_fn) and not overwrite:
+        report['status'] = 'skipped'
+        report['problems'].append('events file exists')
+        return report
+    events = []
+    n_bad = 0
+    for event in parse_log(fn):
+        if event is None:
+            n_bad += 1
+        else:
+            events.append(event)
+    if n_bad:
+        report['problems'].append('{0} unparseable BIDS lines'.format(n_bad))
+    if not events:
+        report['status'] = 'error'
+        report['problems'].append('no BIDS events')
+        return report
+    events, deviations = fill_durations(events)
+    presses = sum(event[2] == 'button_press' for event in events)
+    report['n_button_presses'] = presses
+    report['n_trials'] = len(events) - presses
+    for onset, planned, duration in deviations:
+        report['problems'].append(
+            'trial at {0:.3f}s lasted {1:.3f}s instead of {2:.3f}s'.format(
+                onset, duration, planned))
+    if events[0][0] < 0:
+        report['problems'].append('negative onsets')
+    if report['halted']:
+        report['problems'].append('run was halted')
+    if report['problems']:
+        report['status'] = 'warning'
+
+    out_dir = os.path.dirname(out_fn)
+    if out_dir and not pexists(out_dir):
+        try:
+            os.makedirs(out_dir)
+        except OSError:
+            # created by another worker in the meantime
+            pass
+    tmp_fn = out_fn + '.tmp'
+    with open(tmp_fn, 'wb') as f:
+        f.write('\t'.join(COLUMNS) + '\n')
+        for event in events:
+            f.write(format_row(*event))
+    os.rename(tmp_fn, out_fn)
+    write_sidecar(out_fn)
+    return report
+
+
+def _not_converted(fn, out_fn, status, problem):
+    return {'log': fn, 'events': out_fn, 'status': status,
+            'n_trials': 0, 'n_button_presses': 0,
+            'halted': int('__halted' in basename(fn)),
+            'problems': [problem]}
+
+
+def _convert_job(args):
+    fn, out_fn, overwrite = args
+    try:
+        return convert_log(fn, out_fn, overwrite)
+    except Exception as exc:
+        return _not_converted(fn, out_fn, 'error', '{0}: {1}'.format(
+            type(exc).__name__, exc))
+
+
+def convert_tree(res_dir=RESDIR, out_dir=None, overwrite=False, n_jobs=None):
+    """Converts all the logs in res_dir in parallel.
+
+    Arguments
+    ---------
+    res_dir : str
+        results directory, containing a sub-<id> directory per subject
+    out_dir : str or None
+        where to write the events files (in a sub-<id> directory per
+        subject); if None, they are written next to the logs
+    overwrite : bool
+        overwrite existing events files?
+    n_jobs : int or None
+        number of processes; None uses all cores, 1 runs serially
+
+    Returns
+    -------
+    reports : list
+        a report for each log (see convert_log), in the order of the logs;
+        logs of runs presented several times that are not converted (see
+        plan_conversion) are reported as skipped
+    """
+    logs = find_logs(res_dir)
+    chosen, superseded = plan_conversion(logs, out_dir)
+    jobs = [(fn, out_fn, overwrite)
+            for out_fn, fn in sorted(chosen.items(), key=lambda item:
+                                     logs.index(item[1]))]
+    if n_jobs == 1:
+        converted = map(_convert_job, jobs)
+    else:
+        pool = multiprocessing.Pool(processes=n_jobs)
+        try:
+            # logs are small, so send them to the workers in chunks
+            chunksize = max(1, len(jobs) // (
+                4 * (n_jobs or multiprocessing.cpu_count())))
+            converted = list(pool.imap(_convert_job, jobs,
+                                       chunksize=chunksize))
+        finally:
+            pool.close()
+            pool.join()
+    reports = dict((report['log'], report) for report in converted)
+    for fn, best in superseded.items():
+        if best is None:
+            reports[fn] = _not_converted(fn, None, 'error',
+                                         'not a localizer log name')
+        else:
+            reports[fn] = _not_converted(
+                fn, events_fn(fn, out_dir), 'skipped',
+                'run converted from {0}'.format(basename(best)))
+    return [reports[fn] for fn in logs]
+
+
+def write_report(reports, fn):
+    with open(fn, 'wb') as f:
+        f.write('\t'.join(REPORT_COLUMNS) + '\n')
+        for report in reports:
+            row = dict(report, problems='; '.join(report['problems']))
+            f.write('\t'.join(str(row[col]) for col in REPORT_COLUMNS) +
+                    '\n')
+
+
+def main():
+    parsed = parse_args()
+    tstart = time.time()
+    reports = convert_tree(parsed.resdir, parsed.output, parsed.overwrite,
+                           parsed.jobs)
+    elapsed = time.time() - tstart
+    report_fn = parsed.report or pjoin(parsed.output or parsed.resdir,
+                                       'events_conversion_report.tsv')
+    write_report(reports, report_fn)
+    statuses = [report['status'] for report in reports]
+    print("Converted {0} logs in {1:.2f}s: {2} ok, {3} with warnings, "
+          "{4} skipped, {5} errors. Report in {6}".format(
+              len(reports), elapsed, statuses.count('ok'),
+              statuses.count('warning'), statuses.count('skipped'),
+              statuses.count('error'), report_fn))
+    if statuses.count('error'):
+        raise SystemExit(1)
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description=__doc__)
+
+    parser.add_argument('--resdir', '-d', type=str,
+                        help='results directory',
+                        default=RESDIR)
+    parser.add_argument('--output', '-o', type=str,
+                        help='output directory (default: next to the logs)')
+    parser.add_argument('--report', type=str,
+                        help='report file (default: '
+                             'events_conversion_report.tsv in the output '
+                             'directory)')
+    parser.add_argument('--overwrite', action='store_true',
+                        help='overwrite existing files?')
+    parser.add_argument('--jobs', '-j', type=int,
+                        help='number of processes (default: all cores)')
+    return parser.parse_args()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,250 @@
+"""Cache of pre-decoded movie frames at presentation size.
+
+Each clip is decoded once, rescaled to the presentation size, and stored as
+a .npy file of uint8 RGB frames with shape (nframes, height, width, 3),
+keyed by the content hash of the clip in the stimulus manifest. The frames
+can then be memory-mapped at presentation time, so that loading a clip
+costs a file open rather than a decode.
+"""
+import argparse
+import json
+import multiprocessing
+import os
+from os.path import join as pjoin, exists as pexists
+import time
+import numpy as np
+from manifest import MANIFEST_FN, update_manifest, manifest_hashes
+
+PWD = os.path.dirname(os.path.abspath(__file__))
+CACHE_DIR = pjoin(PWD, 'cache', 'frames')
+# size of the clips on screen
+MOVIE_SIZE = (1280, 940)
+# duration in s of the start of a clip paged in when it is opened (see
+# MemmapClip.prefetch); the rest is paged in as the clip is played
+PREFETCH_S = 0.25
+
+
+def cache_key(content_hash, size=MOVIE_SIZE):
+    return '{0}_{1}x{2}'.format(content_hash, size[0], size[1])
+
+
+def cache_fns(cache_dir, key):
+    """Returns the filenames of the frames and of the metadata"""
+    return pjoin(cache_dir, key + '.npy'), pjoin(cache_dir, key + '.json')
+
+
+def save_frames(cache_dir, key, frames, nframes, size, fps, source=None):
+    """Writes the frames to the cache.
+
+    Arguments
+    ---------
+    cache_dir : str
+        cache directory
+    key : str
+        cache key (see cache_key)
+    frames : iterable
+        uint8 RGB frames of shape (height, width, 3)
+    nframes : int
+        number of frames to store; frames is truncated, or padded by
+        repeating the last frame
+    size : tuple
+        (width, height) of the frames
+    fps : float
+        frame rate
+    source : str or None
+        original clip, stored in the metadata for reference
+
+    Returns
+    -------
+    frames_fn : str
+        filename of the stored frames
+    """
+    if not pexists(cache_dir):
+        os.makedirs(cache_dir)
+    frames_fn, meta_fn = cache_fns(cache_dir, key)
+    width, height = size
+    tmp_fn = '{0}.{1}.tmp.npy'.format(frames_fn[:-4], os.getpid())
+    out = np.lib.format.open_memmap(tmp_fn, mode='w+', dtype=np.uint8,
+                                    shape=(nframes, height, width, 3))
+    iframe = -1
+    for iframe, frame in enumerate(frames):
+        if iframe >= nframes:
+            break
+        out[iframe] = frame
+    if 0 <= iframe < nframes - 1:
+        out[iframe + 1:] = out[iframe]
+    out.flush()
+    del out
+    with open(meta_fn, 'wb') as f:
+        json.dump({'fps': fps, 'nframes': nframes, 'size': list(size),
+                   'source': source}, f)
+    # the frames are moved in place last, so that their presence means that
+    # the entry is complete
+    os.rename(tmp_fn, frames_fn)
+    return frames_fn
+
+
+def resample(clip, fps, nframes):
+    """Yields the frames of a moviepy clip at a fixed frame rate, stopping
+    at the end of the clip or after nframes frames"""
+    for iframe in range(nframes):
+        t = iframe / float(fps)
+        if t >= clip.duration:
+            return
+        yield clip.get_frame(t)
+
+
+def decode_clip(fn, cache_dir, key, size=MOVIE_SIZE, fps=None,
+                duration=None):
+    """Decodes a clip with moviepy (as MovieStim3 does), rescales it to
+    size, and stores the frames in the cache. If fps is given, the clip is
+    resampled at that frame rate; if duration is given, it is trimmed or
+    padded (repeating the last frame) to that duration."""
+    from moviepy.video.io.VideoFileClip import VideoFileClip
+    clip = VideoFileClip(fn, audio=False,
+                         target_resolution=(size[1], size[0]))
+    try:
+        nframes = int(round((duration or clip.duration) *
+                            (fps or clip.fps)))
+        if fps is None:
+            frames = clip.iter_frames()
+        else:
+            frames = resample(clip, fps, nframes)
+        return save_frames(cache_dir, key, frames, nframes, size,
+                           fps or clip.fps, source=fn)
+    finally:
+        clip.reader.close()
+
+
+def is_cached(cache_dir, key):
+    return pexists(cache_fns(cache_dir, key)[0])
+
+
+def load_frames(cache_dir, key):
+    """Returns the memory-mapped frames (read-only) and their metadata"""
+    frames_fn, meta_fn = cache_fns(cache_dir, key)
+    with open(meta_fn, 'rb') as f:
+        meta = json.load(f)
+    return np.load(frames_fn, mmap_mode='r'), meta
+
+
+class MemmapClip(object):
+    """Minimal stand-in for a moviepy VideoFileClip that serves frames from
+    the cache. get_frame returns views into the memory map, so no frame is
+    copied before being uploaded to the texture."""
+    def __init__(self, cache_dir, key):
+        self.frames, meta = load_frames(cache_dir, key)
+        self.fps = meta['fps']
+        self.nframes = len(self.frames)
+        self.duration = self.nframes / float(self.fps)
+        self.size = tuple(meta['size'])
+        self.audio = None
+
+    def prefetch(self, duration=PREFETCH_S):
+        """Reads one byte per page of the frames of the first duration s,
+        so that the start of the clip is in the page cache before it is
+        played, without reading the whole clip"""
+        n = self.frame_index(duration) + 1
+        self.frames[:n].reshape(n, -1)[:, ::4096].sum()
+
+    def frame_index(self, t):
+        return min(max(int(t * self.fps + 1e-6), 0), self.nframes - 1)
+
+    def get_frame(self, t):
+        return self.frames[self.frame_index(t)]
+
+    def close(self):
+        # dropping the reference releases the memory map
+        self.frames = None
+
+
+def _build_entry(args):
+    fn, cache_dir, key, size = args
+    if is_cached(cache_dir, key):
+        return fn, 'cached', 0., None
+    tstart = time.time()
+    try:
+        decode_clip(fn, cache_dir, key, size)
+    except Exception as exc:
+        return fn, 'failed', 0., '{0}: {1}'.format(type(exc).__name__, exc)
+    return fn, 'decoded', time.time() - tstart, None
+
+
+def build_cache(stim_dir, cache_dir=CACHE_DIR, manifest_fn=MANIFEST_FN,
+                size=MOVIE_SIZE, n_jobs=None):
+    """Decodes all the clips in the stimulus manifest that are not cached
+    yet.
+
+    Arguments
+    ---------
+    stim_dir : str
+        directory containing stimuli
+    cache_dir : str
+        cache directory
+    manifest_fn : str or None
+        stimulus manifest
+    size : tuple
+        (width, height) of the cached frames
+    n_jobs : int or None
+        number of processes; None uses all cores, 1 runs serially
+
+    Returns
+    -------
+    results : list
+        (clip, status, decode time, error) for each clip, where status is
+        one of 'cached', 'decoded', 'failed'
+    """
+    manifest = update_manifest(stim_dir, manifest_fn)
+    hashes = manifest_hashes(manifest, start=PWD)
+    jobs = [(pjoin(PWD, fn), cache_dir, cache_key(hashes[fn], size), size)
+            for fn in sorted(hashes)]
+    if n_jobs == 1:
+        return map(_build_entry, jobs)
+    pool = multiprocessing.Pool(processes=n_jobs)
+    try:
+        return pool.map(_build_entry, jobs)
+    finally:
+        pool.close()
+        pool.join()
+
+
+def main():
+    parsed = parse_args()
+    results = build_cache(parsed.stimdir, parsed.cache_dir, parsed.manifest,
+                          tuple(parsed.size), parsed.jobs)
+    failed = 0
+    for fn, status, elapsed, error in results:
+        if status == 'decoded':
+            print("decoded {0} in {1:.2f}s".format(fn, elapsed))
+        elif status == 'failed':
+            failed += 1
+            print("FAILED {0}: {1}".format(fn, error))
+    print("{0} clips, {1} already cached, {2} failed".format(
+        len(results), sum(r[1] == 'cached' for r in results), failed))
+    if failed:
+        raise SystemExit(1)
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description=__doc__)
+
+    parser.add_argument('--stimdir', '-d', type=str,
+                        help='directory containing stimuli',
+                        default=pjoin(PWD, 'stimuli'))
+    parser.add_argument('--manifest', type=str,
+                        help='stimulus manifest, refreshed if stale',
+                        default=MANIFEST_FN)
+    parser.add_argument('--cache-dir', '-o', type=str,
+                        help='cache directory',
+                        default=CACHE_DIR)
+    parser.add_argument('--size', type=int, nargs=2,
+                        metavar=('WIDTH', 'HEIGHT'),
+                        help='presentation size of the clips',
+                        default=list(MOVIE_SIZE))
+    parser.add_argument('--jobs', '-j', type=int,
+                        help='number of processes (default: all cores)')
+    return parser.parse_args()
+
+
+if __name__ == '__main__':
+    main()
@@ -1,17 +1,28 @@
 """Make stimulus order for localizer"""
 import argparse
-from copy import deepcopy
 import json
+import multiprocessing
 import os
-from os.path import join as pjoin, relpath
-from glob import glob
+from os.path import join as pjoin
+import shutil
+import time
 import numpy as np
-from random import shuffle, sample, random
+from manifest import MANIFEST_FN, update_manifest, manifest_stimuli, \
+    manifest_hashes, list_stimuli
+from ordersearch import search_orders, imbalance, random_orders
+from profiling import span, add_profile_args, configure_from_args
+from schedule import Schedule
+from schedulecache import CACHE_DIR, stimuli_digest, schedule_key, \
+    key_seed, get_or_create
+from schedulefile import SCHEDULE_EXT, is_schedule_file, \
+    save_schedule_file, load_schedule_file
 
 PWD = os.path.dirname(os.path.abspath(__file__))
+STIMDIR = pjoin(PWD, 'stimuli')
+CONFIG_FN = pjoin(PWD, 'config.json')
 
 
-def get_stimuli(stim_dir='stimuli'):
+def get_stimuli(stim_dir='stimuli', manifest_fn=None):
     """Returns a dictionary containing the stimuli for each category
 
     Arguments
@@ -19,31 +30,22 @@ def get_stimuli(stim_dir='stimuli'):
     stim_dir : str
         directory containing subdirectories with individual stimuli; the
         name of the subdirectories will be the category name
+    manifest_fn : str or None
+        if given, the stimuli are read from the manifest stored in this
+        file, which is refreshed incrementally (see manifest.py);
+        otherwise stim_dir is only listed, and the stimuli are not hashed
 
     Returns
     -------
     stimuli : dict
-        dictionary containing lists of stimuli for each category
+        dictionary containing sorted lists of stimuli for each category
     """
-    stimuli = dict()
-    categories = glob(pjoin(stim_dir, '*'))
-    for cat in categories:
-        cat_ = os.path.basename(cat)
-        stimuli[cat_] = map(lambda x: relpath(x, start=PWD),
-                            glob(pjoin(cat, '*')))
-    return stimuli
-
+    if manifest_fn is None:
+        return list_stimuli(stim_dir)
+    return manifest_stimuli(update_manifest(stim_dir, manifest_fn))
 
-def make_trial(stim_type, duration, stim_fn):
-    trial = {
-        'stim_type': stim_type,
-        'duration': duration,
-        'stim_fn': stim_fn
-    }
-    return trial
 
-
-def create_run(stimuli):
+def create_run(stimuli, rng=None):
     """Creates a single run according to Pitcher et al., 2011.
     Each run consists of
         - fixation (18s)
@@ -56,6 +58,8 @@ def create_run(stimuli):
     ---------
     stimuli : dict
         dictionary containing lists of stimuli for each category
+    rng : np.random.RandomState or None
+        random state; if None, numpy's global random state is used
 
     Returns
     -------
@@ -65,122 +69,42 @@ def create_run(stimuli):
             - duration : stimulus duration in s
             - stim_fn : stimulus fn (if available)
     """
-    # randomize categories
-    categories = sample(stimuli.keys(), len(stimuli))
-    phases = ['fixation', categories, 'fixation', categories[::-1], 'fixation']
-    # make a copy and shuffle the stimuli
-    stimuli_ = deepcopy(stimuli)
-    for stim in stimuli_:
-        shuffle(stimuli_[stim])
-    run = []
-    for ph in phases:
-        if ph == 'fixation':
-            run.append(make_trial('fixation', 18., None))
-        else:  # we have stimuli
-            for cat in ph:
-                # these are the stimuli
-                stims = stimuli_[cat]
-                # we have 6 stimuli in each block
-                for _ in range(6):
-                    run.append(make_trial(cat, 3., stims.pop()))
-    return run
-
-
-def create_experiment(stimuli, nruns):
-    """Creates an experiment with nruns"""
-    experiment = dict()
-    for irun in range(nruns):
-        experiment[irun + 1] = create_run(stimuli)
-
-    return experiment
-
-
-def get_rand_categories(categories, n, count_categories):
-    """Returns a random sample of categories. If n > len(categories),
-    then all categories are returned plus some random categories. Also, if
-    count_categories is passed, the priority goes to those categories with
-    min(count_categories), in oder to counterbalance across runs."""
-    n_categories = len(categories)
-    idx_min_cat = np.where(count_categories == count_categories.min())[0]
-    if n <= len(idx_min_cat):
-        rand_idx_cat = sample(idx_min_cat, n)
-        sample_categories = [categories[i] for i in rand_idx_cat]
-        for i in rand_idx_cat:
-            count_categories[i] += 1
-        return sample_categories, count_categories
-    else:
-        # first fill with the minimum
-        sample_categories = [categories[i] for i in idx_min_cat]
-        for i in idx_min_cat:
-            count_categories[i] += 1
-        n_ = n - len(sample_categories)
-        # then fill with multiples of n_
-        for _ in range(n_ // n_categories):
-            sample_categories += categories
-            # add one to all categories
-            count_categories += 1
-        # finally fill the remainder
-        idx_sample_categories_ = sample(range(n_categories), n_ % n_categories)
-        for idx in idx_sample_categories_:
-            count_categories[idx] += 1
-        sample_categories += [categories[idx]
-                              for idx in idx_sample_categories_]
-        shuffle(sample_categories)
-        return sample_categories, count_categories
-
-
-def inject_attention_check(exp):
+    return Schedule.create(stimuli, 1, rng).run(1)
+
+
+def create_experiment(stimuli, nruns, rng=None):
+    """Creates an experiment with nruns, in the json format (see
+    schedule.Schedule.create for the array-backed version)"""
+    return Schedule.create(stimuli, nruns, rng).to_json()
+
+
+def inject_attention_check(exp, nchecks=None, rng=None):
     """Inject some repeated trials randomly throughout the experiment.
 
     Arguments
     ---------
     exp : dict
         the experiment
-    nchecks_run : int
-        how many checks for each run to inject. Must be even.
+    nchecks : int or None
+        how many checks to inject in each run; by default, one for each
+        category. The categories are counterbalanced across runs.
+    rng : np.random.RandomState or None
+        random state; if None, numpy's global random state is used
 
     Returns
     -------
     exp_inj : dict
         the experiment with injected trials
     """
-    exp_ = deepcopy(exp)
-    # first we need to figure out how many categories we have. we assume
-    # that all runs have the same categories
-    run_idx = sorted(exp_.keys())
-    run1 = exp_[run_idx[0]]
-    categories = map(lambda x: x['stim_type'], run1)
-    categories = np.unique(filter(lambda x: x != 'fixation', categories))
-    n_categories = len(categories)
-    # we are going to arbitrarily choose a number of repetitions so that
-    # they're balanced across the experiment. it ends up by being a total of
-    # n_runs "catch trials" for each category
-    for run in exp_.itervalues():
-        categories_ = categories.copy()
-        shuffle(categories_)
-        # randomly split in two blocks
-        categories_ = [
-            categories_[:n_categories//2],
-            categories_[n_categories//2:]]
-        shuffle(categories_)
-        for check_cat, where_to_check in zip(
-                categories_,
-                (lambda x: 1 < x < len(run)//2, lambda x: x >= len(run)//2)):
-            for cat in check_cat:
-                idx_ok = np.where(map(lambda x: x['stim_type'] == cat, run))[0]
-                idx_ok = sorted(filter(where_to_check, idx_ok))
-                # also do not take the first trial because it's at the edge
-                # of two trial types
-                idx_ok = idx_ok[1:]
-                idx_check = sample(idx_ok, 1)[0]
-                run[idx_check] = run[idx_check - 1].copy()
-                run[idx_check]['repetition'] = 1
-    return exp_
-
-
-def out_fn(subid, nruns):
-    template = 'sub-{0}_task-localizer_{1}runs.json'
-    return template.format(subid, nruns)
+    schedule = Schedule.from_json(exp)
+    schedule = schedule.inject_attention_check(nchecks, rng)
+    return schedule.to_json()
+
+
+def out_fn(subid, nruns, binary=False):
+    template = 'sub-{0}_task-localizer_{1}runs'
+    return template.format(subid, nruns) + \
+        (SCHEDULE_EXT if binary else '.json')
 
 
 def save_json(obj, fn, overwrite=False):
@@ -190,9 +114,283 @@ def save_json(obj, fn, overwrite=False):
         json.dump(obj, f, indent=True)
 
 
+def generate_schedule(subid, stimuli, nruns, seed=0, nchecks=None,
+                      orders=None, digest=None):
+    """Creates the experiment for a single subject and injects the
+    attention checks. The random state is seeded from the cache key (see
+    schedulecache.schedule_key), so the experiment only depends on the
+    arguments and on the generator version.
+
+    Returns
+    -------
+    schedule : Schedule
+    key : str
+        cache key of the experiment
+    """
+    if digest is None:
+        digest = stimuli_digest(stimuli)
+    key = schedule_key(subid, nruns, digest, seed, nchecks, orders)
+    rng = np.random.RandomState(key_seed(key))
+    with span('create'):
+        schedule = Schedule.create(stimuli, nruns, rng, orders)
+    # inject attention check
+    with span('inject'):
+        schedule = schedule.inject_attention_check(nchecks, rng)
+    with span('validate'):
+        problems = schedule.validate()
+    if problems:
+        raise ValueError("Invalid schedule: {0}".format(problems))
+    return schedule, key
+
+
+def generate_subject(subid, stimuli, nruns, out_dir, overwrite=False,
+                     seed=0, nchecks=None, orders=None, digest=None,
+                     cache_dir=None, binary=False):
+    """Creates the experiment for a single subject, injects the attention
+    checks, and saves it in out_dir.
+
+    Arguments
+    ---------
+    subid : str
+        subject id
+    stimuli : dict
+        dictionary containing lists of stimuli for each category
+    nruns : int
+        number of runs
+    out_dir : str
+        output directory
+    overwrite : bool
+        overwrite existing files?
+    seed : int
+        base seed
+    nchecks : int or None
+        number of attention checks in each run; by default, one for each
+        category
+    orders : array (nruns, ncategories) or None
+        order of the categories in each run (see ordersearch.py); random
+        if None
+    digest : str or None
+        hash of the stimuli, including their content (see
+        schedulecache.stimuli_digest); if None, it is computed from the
+        filenames only
+    cache_dir : str or None
+        if given, the experiment is taken from this schedule cache, or
+        generated and stored in it
+    binary : bool
+        save the experiment in the binary format (see schedulefile.py)
+        instead of json
+
+    Returns
+    -------
+    fn : str
+        filename of the saved experiment
+    """
+    fn = pjoin(out_dir, out_fn(subid, nruns, binary))
+    if os.path.exists(fn) and not overwrite:
+        raise ValueError("{0} exists, not overwriting".format(fn))
+    if digest is None:
+        digest = stimuli_digest(stimuli)
+    if cache_dir is None:
+        schedule, _ = generate_schedule(subid, stimuli, nruns, seed,
+                                        nchecks, orders, digest)
+        save_schedule(schedule, fn, overwrite)
+        return fn
+    key = schedule_key(subid, nruns, digest, seed, nchecks, orders)
+    with span('cache'):
+        cached_fn, _ = get_or_create(
+            cache_dir, key, lambda: generate_schedule(
+                subid, stimuli, nruns, seed, nchecks, orders,
+                digest)[0].to_json())
+    if binary:
+        save_schedule_file(load_schedule(cached_fn), fn, overwrite)
+    else:
+        shutil.copyfile(cached_fn, fn)
+    return fn
+
+
+def config_nruns(fn=CONFIG_FN):
+    """Returns the number of runs in the config file (4 if not set)"""
+    try:
+        with open(fn, 'rb') as f:
+            return json.load(f).get('nruns', 4)
+    except IOError:
+        return 4
+
+
+def make_schedule(subid, nruns=None, manifest=None, stim_dir=STIMDIR,
+                  manifest_fn=MANIFEST_FN, seed=0, nchecks=None,
+                  out_dir=None, overwrite=False, cache_dir=CACHE_DIR):
+    """Returns the experiment for a subject, taking it from the schedule
+    cache or generating it, and optionally saves it.
+
+    Arguments
+    ---------
+    subid : str
+        subject id
+    nruns : int or None
+        number of runs; if None, it is read from the config file
+    manifest : dict or None
+        stimulus manifest; if None, it is loaded from manifest_fn and
+        refreshed from stim_dir
+    stim_dir : str
+        directory containing stimuli
+    manifest_fn : str
+        stimulus manifest file
+    seed : int
+        base seed
+    nchecks : int or None
+        number of attention checks in each run
+    out_dir : str or None
+        if given, the experiment is saved in this directory (see out_fn)
+    overwrite : bool
+        overwrite an existing file in out_dir?
+    cache_dir : str or None
+        schedule cache; if None, the cache is not used
+
+    Returns
+    -------
+    schedule : Schedule
+    """
+    if nruns is None:
+        nruns = config_nruns()
+    with span('stimuli'):
+        if manifest is None:
+            manifest = update_manifest(stim_dir, manifest_fn)
+        stimuli = manifest_stimuli(manifest)
+        digest = stimuli_digest(stimuli, manifest_hashes(manifest))
+    fn = None
+    if out_dir is not None:
+        fn = pjoin(out_dir, out_fn(subid, nruns))
+        if os.path.exists(fn) and not overwrite:
+            raise ValueError("{0} exists, not overwriting".format(fn))
+    if cache_dir is None:
+        schedule, _ = generate_schedule(subid, stimuli, nruns, seed,
+                                        nchecks, digest=digest)
+    else:
+        key = schedule_key(subid, nruns, digest, seed, nchecks)
+        with span('cache'):
+            cached_fn, _ = get_or_create(
+                cache_dir, key, lambda: generate_schedule(
+                    subid, stimuli, nruns, seed, nchecks,
+                    digest=digest)[0].to_json())
+        schedule = load_schedule(cached_fn)
+    if fn is not None:
+        save_schedule(schedule, fn, overwrite)
+    return schedule
+
+
+def save_schedule(schedule, fn, overwrite=False):
+    """Saves a Schedule in the binary format if fn has the extension of
+    schedule files (see schedulefile.py), in the json format otherwise"""
+    with span('save'):
+        if fn.endswith(SCHEDULE_EXT):
+            save_schedule_file(schedule, fn, overwrite)
+        else:
+            save_json(schedule.to_json(), fn, overwrite)
+
+
+def load_schedule(fn):
+    """Loads an experiment saved in the json or in the binary format as a
+    Schedule"""
+    with span('load'):
+        if is_schedule_file(fn):
+            return load_schedule_file(fn)
+        with open(fn, 'rb') as f:
+            return Schedule.from_json(json.load(f))
+
+
+def _generate_subject_job(args):
+    """Pool worker: returns (subid, fn, error) instead of raising, so that
+    a single failure doesn't stop the whole batch."""
+    subid = args[0]
+    try:
+        return subid, generate_subject(*args), None
+    except Exception as exc:
+        return subid, None, '{0}: {1}'.format(type(exc).__name__, exc)
+
+
+def generate_batch(subids, stimuli, nruns, out_dir, overwrite=False,
+                   seed=0, nchecks=None, orders=None, digest=None,
+                   cache_dir=None, n_jobs=None, binary=False):
+    """Creates and saves the experiments for several subjects in parallel.
+    Each subject gets its own deterministic seed (see generate_schedule), so
+    that the output doesn't depend on the number of jobs.
+
+    Arguments
+    ---------
+    subids : list
+        subject ids
+    stimuli : dict
+        dictionary containing lists of stimuli for each category
+    nruns : int
+        number of runs
+    out_dir : str
+        output directory
+    overwrite : bool
+        overwrite existing files?
+    seed : int
+        base seed
+    nchecks : int or None
+        number of attention checks in each run
+    orders : array (nsubjects, nruns, ncategories) or None
+        order of the categories in each run of each subject, e.g. from
+        ordersearch.search_orders; random if None
+    digest : str or None
+        hash of the stimuli (see generate_subject)
+    cache_dir : str or None
+        schedule cache (see generate_subject)
+    n_jobs : int or None
+        number of processes; None uses all cores, 1 runs serially
+    binary : bool
+        save the experiments in the binary format (see schedulefile.py)
+
+    Returns
+    -------
+    done : dict
+        subject id -> filename of the saved experiment
+    failed : dict
+        subject id -> error message
+    """
+    if digest is None:
+        digest = stimuli_digest(stimuli)
+    jobs = [(subid, stimuli, nruns, out_dir, overwrite, seed, nchecks,
+             orders[i] if orders is not None else None, digest, cache_dir,
+             binary)
+            for i, subid in enumerate(subids)]
+    if n_jobs == 1:
+        results = map(_generate_subject_job, jobs)
+    else:
+        pool = multiprocessing.Pool(processes=n_jobs)
+        try:
+            results = list(pool.imap_unordered(_generate_subject_job, jobs))
+        finally:
+            pool.close()
+            pool.join()
+    done = dict()
+    failed = dict()
+    for subid, fn, error in results:
+        if error is None:
+            done[subid] = fn
+        else:
+            failed[subid] = error
+    return done, failed
+
+
+def get_subids(parsed):
+    """Returns the list of subject ids requested on the command line"""
+    if parsed.subid:
+        return parsed.subid
+    if parsed.subid_file:
+        with open(parsed.subid_file, 'rb') as f:
+            return [l.strip() for l in f if l.strip()]
+    start, stop = parsed.subid_range
+    return [parsed.subid_template.format(i) for i in range(start, stop + 1)]
+
+
 def main():
     parsed = parse_args()
-    subid = parsed.subid
+    configure_from_args('make_stim_order', parsed)
+    subids = get_subids(parsed)
     nruns = parsed.nruns
     stim_dir = parsed.stimdir
     out_dir = parsed.output
@@ -201,30 +399,108 @@ def main():
     if not os.path.exists(out_dir):
         os.makedirs(out_dir)
 
-    stimuli = get_stimuli(stim_dir)
-    exp = create_experiment(stimuli, nruns)
-    # inject attention check
-    exp = inject_attention_check(exp)
-    save_json(exp, pjoin(out_dir, out_fn(subid, nruns)), overwrite)
+    with span('stimuli'):
+        manifest = update_manifest(stim_dir, parsed.manifest)
+        stimuli = manifest_stimuli(manifest)
+        digest = stimuli_digest(stimuli, manifest_hashes(manifest))
+    cache_dir = parsed.cache_dir if not parsed.no_cache else None
+    seed = parsed.seed
+    orders = None
+    if parsed.balance is not None or parsed.balance_iter is not None:
+        with span('balance'):
+            orders, score = search_orders(
+                len(stimuli), nruns, len(subids), budget=parsed.balance,
+                max_iter=parsed.balance_iter, seed=seed,
+                n_jobs=parsed.jobs)
+        random_score = imbalance(random_orders(
+            len(stimuli), nruns, len(subids), np.random.RandomState(seed)))
+        print("Category orders: imbalance {0:.1f} (random orders: "
+              "{1:.1f})".format(score, random_score))
+    if len(subids) == 1:
+        with span('generate'):
+            generate_subject(subids[0], stimuli, nruns, out_dir, overwrite,
+                             seed=seed, nchecks=parsed.nchecks,
+                             orders=orders[0] if orders is not None
+                             else None,
+                             digest=digest, cache_dir=cache_dir,
+                             binary=parsed.binary)
+        return
+
+    tstart = time.time()
+    # with more than one job, the spans of the workers are not recorded
+    with span('generate'):
+        done, failed = generate_batch(
+            subids, stimuli, nruns, out_dir, overwrite,
+            seed=seed, nchecks=parsed.nchecks, orders=orders, digest=digest,
+            cache_dir=cache_dir, n_jobs=parsed.jobs, binary=parsed.binary)
+    elapsed = time.time() - tstart
+    print("Generated {0}/{1} schedules in {2:.2f}s ({3:.1f} schedules/s)"
+          .format(len(done), len(subids), elapsed,
+                  len(done) / max(elapsed, 1e-6)))
+    for subid in sorted(failed):
+        print("FAILED {0}: {1}".format(subid, failed[subid]))
+    if failed:
+        raise SystemExit(1)
 
 
 def parse_args():
     parser = argparse.ArgumentParser()
 
-    parser.add_argument('--subid', '-s', type=str,
-                        help='subject id',
-                        required=True)
+    subjects = parser.add_mutually_exclusive_group(required=True)
+    subjects.add_argument('--subid', '-s', type=str, nargs='+',
+                          help='subject id(s)')
+    subjects.add_argument('--subid-file', type=str,
+                          help='file with one subject id per line')
+    subjects.add_argument('--subid-range', type=int, nargs=2,
+                          metavar=('START', 'STOP'),
+                          help='range of subject numbers (inclusive), '
+                               'formatted with --subid-template')
+    parser.add_argument('--subid-template', type=str,
+                        help='template for --subid-range',
+                        default='{0:03d}')
     parser.add_argument('--nruns', '-n', type=int,
-                        help='number of runs',
-                        default=4)
+                        help='number of runs (default: nruns in '
+                             'config.json)',
+                        default=config_nruns())
+    parser.add_argument('--nchecks', type=int,
+                        help='number of attention checks (repetitions) in '
+                             'each run (default: one per category)')
+    parser.add_argument('--balance', type=float, metavar='SECONDS',
+                        help='search category orders balanced for '
+                             'carry-over and position across the runs of '
+                             'each subject and across the cohort, for '
+                             'this many seconds (see ordersearch.py)')
+    parser.add_argument('--balance-iter', type=int, metavar='N',
+                        help='like --balance, but stop after N iterations '
+                             '(reproducible)')
     parser.add_argument('--stimdir', '-d', type=str,
                         help='directory containing stimuli',
-                        default=pjoin(PWD, 'stimuli'))
+                        default=STIMDIR)
+    parser.add_argument('--manifest', type=str,
+                        help='stimulus manifest, refreshed if stale',
+                        default=MANIFEST_FN)
     parser.add_argument('--overwrite', action='store_true',
                         help='overwrite existing files?')
+    parser.add_argument('--binary', action='store_true',
+                        help='save in the compact binary format (see '
+                             'schedulefile.py) instead of json')
     parser.add_argument('--output', '-o', type=str,
                         help='output directory',
                         required=True)
+    parser.add_argument('--seed', type=int,
+                        help='base seed; each subject gets a seed derived '
+                             'from this, its id, the stimuli and the other '
+                             'options',
+                        default=0)
+    parser.add_argument('--cache-dir', type=str,
+                        help='schedule cache',
+                        default=CACHE_DIR)
+    parser.add_argument('--no-cache', action='store_true',
+                        help='always generate, without using the cache')
+    parser.add_argument('--jobs', '-j', type=int,
+                        help='number of processes for batches '
+                             '(default: all cores)')
+    add_profile_args(parser)
     return parser.parse_args()
 
 
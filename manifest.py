@@ -0,0 +1,245 @@
+"""Persistent index of the stimuli available for each category.
+
+The manifest stores, for each category subdirectory of the stimulus
+directory, the files it contains with their size, mtime and content hash.
+It is refreshed incrementally: a category directory is listed again only if
+its mtime changed (i.e. files were added, removed or renamed), while the
+files already known are stat'ed on every refresh, and hashed again only if
+their size or mtime changed (e.g. a clip overwritten in place).
+"""
+import argparse
+import hashlib
+import json
+import os
+from os.path import join as pjoin, relpath
+
+PWD = os.path.dirname(os.path.abspath(__file__))
+MANIFEST_FN = pjoin(PWD, 'cfg', 'stimuli_manifest.json')
+MANIFEST_VERSION = 1
+
+
+def file_hash(fn, blocksize=1 << 20):
+    """Returns the sha1 of the content of fn. For dangling symlinks (e.g.,
+    git-annex files whose content is not present) the hash of the link
+    target is returned instead, which for annexed files already encodes the
+    content."""
+    sha1 = hashlib.sha1()
+    if os.path.islink(fn) and not os.path.exists(fn):
+        sha1.update(os.readlink(fn).encode('utf-8'))
+        return 'link-' + sha1.hexdigest()
+    with open(fn, 'rb') as f:
+        block = f.read(blocksize)
+        while block:
+            sha1.update(block)
+            block = f.read(blocksize)
+    return sha1.hexdigest()
+
+
+def _stat(fn):
+    """os.stat that doesn't fail on dangling symlinks"""
+    try:
+        return os.stat(fn)
+    except OSError:
+        return os.lstat(fn)
+
+
+def _scan_category(cat_dir, old_files, relist=True):
+    """Returns the files in cat_dir, reusing the hashes in old_files for
+    those files whose size and mtime didn't change. If relist is False,
+    only the files in old_files are stat'ed, without listing cat_dir."""
+    files = dict()
+    fns = os.listdir(cat_dir) if relist else list(old_files)
+    for fn in fns:
+        if fn.startswith('.'):
+            continue
+        try:
+            st = _stat(pjoin(cat_dir, fn))
+        except OSError:
+            # removed since cat_dir was listed
+            continue
+        old = old_files.get(fn)
+        if old is not None and old['size'] == st.st_size \
+                and old['mtime'] == st.st_mtime:
+            files[fn] = old
+        else:
+            files[fn] = {
+                'size': st.st_size,
+                'mtime': st.st_mtime,
+                'hash': file_hash(pjoin(cat_dir, fn)),
+            }
+    return files
+
+
+def empty_manifest(stim_dir):
+    return {
+        'version': MANIFEST_VERSION,
+        'stim_dir': os.path.abspath(stim_dir),
+        'mtime': None,
+        'categories': dict(),
+    }
+
+
+def load_manifest(fn):
+    """Loads the manifest saved in fn. Returns None if fn doesn't exist or
+    was saved by a different version."""
+    if not os.path.exists(fn):
+        return None
+    with open(fn, 'rb') as f:
+        manifest = json.load(f)
+    if manifest.get('version') != MANIFEST_VERSION:
+        return None
+    return manifest
+
+
+def save_manifest(manifest, fn):
+    """Saves the manifest atomically, so that readers never see a
+    partially written file"""
+    out_dir = os.path.dirname(fn)
+    if out_dir and not os.path.exists(out_dir):
+        os.makedirs(out_dir)
+    tmp_fn = '{0}.{1}.tmp'.format(fn, os.getpid())
+    with open(tmp_fn, 'wb') as f:
+        json.dump(manifest, f, indent=True, sort_keys=True)
+    os.rename(tmp_fn, fn)
+
+
+def refresh_manifest(manifest, stim_dir):
+    """Refreshes the manifest in place, listing again only the category
+    directories that changed, and hashing again only the files that
+    changed.
+
+    Arguments
+    ---------
+    manifest : dict
+        manifest to refresh; if it refers to a different stim_dir it is
+        rebuilt from scratch
+    stim_dir : str
+        directory containing subdirectories with individual stimuli; the
+        name of the subdirectories will be the category name
+
+    Returns
+    -------
+    changed : list
+        categories that were added or removed, or whose files changed
+    """
+    stim_dir_abs = os.path.abspath(stim_dir)
+    if manifest['stim_dir'] != stim_dir_abs:
+        manifest.update(empty_manifest(stim_dir))
+    old_categories = manifest['categories']
+    changed = []
+    mtime = os.stat(stim_dir).st_mtime
+    if mtime != manifest['mtime']:
+        # categories were added or removed
+        cats = [c for c in os.listdir(stim_dir)
+                if not c.startswith('.') and
+                os.path.isdir(pjoin(stim_dir, c))]
+        for cat in set(old_categories) - set(cats):
+            del old_categories[cat]
+            changed.append(cat)
+        manifest['mtime'] = mtime
+    else:
+        cats = list(old_categories)
+    for cat in cats:
+        cat_dir = pjoin(stim_dir, cat)
+        cat_mtime = os.stat(cat_dir).st_mtime
+        old = old_categories.get(cat)
+        old_files = old['files'] if old is not None else dict()
+        relist = old is None or old['mtime'] != cat_mtime
+        files = _scan_category(cat_dir, old_files, relist)
+        if relist or files != old_files:
+            old_categories[cat] = {'mtime': cat_mtime, 'files': files}
+            changed.append(cat)
+    return sorted(changed)
+
+
+def update_manifest(stim_dir, fn=None):
+    """Loads the manifest from fn (if given), refreshes it, and saves it
+    back if anything changed.
+
+    Arguments
+    ---------
+    stim_dir : str
+        directory containing subdirectories with individual stimuli
+    fn : str or None
+        where the manifest is stored; if None, the manifest is built in
+        memory and not saved
+
+    Returns
+    -------
+    manifest : dict
+    """
+    manifest = load_manifest(fn) if fn is not None else None
+    if manifest is None:
+        manifest = empty_manifest(stim_dir)
+    changed = refresh_manifest(manifest, stim_dir)
+    if fn is not None and changed:
+        save_manifest(manifest, fn)
+    return manifest
+
+
+def list_stimuli(stim_dir, start=PWD):
+    """Returns a dictionary containing sorted lists of stimuli for each
+    category, with paths relative to start, listing stim_dir without
+    building a manifest (nothing is hashed)"""
+    stimuli = dict()
+    for cat in os.listdir(stim_dir):
+        cat_dir = pjoin(stim_dir, cat)
+        if cat.startswith('.') or not os.path.isdir(cat_dir):
+            continue
+        stimuli[cat] = [relpath(pjoin(cat_dir, fn), start=start)
+                        for fn in sorted(os.listdir(cat_dir))
+                        if not fn.startswith('.')]
+    return stimuli
+
+
+def manifest_stimuli(manifest, start=PWD):
+    """Returns a dictionary containing sorted lists of stimuli for each
+    category, with paths relative to start"""
+    stim_dir = manifest['stim_dir']
+    stimuli = dict()
+    for cat, entry in manifest['categories'].items():
+        stimuli[cat] = [relpath(pjoin(stim_dir, cat, fn), start=start)
+                        for fn in sorted(entry['files'])]
+    return stimuli
+
+
+def manifest_hashes(manifest, start=PWD):
+    """Returns a dictionary mapping each stimulus, with path relative to
+    start, to its content hash"""
+    stim_dir = manifest['stim_dir']
+    hashes = dict()
+    for cat, entry in manifest['categories'].items():
+        for fn, info in entry['files'].items():
+            hashes[relpath(pjoin(stim_dir, cat, fn), start=start)] = \
+                info['hash']
+    return hashes
+
+
+def main():
+    parsed = parse_args()
+    manifest = load_manifest(parsed.output)
+    if manifest is None:
+        manifest = empty_manifest(parsed.stimdir)
+    changed = refresh_manifest(manifest, parsed.stimdir)
+    if changed:
+        save_manifest(manifest, parsed.output)
+    for cat in sorted(manifest['categories']):
+        print("{0}: {1} stimuli{2}".format(
+            cat, len(manifest['categories'][cat]['files']),
+            ' (updated)' if cat in changed else ''))
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description=__doc__)
+
+    parser.add_argument('--stimdir', '-d', type=str,
+                        help='directory containing stimuli',
+                        default=pjoin(PWD, 'stimuli'))
+    parser.add_argument('--output', '-o', type=str,
+                        help='manifest file',
+                        default=MANIFEST_FN)
+    return parser.parse_args()
+
+
+if __name__ == '__main__':
+    main()
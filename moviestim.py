@@ -0,0 +1,93 @@
+"""Movie stimuli played from the frame cache (see framecache.py)"""
+from psychopy import visual
+from framecache import MemmapClip, cache_key, is_cached, MOVIE_SIZE
+
+# rough memory held by a clip opened with moviepy, besides its last frame:
+# the ffmpeg process decoding it and the buffers of the pipe reading it
+READER_NBYTES = 32 * 2 ** 20
+
+
+def clip_nbytes(clip):
+    """Returns an estimate of the memory held by a clip returned by
+    open_clip: all the frames for cached clips (once played), and the
+    ffmpeg reader and the last frame for the others"""
+    frames = getattr(clip, 'frames', None)
+    if frames is not None:
+        return frames.nbytes
+    width, height = clip.size
+    return READER_NBYTES + width * height * 3
+
+
+def open_clip(filename, content_hash=None, cache_dir=None,
+              size=MOVIE_SIZE):
+    """Opens a clip without touching OpenGL, so that it can be called from
+    a background thread. Returns a MemmapClip with its first frames paged
+    in if the clip is in the frame cache, or a moviepy VideoFileClip
+    otherwise.
+    """
+    if content_hash is not None and cache_dir is not None:
+        key = cache_key(content_hash, size)
+        if is_cached(cache_dir, key):
+            clip = MemmapClip(cache_dir, key)
+            clip.prefetch()
+            return clip
+    from moviepy.video.io.VideoFileClip import VideoFileClip
+    return VideoFileClip(filename, audio=False)
+
+
+class PreparedMovieStim(visual.MovieStim3):
+    """MovieStim3 that plays an already opened clip (see open_clip) instead
+    of opening filename itself. Frames from the frame cache are already at
+    presentation size, and are uploaded to the texture straight from the
+    memory map."""
+    def __init__(self, win, filename, clip, **kwargs):
+        # loadMovie is called by MovieStim3.__init__, so this must be set
+        # beforehand
+        self._clip = clip
+        kwargs['noAudio'] = True
+        super(PreparedMovieStim, self).__init__(win, filename, **kwargs)
+
+    def loadMovie(self, filename, log=True):
+        self.reset()
+        self._mov = self._clip
+        self._audioStream = None
+        self._frameInterval = 1.0 / self._mov.fps
+        self.duration = self._mov.duration
+        self.filename = filename
+        self._updateFrameTexture()
+
+    def time_to_next_frame(self):
+        """Returns how long until draw() will show a new frame of the movie
+        (0 if it would show one now)"""
+        if self._nextFrameT is None or self.status != visual.PLAYING:
+            return 0.
+        # same criterion as MovieStim3._updateFrameTexture
+        return max(0., self._nextFrameT + self._retraceInterval / 2. -
+                   self._videoClock.getTime())
+
+    def current_frame(self):
+        """Returns the index of the last frame of the movie that was drawn
+        (-1 if none)"""
+        if self._nextFrameT is None:
+            return -1
+        return int(round(self._nextFrameT / self._frameInterval)) - 1
+
+    def detach(self):
+        """Frees the texture but leaves the clip open, so that it can be
+        used by another stimulus"""
+        try:
+            self.clearTextures()
+        except Exception:
+            pass
+        self._mov = None
+        self._clip = None
+        self._numpyFrame = None
+        self.status = visual.FINISHED
+
+
+def make_movie(win, filename, content_hash=None, cache_dir=None,
+               size=MOVIE_SIZE, **kwargs):
+    """Returns a movie stimulus for filename, played from the frame cache if
+    the clip is cached"""
+    clip = open_clip(filename, content_hash, cache_dir, size)
+    return PreparedMovieStim(win, filename, clip, size=size, **kwargs)
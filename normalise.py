@@ -0,0 +1,265 @@
+"""Offline normalisation of the clips into presentation-ready frames.
+
+Every clip in the stimulus manifest is decoded once in a process pool,
+rescaled to the presentation size, resampled at a fixed frame rate, and
+trimmed or padded (repeating the last frame) to the trial duration, so that
+the render loop neither scales nor loops the clips. The frames are stored
+raw in the frame cache (see framecache.py) under the same key as an
+unnormalised entry, so run_localizer.py picks them up without changes.
+
+What was changed in each clip (size, frame rate, duration), together with
+the decode cost per frame of the original clip and of the normalised frames,
+is recorded in the manifest entry of the clip under 'normalised'. Clips
+whose entry matches the current settings and whose frames are in the cache
+are skipped; the manifest drops the entry of a file that changed, so edited
+clips are normalised again.
+"""
+import argparse
+import multiprocessing
+import os
+from os.path import join as pjoin
+import time
+import numpy as np
+from framecache import CACHE_DIR, MOVIE_SIZE, MemmapClip, cache_key, \
+    decode_clip, is_cached
+from manifest import MANIFEST_FN, update_manifest, save_manifest
+from schedule import STIM_DURATION
+
+PWD = os.path.dirname(os.path.abspath(__file__))
+# frame rate of the normalised clips
+CLIP_FPS = 30.
+
+
+def clip_changes(source, size, fps, duration):
+    """Returns a list of the changes made to a clip.
+
+    Arguments
+    ---------
+    source : dict
+        size ([width, height]), fps and duration of the original clip
+    size : tuple
+        (width, height) of the normalised clip
+    fps : float
+        frame rate of the normalised clip
+    duration : float
+        duration of the normalised clip, in s
+    """
+    changes = []
+    if tuple(source['size']) != tuple(size):
+        changes.append('resized {0}x{1} -> {2}x{3}'.format(
+            source['size'][0], source['size'][1], size[0], size[1]))
+    if abs(source['fps'] - fps) > 1e-3:
+        changes.append('resampled {0:g} -> {1:g} fps'.format(
+            source['fps'], fps))
+    if source['duration'] > duration + 1e-3:
+        changes.append('trimmed {0:.2f} -> {1:g} s'.format(
+            source['duration'], duration))
+    elif source['duration'] < duration - 1e-3:
+        changes.append('padded {0:.2f} -> {1:g} s'.format(
+            source['duration'], duration))
+    return changes
+
+
+def is_normalised(info, cache_dir, key, size, fps, duration):
+    """Whether the manifest entry info of a clip records a normalisation
+    with these settings whose frames are still in the cache"""
+    entry = info.get('normalised')
+    return (entry is not None and entry['key'] == key and
+            tuple(entry['size']) == tuple(size) and
+            entry['fps'] == fps and entry['duration'] == duration and
+            is_cached(cache_dir, key))
+
+
+def source_decode_cost(fn, max_frames=None):
+    """Decodes a clip at its own size and frame rate, as MovieStim3 does
+    before rescaling.
+
+    Returns
+    -------
+    source : dict
+        size ([width, height]), fps and duration of the clip
+    ms_per_frame : float
+        decode time per frame, in ms
+    """
+    from moviepy.video.io.VideoFileClip import VideoFileClip
+    clip = VideoFileClip(fn, audio=False)
+    try:
+        source = {'size': list(clip.size), 'fps': clip.fps,
+                  'duration': clip.duration}
+        nframes = 0
+        tstart = time.time()
+        for _ in clip.iter_frames():
+            nframes += 1
+            if max_frames is not None and nframes >= max_frames:
+                break
+        elapsed = time.time() - tstart
+    finally:
+        clip.reader.close()
+    return source, 1000. * elapsed / max(nframes, 1)
+
+
+def cached_decode_cost(cache_dir, key):
+    """Returns the time per frame, in ms, to get the normalised frames of a
+    clip from the cache, including the copy made when uploading to a
+    texture"""
+    clip = MemmapClip(cache_dir, key)
+    try:
+        tstart = time.time()
+        for iframe in range(clip.nframes):
+            np.ascontiguousarray(clip.get_frame(iframe / float(clip.fps)))
+        elapsed = time.time() - tstart
+        return 1000. * elapsed / max(clip.nframes, 1)
+    finally:
+        clip.close()
+
+
+def _normalise_job(args):
+    fn, cache_dir, key, size, fps, duration = args
+    try:
+        source, cost_before = source_decode_cost(pjoin(PWD, fn))
+        decode_clip(pjoin(PWD, fn), cache_dir, key, size, fps, duration)
+        cost_after = cached_decode_cost(cache_dir, key)
+    except Exception as exc:
+        return fn, None, '{0}: {1}'.format(type(exc).__name__, exc)
+    entry = {
+        'key': key,
+        'size': list(size),
+        'fps': fps,
+        'duration': duration,
+        'nframes': int(round(duration * fps)),
+        'source': source,
+        'changes': clip_changes(source, size, fps, duration),
+        'decode_ms_per_frame': {'before': cost_before, 'after': cost_after},
+    }
+    return fn, entry, None
+
+
+def normalise_stimuli(stim_dir, cache_dir=CACHE_DIR, manifest_fn=MANIFEST_FN,
+                      size=MOVIE_SIZE, fps=CLIP_FPS, duration=STIM_DURATION,
+                      force=False, n_jobs=None):
+    """Normalises all the clips in the stimulus manifest that are not
+    normalised with these settings yet, and records the result in the
+    manifest.
+
+    Arguments
+    ---------
+    stim_dir : str
+        directory containing stimuli
+    cache_dir : str
+        frame cache directory
+    manifest_fn : str or None
+        stimulus manifest; if None, it is built in memory and the results
+        are not recorded
+    size : tuple
+        (width, height) of the normalised clips
+    fps : float
+        frame rate of the normalised clips
+    duration : float
+        duration of the normalised clips, in s
+    force : bool
+        normalise all the clips again
+    n_jobs : int or None
+        number of processes; None uses all cores, 1 runs serially
+
+    Returns
+    -------
+    results : list
+        (clip, status, entry, error) for each clip, where status is one of
+        'unchanged', 'normalised', 'failed', and entry is what is recorded
+        in the manifest
+    """
+    manifest = update_manifest(stim_dir, manifest_fn)
+    stim_dir = manifest['stim_dir']
+    infos = dict()
+    for cat, cat_entry in manifest['categories'].items():
+        for fn, info in cat_entry['files'].items():
+            infos[os.path.relpath(pjoin(stim_dir, cat, fn), start=PWD)] = \
+                info
+    results = []
+    jobs = []
+    for fn in sorted(infos):
+        info = infos[fn]
+        key = cache_key(info['hash'], size)
+        if not force and is_normalised(info, cache_dir, key, size, fps,
+                                       duration):
+            results.append((fn, 'unchanged', info['normalised'], None))
+        else:
+            jobs.append((fn, cache_dir, key, size, fps, duration))
+    if n_jobs == 1 or len(jobs) <= 1:
+        done = map(_normalise_job, jobs)
+    else:
+        pool = multiprocessing.Pool(processes=n_jobs)
+        try:
+            done = pool.map(_normalise_job, jobs)
+        finally:
+            pool.close()
+            pool.join()
+    # the manifest is only written here, not by the workers
+    for fn, entry, error in done:
+        if entry is None:
+            infos[fn].pop('normalised', None)
+            results.append((fn, 'failed', None, error))
+        else:
+            infos[fn]['normalised'] = entry
+            results.append((fn, 'normalised', entry, None))
+    if manifest_fn is not None and done:
+        save_manifest(manifest, manifest_fn)
+    return sorted(results)
+
+
+def main():
+    parsed = parse_args()
+    results = normalise_stimuli(parsed.stimdir, parsed.cache_dir,
+                                parsed.manifest, tuple(parsed.size),
+                                parsed.fps, parsed.duration, parsed.force,
+                                parsed.jobs)
+    print('{0:<50} {1:>10} {2:>10}  {3}'.format(
+        'clip', 'before', 'after', 'changes'))
+    failed = 0
+    for fn, status, entry, error in results:
+        if status == 'failed':
+            failed += 1
+            print("FAILED {0}: {1}".format(fn, error))
+            continue
+        cost = entry['decode_ms_per_frame']
+        print('{0:<50} {1:>7.2f} ms {2:>7.2f} ms  {3}{4}'.format(
+            fn, cost['before'], cost['after'],
+            ', '.join(entry['changes']) or 'none',
+            ' (unchanged)' if status == 'unchanged' else ''))
+    print("{0} clips, {1} unchanged, {2} failed".format(
+        len(results), sum(r[1] == 'unchanged' for r in results), failed))
+    if failed:
+        raise SystemExit(1)
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description=__doc__)
+
+    parser.add_argument('--stimdir', '-d', type=str,
+                        help='directory containing stimuli',
+                        default=pjoin(PWD, 'stimuli'))
+    parser.add_argument('--manifest', type=str,
+                        help='stimulus manifest, refreshed if stale',
+                        default=MANIFEST_FN)
+    parser.add_argument('--cache-dir', '-o', type=str,
+                        help='frame cache directory',
+                        default=CACHE_DIR)
+    parser.add_argument('--size', type=int, nargs=2,
+                        metavar=('WIDTH', 'HEIGHT'),
+                        help='presentation size of the clips',
+                        default=list(MOVIE_SIZE))
+    parser.add_argument('--fps', type=float,
+                        help='frame rate of the normalised clips',
+                        default=CLIP_FPS)
+    parser.add_argument('--duration', type=float,
+                        help='duration of the normalised clips (s)',
+                        default=STIM_DURATION)
+    parser.add_argument('--force', action='store_true',
+                        help='normalise all the clips again')
+    parser.add_argument('--jobs', '-j', type=int,
+                        help='number of processes (default: all cores)')
+    return parser.parse_args()
+
+
+if __name__ == '__main__':
+    main()
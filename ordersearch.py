@@ -0,0 +1,274 @@
+"""Search for category orders balanced for carry-over and position.
+
+Each run presents the categories in some order, then in the reverse order,
+so a run contributes the transitions a -> b and b -> a for every pair of
+adjacent categories in its order. The imbalance of a set of runs is the sum
+of squared deviations from their mean of
+    - the number of transitions between each ordered pair of categories
+      (first-order carry-over)
+    - the number of times each category appears at each position
+(the latter weighted by position_weight); it is zero for a perfectly
+balanced set. For a cohort, the imbalance of the whole cohort is added to
+the imbalance of each subject.
+
+The search starts from rows of a Williams square, randomly relabelled, and
+improves them by simulated annealing, swapping two categories in one run at
+a time and updating the score incrementally. Independent restarts run in a
+process pool, and the best result is kept.
+"""
+import math
+import multiprocessing
+import random
+import time
+import numpy as np
+
+# annealing temperatures at the start and at the end of the search
+T_START = 2.
+T_END = 0.05
+
+
+def williams_square(n):
+    """Returns a Williams design for n categories: n rows (2n if n is odd)
+    in which every category is preceded by every other one equally often"""
+    first = [0]
+    lo, hi = 1, n - 1
+    while len(first) < n:
+        first.append(lo)
+        lo += 1
+        if len(first) < n:
+            first.append(hi)
+            hi -= 1
+    rows = [[(c + k) % n for c in first] for k in range(n)]
+    if n % 2:
+        rows += [row[::-1] for row in rows]
+    return np.array(rows)
+
+
+def initial_orders(ncat, nruns, nsubjects=1, rng=None):
+    """Returns orders (nsubjects, nruns, ncat) taken from consecutive rows
+    of a randomly relabelled Williams square, so that the cohort cycles
+    through the square"""
+    rng = random.Random() if rng is None else rng
+    square = williams_square(ncat)
+    relabel = np.array(rng.sample(range(ncat), ncat))
+    start = rng.randrange(len(square))
+    rows = (start + np.arange(nsubjects * nruns)) % len(square)
+    return relabel[square[rows]].reshape(nsubjects, nruns, ncat)
+
+
+def random_orders(ncat, nruns, nsubjects=1, rng=None):
+    """Returns random orders (nsubjects, nruns, ncat), as create_run
+    would"""
+    rng = np.random if rng is None else rng
+    return rng.rand(nsubjects, nruns, ncat).argsort(axis=2)
+
+
+class _Counts(object):
+    """Transition and position counts of a group of runs, with the sums of
+    their squares, so that the imbalance can be updated incrementally"""
+    def __init__(self, ncat, position_weight):
+        self.ncat = ncat
+        self.position_weight = position_weight
+        self.trans = [[0] * ncat for _ in range(ncat)]
+        self.pos = [[0] * ncat for _ in range(ncat)]
+        self.sq_trans = 0
+        self.sq_pos = 0
+        self.nruns = 0
+
+    def add(self, order, sign=1):
+        """Adds (sign=1) or removes (sign=-1) the run with this order"""
+        trans = self.trans
+        sq = 0
+        for a, b in zip(order[:-1], order[1:]):
+            count = trans[a][b]
+            sq += 2 * sign * count + 1
+            trans[a][b] = count + sign
+            count = trans[b][a]
+            sq += 2 * sign * count + 1
+            trans[b][a] = count + sign
+        self.sq_trans += sq
+        pos = self.pos
+        sq = 0
+        for i, c in enumerate(order):
+            count = pos[c][i]
+            sq += 2 * sign * count + 1
+            pos[c][i] = count + sign
+        self.sq_pos += sq
+        self.nruns += sign
+
+    def imbalance(self):
+        n = self.ncat
+        mean_trans = 2. * self.nruns / n
+        mean_pos = float(self.nruns) / n
+        return (self.sq_trans - n * (n - 1) * mean_trans ** 2 +
+                self.position_weight * (self.sq_pos - n * n * mean_pos ** 2))
+
+
+def _groups(nsubjects, ncat, position_weight):
+    subjects = [_Counts(ncat, position_weight) for _ in range(nsubjects)]
+    cohort = _Counts(ncat, position_weight) if nsubjects > 1 else None
+    return subjects, cohort
+
+
+def imbalance(orders, position_weight=1.):
+    """Returns the imbalance of orders (nsubjects, nruns, ncat), or
+    (nruns, ncat) for a single subject"""
+    orders = np.asarray(orders)
+    if orders.ndim == 2:
+        orders = orders[np.newaxis]
+    nsubjects, _, ncat = orders.shape
+    subjects, cohort = _groups(nsubjects, ncat, position_weight)
+    for counts, runs in zip(subjects, orders.tolist()):
+        for order in runs:
+            counts.add(order)
+            if cohort is not None:
+                cohort.add(order)
+    score = sum(counts.imbalance() for counts in subjects)
+    if cohort is not None:
+        score += cohort.imbalance()
+    return score
+
+
+def anneal(orders, budget=1., max_iter=None, rng=None, position_weight=1.):
+    """Improves orders by simulated annealing.
+
+    Arguments
+    ---------
+    orders : array (nsubjects, nruns, ncat)
+        initial orders
+    budget : float or None
+        time budget in s
+    max_iter : int or None
+        maximum number of iterations; the search stops when either the
+        budget or max_iter is reached (or a perfect balance is found)
+    rng : random.Random or None
+    position_weight : float
+        weight of the position imbalance relative to carry-over
+
+    Returns
+    -------
+    orders : array (nsubjects, nruns, ncat)
+        the best orders found
+    score : float
+        their imbalance
+    """
+    if budget is None and max_iter is None:
+        raise ValueError("Need a time budget or a number of iterations")
+    rng = random.Random() if rng is None else rng
+    orders = np.asarray(orders).tolist()
+    nsubjects, nruns, ncat = len(orders), len(orders[0]), len(orders[0][0])
+    subjects, cohort = _groups(nsubjects, ncat, position_weight)
+    groups = subjects + ([cohort] if cohort is not None else [])
+    for counts, runs in zip(subjects, orders):
+        for order in runs:
+            counts.add(order)
+            if cohort is not None:
+                cohort.add(order)
+
+    def total():
+        return sum(counts.imbalance() for counts in groups)
+
+    score = total()
+    if ncat < 2:
+        # there is nothing to swap, the orders are returned unchanged
+        return np.array(orders), max(score, 0.)
+    best_score = score
+    best = [[list(order) for order in runs] for runs in orders]
+    tstart = time.time()
+    temp = T_START
+    it = 0
+    while best_score > 1e-9:
+        if it % 256 == 0:
+            progress = 0.
+            if budget is not None:
+                progress = (time.time() - tstart) / budget if budget else 1.
+            if max_iter is not None:
+                progress = max(progress, float(it) / max_iter)
+            if progress >= 1.:
+                break
+            temp = T_START * (T_END / T_START) ** progress
+        it += 1
+        isub = rng.randrange(nsubjects)
+        irun = rng.randrange(nruns)
+        i, j = rng.sample(range(ncat), 2)
+        old = orders[isub][irun]
+        new = list(old)
+        new[i], new[j] = new[j], new[i]
+        changed = [subjects[isub]] + ([cohort] if cohort is not None else [])
+        before = sum(counts.imbalance() for counts in changed)
+        for counts in changed:
+            counts.add(old, -1)
+            counts.add(new)
+        delta = sum(counts.imbalance() for counts in changed) - before
+        if delta <= 0 or rng.random() < math.exp(-delta / temp):
+            orders[isub][irun] = new
+            score += delta
+            if score < best_score - 1e-9:
+                best_score = score
+                best = [[list(order) for order in runs] for runs in orders]
+        else:
+            for counts in changed:
+                counts.add(new, -1)
+                counts.add(old)
+    return np.array(best), max(best_score, 0.)
+
+
+def _search_job(args):
+    ncat, nruns, nsubjects, budget, max_iter, seed, position_weight = args
+    rng = random.Random(seed)
+    orders = initial_orders(ncat, nruns, nsubjects, rng)
+    return anneal(orders, budget, max_iter, rng, position_weight)
+
+
+def search_orders(ncat, nruns, nsubjects=1, budget=1., max_iter=None,
+                  seed=0, restarts=None, n_jobs=None, position_weight=1.):
+    """Searches category orders for all the runs of one subject, or of a
+    whole cohort, minimising the carry-over and position imbalance.
+
+    Arguments
+    ---------
+    ncat : int
+        number of categories
+    nruns : int
+        number of runs per subject
+    nsubjects : int
+        number of subjects balanced together
+    budget : float or None
+        time budget of each restart, in s
+    max_iter : int or None
+        maximum number of iterations of each restart; with a time budget
+        the result depends on the speed of the machine, with max_iter alone
+        it is reproducible
+    seed : int
+        seed of the first restart; restart k uses seed + k
+    restarts : int or None
+        number of independent restarts; by default, one per process
+    n_jobs : int or None
+        number of processes; None uses all cores, 1 runs serially
+    position_weight : float
+        weight of the position imbalance relative to carry-over
+
+    Returns
+    -------
+    orders : array (nsubjects, nruns, ncat)
+        category indices (into the sorted categories) for each run
+    score : float
+        imbalance of the orders
+    """
+    if restarts is None:
+        restarts = n_jobs or multiprocessing.cpu_count()
+    jobs = [(ncat, nruns, nsubjects, budget, max_iter, seed + k,
+             position_weight) for k in range(restarts)]
+    if n_jobs == 1 or restarts == 1:
+        results = map(_search_job, jobs)
+    else:
+        pool = multiprocessing.Pool(processes=n_jobs)
+        try:
+            results = pool.map(_search_job, jobs)
+        finally:
+            pool.close()
+            pool.join()
+    # the first of the best, so that the result doesn't depend on timing of
+    # the processes
+    ibest = min(range(len(results)), key=lambda k: results[k][1])
+    return results[ibest]
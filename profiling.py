@@ -0,0 +1,409 @@
+"""Opt-in profiling of schedule generation and of the presentation.
+
+Code is instrumented with named spans,
+
+    with profiling.span('inject'):
+        ...
+
+which are timed only when profiling is enabled, with --profile on the
+command line of make_stim_order.py and run_localizer.py, or by setting the
+environment variable LOCALIZER_PROFILE to 1 (or to 'cprofile' to also run
+cProfile). When disabled, span() returns a shared object that does nothing,
+so that the instrumentation can stay in the presentation loop.
+
+Spans nest: a span opened inside another one is recorded under its path
+(e.g. 'run/trials/trial/flip'), and for each path the report gives the
+number of calls, the total, mean and max time, and the self time, i.e. the
+time not spent in nested spans (for 'run/trials/trial', the overhead of the
+presentation loop itself). Spans of other threads are recorded under their
+own paths; spans of worker processes are not recorded.
+
+At exit, the report of the invocation is saved as json in the profile
+directory (LOCALIZER_PROFILE_DIR, by default profiles/), together with the
+cProfile statistics if enabled, and summarised on stderr. Saved reports can
+be printed again with
+
+    python profiling.py profiles/make_stim_order_20240101T120000_1234.json
+"""
+import argparse
+import atexit
+import datetime
+import json
+import os
+from os.path import join as pjoin
+import socket
+import sys
+import threading
+import time
+
+PWD = os.path.dirname(os.path.abspath(__file__))
+PROFILE_ENV = 'LOCALIZER_PROFILE'
+PROFILE_DIR_ENV = 'LOCALIZER_PROFILE_DIR'
+PROFILE_DIR = pjoin(PWD, 'profiles')
+# number of functions listed in the report from the cProfile statistics
+CPROFILE_TOP = 30
+
+
+class _NullSpan(object):
+    """What span() returns when profiling is disabled"""
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        return False
+
+
+NULL_SPAN = _NullSpan()
+
+
+class _Span(object):
+    __slots__ = ('profiler', 'name', 'path', 'tstart')
+
+    def __init__(self, profiler, name):
+        self.profiler = profiler
+        self.name = name
+
+    def __enter__(self):
+        stack = self.profiler._stack()
+        stack.append(self.name)
+        self.path = '/'.join(stack)
+        self.tstart = self.profiler.clock()
+        return self
+
+    def __exit__(self, *exc_info):
+        duration = self.profiler.clock() - self.tstart
+        self.profiler._stack().pop()
+        self.profiler.record(self.path, duration, self.tstart)
+        return False
+
+
+class Profiler(object):
+    """Collects the time spent in named spans.
+
+    Arguments
+    ---------
+    command : str
+        name of the profiled program, used in the report and its filename
+    enabled : bool
+        whether spans are timed
+    use_cprofile : bool
+        also run cProfile between start() and stop()
+    clock : callable
+        returns the current time in s
+    t0 : float or None
+        start of the invocation, as returned by clock; defaults to now
+    """
+    def __init__(self, command='', enabled=False, use_cprofile=False,
+                 clock=time.time, t0=None):
+        self.command = command
+        self.enabled = enabled
+        self.use_cprofile = use_cprofile
+        self.clock = clock
+        self.t0 = clock() if t0 is None else t0
+        self.started = datetime.datetime.now()
+        # path -> [count, total, max]
+        self.stats = dict()
+        # (path, start, duration) of the top-level spans, in order
+        self.timeline = []
+        self._lock = threading.Lock()
+        self._local = threading.local()
+        self._cprofile = None
+
+    def _stack(self):
+        try:
+            return self._local.stack
+        except AttributeError:
+            self._local.stack = []
+            return self._local.stack
+
+    def span(self, name):
+        """Returns a context manager timing the code it wraps as name"""
+        if not self.enabled:
+            return NULL_SPAN
+        return _Span(self, name)
+
+    def record(self, path, duration, tstart=None):
+        """Records a call of duration s to span path"""
+        with self._lock:
+            stats = self.stats.get(path)
+            if stats is None:
+                self.stats[path] = [1, duration, duration]
+            else:
+                stats[0] += 1
+                stats[1] += duration
+                stats[2] = max(stats[2], duration)
+            if '/' not in path:
+                self.timeline.append(
+                    (path, None if tstart is None else tstart - self.t0,
+                     duration))
+
+    def add(self, path, duration):
+        """Records a span of duration s timed elsewhere (e.g. by a
+        PhaseTimer)"""
+        if self.enabled:
+            self.record(path, duration)
+
+    def start(self):
+        if self.enabled and self.use_cprofile and self._cprofile is None:
+            import cProfile
+            self._cprofile = cProfile.Profile()
+            self._cprofile.enable()
+
+    def stop(self):
+        if self._cprofile is not None:
+            self._cprofile.disable()
+
+    def report(self):
+        """Returns the report of the spans recorded so far.
+
+        Returns
+        -------
+        report : dict
+            command, argv, host, pid, start date and total time of the
+            invocation; for each span path (sorted), its count, total,
+            mean, max and self time; and the top-level spans in order, with
+            their start relative to the start of the invocation
+        """
+        with self._lock:
+            stats = dict((path, list(s)) for path, s in self.stats.items())
+            timeline = list(self.timeline)
+        children = dict()
+        for path, (_, total, _) in stats.items():
+            parent = path.rpartition('/')[0]
+            children[parent] = children.get(parent, 0.) + total
+        spans = []
+        for path in sorted(stats):
+            count, total, longest = stats[path]
+            spans.append({
+                'path': path,
+                'count': count,
+                'total': total,
+                'mean': total / count,
+                'max': longest,
+                'self': total - children.get(path, 0.),
+            })
+        return {
+            'command': self.command,
+            'argv': sys.argv,
+            'host': socket.gethostname(),
+            'pid': os.getpid(),
+            'started': self.started.isoformat(),
+            'total': self.clock() - self.t0,
+            'spans': spans,
+            'timeline': [{'path': path, 'start': start, 'duration': duration}
+                         for path, start, duration in timeline],
+        }
+
+    def save(self, profile_dir=None):
+        """Stops cProfile and saves the report (see report) as json in
+        profile_dir, with the cProfile statistics if enabled.
+
+        Returns
+        -------
+        fn : str
+            filename of the saved report
+        """
+        if profile_dir is None:
+            profile_dir = os.environ.get(PROFILE_DIR_ENV) or PROFILE_DIR
+        if not os.path.exists(profile_dir):
+            os.makedirs(profile_dir)
+        self.stop()
+        report = self.report()
+        fn = pjoin(profile_dir, '{0}_{1}_{2}'.format(
+            self.command or 'profile',
+            self.started.strftime('%Y%m%dT%H%M%S'), os.getpid()))
+        if self._cprofile is not None:
+            report['cprofile'] = {'fn': fn + '.prof',
+                                  'top': cprofile_top(self._cprofile)}
+            self._cprofile.dump_stats(fn + '.prof')
+        fn += '.json'
+        with open(fn, 'wb') as f:
+            json.dump(report, f, indent=True)
+        return fn
+
+
+class PhaseTimer(object):
+    """Records how long each phase of a sequence (e.g. the startup of the
+    presentation) takes.
+
+    Arguments
+    ---------
+    t0 : float or None
+        start of the first phase, as returned by clock; defaults to now
+    clock : callable
+        returns the current time in s
+    """
+    def __init__(self, t0=None, clock=time.time):
+        self.clock = clock
+        self.t0 = clock() if t0 is None else t0
+        self._last = self.t0
+        self.phases = []
+
+    def mark(self, name):
+        """Ends the current phase, naming it name; returns its duration"""
+        now = self.clock()
+        duration = now - self._last
+        self.phases.append((name, duration))
+        self._last = now
+        return duration
+
+    def total(self, exclude=()):
+        return sum(duration for name, duration in self.phases
+                   if name not in exclude)
+
+    def report(self, exclude=()):
+        """Returns a line for each phase and one with the total; phases in
+        exclude (e.g. waiting for the user) are listed but not counted in
+        the total"""
+        width = max([len(name) for name, _ in self.phases] + [5])
+        lines = ['{0:<{1}} {2:8.3f}s{3}'.format(
+            name, width, duration,
+            ' (not counted)' if name in exclude else '')
+            for name, duration in self.phases]
+        lines.append('{0:<{1}} {2:8.3f}s'.format('total', width,
+                                                 self.total(exclude)))
+        return lines
+
+
+def cprofile_top(profile, n=CPROFILE_TOP):
+    """Returns the n functions with the largest cumulative time, as
+    dictionaries with the function, the number of calls, and the total time
+    spent in the function itself and in the functions it calls"""
+    import pstats
+    stats = pstats.Stats(profile).stats
+    top = sorted(stats.items(), key=lambda item: -item[1][3])[:n]
+    return [{'function': '{0}:{1}({2})'.format(*func),
+             'ncalls': ncalls, 'tottime': tottime, 'cumtime': cumtime}
+            for func, (_, ncalls, tottime, cumtime, _) in top]
+
+
+def format_report(report):
+    """Returns the lines of a text summary of a report"""
+    width = max([len(s['path']) for s in report['spans']] + [5])
+    lines = ['{0} (pid {1}), {2:.3f}s'.format(
+        report['command'], report['pid'], report['total'])]
+    lines.append('{0:<{1}} {2:>8} {3:>10} {4:>10} {5:>10} {6:>10}'.format(
+        'span', width, 'count', 'total', 'mean', 'max', 'self'))
+    for s in report['spans']:
+        lines.append('{0:<{1}} {2:>8d} {3:9.4f}s {4:9.4f}s {5:9.4f}s '
+                     '{6:9.4f}s'.format(s['path'], width, s['count'],
+                                        s['total'], s['mean'], s['max'],
+                                        s['self']))
+    top = report.get('cprofile', dict()).get('top', [])[:10]
+    if top:
+        lines.append('{0:>8} {1:>10} {2:>10}  {3}'.format(
+            'ncalls', 'tottime', 'cumtime', 'function'))
+    for func in top:
+        lines.append('{0:>8} {1:9.4f}s {2:9.4f}s  {3}'.format(
+            func['ncalls'], func['tottime'], func['cumtime'],
+            func['function']))
+    return lines
+
+
+# the profiler of this process, disabled until configure() enables it
+PROFILER = Profiler()
+
+
+def env_settings():
+    """Returns (enabled, use_cprofile) as set by the environment variable
+    LOCALIZER_PROFILE"""
+    value = os.environ.get(PROFILE_ENV, '').strip().lower()
+    if value in ('', '0', 'no', 'false', 'off'):
+        return False, False
+    return True, value == 'cprofile'
+
+
+def configure(command, enabled=False, use_cprofile=False, t0=None,
+              profile_dir=None, verbose=True):
+    """Sets up the profiler of this process. Profiling is enabled if
+    requested by the arguments (usually --profile and --cprofile) or by the
+    environment (see env_settings); the report is then saved when the
+    process exits.
+
+    Arguments
+    ---------
+    command : str
+        name of the profiled program
+    enabled : bool
+        time the spans
+    use_cprofile : bool
+        also run cProfile (implies enabled)
+    t0 : float or None
+        start of the invocation, as returned by time.time; defaults to
+        now
+    profile_dir : str or None
+        where to save the report; defaults to LOCALIZER_PROFILE_DIR or
+        profiles/
+    verbose : bool
+        print where the report is saved and its summary to stderr
+
+    Returns
+    -------
+    profiler : Profiler
+    """
+    global PROFILER
+    env_enabled, env_cprofile = env_settings()
+    use_cprofile = use_cprofile or env_cprofile
+    enabled = enabled or env_enabled or use_cprofile
+    PROFILER = Profiler(command, enabled, use_cprofile, t0=t0)
+    if enabled:
+        PROFILER.start()
+        atexit.register(_save_at_exit, PROFILER, profile_dir, verbose)
+    return PROFILER
+
+
+def _save_at_exit(profiler, profile_dir, verbose):
+    fn = profiler.save(profile_dir)
+    if verbose:
+        with open(fn, 'rb') as f:
+            lines = format_report(json.load(f))
+        sys.stderr.write('\n'.join(lines + ['Profile saved to ' + fn, '']))
+
+
+def enabled():
+    return PROFILER.enabled
+
+
+def span(name):
+    """Returns a context manager timing the code it wraps as name, if
+    profiling is enabled (see Profiler.span)"""
+    return PROFILER.span(name)
+
+
+def add(path, duration):
+    """Records a span of duration s timed elsewhere (see Profiler.add)"""
+    PROFILER.add(path, duration)
+
+
+def add_profile_args(parser):
+    """Adds the profiling options to an argparse parser"""
+    parser.add_argument('--profile', action='store_true',
+                        help='time the phases of this invocation and save '
+                             'a report (also enabled by setting {0}=1)'
+                             .format(PROFILE_ENV))
+    parser.add_argument('--cprofile', action='store_true',
+                        help='like --profile, also running cProfile')
+    parser.add_argument('--profile-dir', type=str,
+                        help='where to save the report (default: {0} or '
+                             'profiles/)'.format(PROFILE_DIR_ENV))
+
+
+def configure_from_args(command, parsed, t0=None):
+    """Calls configure with the options added by add_profile_args"""
+    return configure(command, parsed.profile, parsed.cprofile, t0=t0,
+                     profile_dir=parsed.profile_dir)
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description=__doc__,
+        formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('report', type=str, nargs='+',
+                        help='saved profile report(s)')
+    for fn in parser.parse_args().report:
+        with open(fn, 'rb') as f:
+            print('\n'.join(format_report(json.load(f))))
+
+
+if __name__ == '__main__':
+    main()
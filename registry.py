@@ -0,0 +1,161 @@
+"""Registry of the subjects and runs presented on this machine.
+
+The registry is a SQLite database with a row for each run that was started,
+with its status ('started', then 'completed' or 'halted'), and a row for
+each subject with the next run to present, so that the dialog can be filled
+in without going through the history. Each change is a transaction, so the
+registry stays consistent if the presentation crashes. Runs from the old
+subjectlog.tsv can be imported with import_tsv.
+"""
+import csv
+import datetime
+import os
+import sqlite3
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS runs (
+    id INTEGER PRIMARY KEY,
+    subject_id TEXT NOT NULL,
+    run_nr INTEGER NOT NULL,
+    status TEXT NOT NULL,
+    started TEXT NOT NULL,
+    finished TEXT,
+    log_fn TEXT
+);
+CREATE INDEX IF NOT EXISTS runs_subject ON runs (subject_id, run_nr);
+CREATE TABLE IF NOT EXISTS subjects (
+    subject_id TEXT PRIMARY KEY,
+    next_run INTEGER NOT NULL,
+    last_run_id INTEGER
+);
+CREATE TABLE IF NOT EXISTS imports (
+    fn TEXT PRIMARY KEY,
+    imported TEXT NOT NULL,
+    n_runs INTEGER NOT NULL
+);
+"""
+
+
+def _now():
+    return datetime.datetime.now().isoformat()
+
+
+class SessionRegistry(object):
+    """SQLite-backed registry of subjects and runs.
+
+    Arguments
+    ---------
+    fn : str
+        database file; created if it doesn't exist
+    """
+    def __init__(self, fn):
+        self.fn = fn
+        self._conn = sqlite3.connect(fn)
+        self._conn.row_factory = sqlite3.Row
+        with self._conn:
+            self._conn.executescript(SCHEMA)
+
+    def close(self):
+        self._conn.close()
+
+    def start_run(self, subject_id, run_nr, log_fn=None, timestamp=None):
+        """Records that a run started, and returns its id"""
+        with self._conn:
+            cursor = self._conn.execute(
+                "INSERT INTO runs (subject_id, run_nr, status, started, "
+                "log_fn) VALUES (?, ?, 'started', ?, ?)",
+                (subject_id, int(run_nr), timestamp or _now(), log_fn))
+            run_id = cursor.lastrowid
+            self._update_subject(subject_id, int(run_nr), run_id)
+        return run_id
+
+    def finish_run(self, run_id, status='completed'):
+        """Records that a run completed or was halted. A completed run
+        moves the subject on to the following run; after a halted run, the
+        same run is presented again."""
+        if status not in ('completed', 'halted'):
+            raise ValueError("Unknown status {0}".format(status))
+        with self._conn:
+            self._conn.execute(
+                "UPDATE runs SET status = ?, finished = ? WHERE id = ?",
+                (status, _now(), run_id))
+            row = self._conn.execute(
+                "SELECT subject_id, run_nr FROM runs WHERE id = ?",
+                (run_id,)).fetchone()
+            if row is None:
+                raise ValueError("Unknown run {0}".format(run_id))
+            if status == 'completed':
+                self._update_subject(row['subject_id'], row['run_nr'] + 1,
+                                     run_id)
+
+    def _update_subject(self, subject_id, next_run, run_id):
+        self._conn.execute(
+            "INSERT OR REPLACE INTO subjects (subject_id, next_run, "
+            "last_run_id) VALUES (?, ?, ?)", (subject_id, next_run, run_id))
+
+    def last_session(self):
+        """Returns the last run started, as a dictionary with keys
+        subject_id, run_nr, status, started, finished and log_fn (None if
+        no run was started)"""
+        row = self._conn.execute(
+            "SELECT * FROM runs ORDER BY id DESC LIMIT 1").fetchone()
+        return dict(row) if row is not None else None
+
+    def next_run(self, subject_id, nruns=None):
+        """Returns the run to present next to subject_id (1 for a new
+        subject); if the number of runs nruns is given, returns None once
+        all of them were completed"""
+        row = self._conn.execute(
+            "SELECT next_run FROM subjects WHERE subject_id = ?",
+            (subject_id,)).fetchone()
+        run_nr = row['next_run'] if row is not None else 1
+        if nruns is not None and run_nr > nruns:
+            return None
+        return run_nr
+
+    def runs(self, subject_id, status=None):
+        """Returns the runs of subject_id, oldest first, optionally only
+        those with the given status"""
+        query = "SELECT * FROM runs WHERE subject_id = ?"
+        args = (subject_id,)
+        if status is not None:
+            query += " AND status = ?"
+            args += (status,)
+        return [dict(row) for row in
+                self._conn.execute(query + " ORDER BY id", args)]
+
+    def import_tsv(self, fn):
+        """Imports the runs of a subjectlog.tsv (subject_id, run_nr and
+        timestamp for each run started) in a single transaction, as runs
+        with status 'imported' that move their subject on to the following
+        run. A file is only imported once.
+
+        Returns
+        -------
+        n_runs : int
+            number of runs imported
+        """
+        fn = os.path.abspath(fn)
+        with self._conn:
+            if self._conn.execute("SELECT 1 FROM imports WHERE fn = ?",
+                                  (fn,)).fetchone() is not None:
+                return 0
+            n_runs = 0
+            with open(fn, 'rb') as f:
+                for row in csv.DictReader(f, delimiter='\t'):
+                    try:
+                        run_nr = int(row['run_nr'])
+                    except (TypeError, ValueError):
+                        continue
+                    cursor = self._conn.execute(
+                        "INSERT INTO runs (subject_id, run_nr, status, "
+                        "started) VALUES (?, ?, 'imported', ?)",
+                        (row['subject_id'], run_nr,
+                         row.get('timestamp') or ''))
+                    self._update_subject(row['subject_id'], run_nr + 1,
+                                         cursor.lastrowid)
+                    n_runs += 1
+            self._conn.execute(
+                "INSERT INTO imports (fn, imported, n_runs) VALUES (?, ?, ?)",
+                (fn, _now(), n_runs))
+        return n_runs
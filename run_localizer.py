@@ -5,32 +5,76 @@ the paradigm in Pitcher, D., Dilks, D. D., Saxe, R. R., Triantafyllou, C.,
 & Kanwisher, N. (2011). Differential selectivity for dynamic versus static
 information in face-selective cortical regions. Neuroimage, 56(4), 2356-2363.
 """
+import time as ptime
+# start of the startup report
+T_START = ptime.time()
 import argparse
 import sys
-from psychopy import visual, gui, event, logging
-from psychopy import sound, core
-import time as ptime
-import serial
 import os
 from os.path import join as pjoin, exists as pexists, abspath, dirname
 import json
-import csv
-import datetime
 import shutil
-import subprocess as sp
+import threading
+from cliploader import ClipLoader, ClipPool, POOL_MB, POOL_MAX_CLIPS
+import profiling
+from profiling import span, PhaseTimer
+from serialreader import SerialReader
+from bidsevents import EventWriter, events_name, sidecar_fn
+from registry import SessionRegistry
+
+# psychopy and the movie modules are slow to import, and need a display, so
+# they are only imported by load_psychopy and load_movie_modules, when we
+# know we are going to present something; likewise, the modules creating the
+# schedule and timing the presentation (which need numpy) are only imported
+# by the functions using them
+visual = gui = event = logging = core = None
+open_clip = clip_nbytes = PreparedMovieStim = None
+# how the presentation loop sleeps, in the time of core.getTime; replaced,
+# like the modules above, by the simulator (see simulate.py)
+sleep = ptime.sleep
+# how often the keyboard is pumped while waiting (see KeyboardSerial)
+PUMP_INTERVAL = 0.005
+# waits at least this long are used to create the stimulus of a clip loaded
+# in the background (see ClipLoader.poll)
+FINALIZE_MARGIN = 0.01
+# duration of each phase of the startup, reported when the first intro
+# screen is shown
+STARTUP = PhaseTimer(T_START)
 
 PWD = os.path.dirname(os.path.abspath(__file__))
 # add a new level name called bids
 # we will use this level to log information that will be saved
 # in the _events.tsv file for this run
 BIDS = 26
-logging.addLevel(BIDS, 'BIDS')
 
 
-def move_halted_log(fn):
+def load_psychopy():
+    """Imports psychopy and sets up logging"""
+    global visual, gui, event, logging, core
+    if core is not None:
+        return
+    from psychopy import visual, gui, event, logging, core
+    logging.addLevel(BIDS, 'BIDS')
+    logging.console.setLevel(logging.INFO)  # receive nearly all messages
+
+
+def load_movie_modules():
+    global open_clip, clip_nbytes, PreparedMovieStim
+    from moviestim import open_clip, clip_nbytes, PreparedMovieStim
+
+
+def move_halted_log(fn, events=None, registry=None, run_id=None):
     # flush log
     logging.flush()
+    if registry is not None:
+        registry.finish_run(run_id, 'halted')
     shutil.move(fn, fn.replace('.txt', '__halted.txt'))
+    # the events written so far are kept too, out of the BIDS names, so that
+    # the run can be presented again
+    if events is not None:
+        events.close()
+        for fn_ in (events.fn, sidecar_fn(events.fn)):
+            shutil.move(fn_, fn_.replace('_events.', '__halted_events.'))
     # quit
     core.quit()
 
@@ -42,105 +86,274 @@ def logbids(msg, t=None, obj=None):
     logging.root.log(msg, level=BIDS, t=t, obj=obj)
 
 
-logging.console.setLevel(logging.INFO)  # receive nearly all messages
-time_template = '%Y%m%dT%H%M%S'
+# duration will be filled later
+template_bids = '{onset:.3f}\t{duration:.3f}\t{stim_type}\t{stim_fn}\t' \
+                '{repetition}'
 
 
-def write_subjectlog(fn, info):
-    fieldnames = ['subject_id', 'run_nr', 'timestamp']
-    info_save = {key: info.get(key, '') for key in fieldnames}
-    with open(fn, 'ab') as f:
-        writer = csv.DictWriter(f, fieldnames=fieldnames, delimiter='\t')
-        info_save['timestamp'] = datetime.datetime.now().isoformat()
-        writer.writerow(info_save)
+def log_event(events, onset, duration, stim_type, stim_fn=None,
+              repetition=0):
+    """Logs an event both in the log and in the _events.tsv file"""
+    logbids(template_bids.format(
+        onset=onset,
+        duration=duration,
+        stim_type=stim_type,
+        stim_fn=stim_fn,
+        repetition=repetition)
+    )
+    events.add(onset, duration, stim_type, stim_fn, repetition)
 
 
-def load_subjectlog(fn):
-    lastinfo = {
-        'subject_id': 'sidXXXXXX',
-        'run_nr': 1
-    }
-    if not pexists(fn):
-        with open(fn, 'wb') as f:
-            writer = csv.DictWriter(f,
-                                    fieldnames=['subject_id',
-                                                'run_nr',
-                                                'timestamp'],
-                                    delimiter='\t')
-            writer.writeheader()
-    else:
-        with open(fn, 'rb') as f:
-            reader = csv.DictReader(f, delimiter='\t')
-            rows = [r for r in reader]
-            lastinfo = rows[-1]
-    return lastinfo
+def log_button_presses(reader, t_trigger, events):
+    """Logs the button presses received by the serial reader since the
+    first trigger, timestamped from the trigger"""
+    for t, key in reader.drain():
+        if key in ['1', '2'] and t >= t_trigger:
+            log_event(events, t - t_trigger, 0., 'button_press')
+
+
+time_template = '%Y%m%dT%H%M%S'
+
 
 # set up some dirs
 HERE = abspath(dirname(__file__))
 STIMDIR = pjoin(HERE, "stimuli")
 RESDIR = pjoin(HERE, "res")
-if not pexists(RESDIR):
-    os.makedirs(RESDIR)
-
-# load config
+CFGDIR = pjoin(HERE, "cfg")
+FRAMECACHE = pjoin(HERE, "cache", "frames")
 CONFIG_FN = pjoin(HERE, 'config.json')
-with open(CONFIG_FN, 'rb') as f:
-    config = json.load(f)
+_config = None
 
-instructions = config['instructions']
-subjectlog = pjoin(RESDIR, config['log_subjects'])
-lastinfo = load_subjectlog(subjectlog)
 
+def get_config():
+    """Returns the config, loading it the first time"""
+    global _config
+    if _config is None:
+        with open(CONFIG_FN, 'rb') as f:
+            _config = json.load(f)
+    return _config
 
-def main(info):
-    # save log of subjects
-    write_subjectlog(subjectlog, info)
+
+def open_registry():
+    """Opens the session registry, importing the old subject log the first
+    time"""
+    if not pexists(RESDIR):
+        os.makedirs(RESDIR)
+    config = get_config()
+    registry = SessionRegistry(pjoin(RESDIR, config.get(
+        'registry', 'sessions.sqlite')))
+    subjectlog = pjoin(RESDIR, config['log_subjects'])
+    if pexists(subjectlog):
+        registry.import_tsv(subjectlog)
+    return registry
+
+
+def load_schedule(subj, nruns, manifest):
+    """Loads the stimulus order of all runs for this participant, creating
+    it if it doesn't exist. A stimulus order in the binary format is
+    preferred, and only the runs presented are read from it."""
+    import make_stim_order as msorder
+    from schedulefile import ScheduleFile
+    stim_bin = pjoin(CFGDIR, msorder.out_fn(subj, nruns, binary=True))
+    if pexists(stim_bin):
+        return ScheduleFile(stim_bin)
+    stim_json = pjoin(CFGDIR, msorder.out_fn(subj, nruns))
+    if pexists(stim_json):
+        return msorder.load_schedule(stim_json)
+    # create stimulus order if not existing
+    logging.warning("Creating stimulus order for {0}".format(subj))
+    return msorder.make_schedule(subj, nruns, manifest,
+                                 out_dir=CFGDIR)
+
+
+def prepare_subject(subj, nruns):
+    """Returns the stimulus order for this participant and the content
+    hash of each stimulus"""
+    from manifest import MANIFEST_FN, update_manifest, manifest_hashes
+    with span('stimuli'):
+        manifest = update_manifest(STIMDIR, MANIFEST_FN)
+    return load_schedule(subj, nruns, manifest), manifest_hashes(manifest)
+
+
+def in_background(func, *args):
+    """Calls func(*args) in a thread, and returns a function that waits for
+    the result (re-raising the exceptions of func)"""
+    result = dict()
+
+    def target():
+        try:
+            result['value'] = func(*args)
+        except Exception:
+            result['error'] = sys.exc_info()
+    thread = threading.Thread(target=target, name=func.__name__)
+    thread.daemon = True
+    thread.start()
+
+    def wait():
+        thread.join()
+        if 'error' in result:
+            raise result['error'][0], result['error'][1], result['error'][2]
+        return result['value']
+    return wait
+
+
+def open_window(fullscr):
+    print "Opening screen"
+    # Setting up visual
+    size = [1280, 1024]
+    scrwin = visual.Window(size=size,
+                           allowGUI=False, units='pix',
+                           screen=1, rgb=[-1, -1, -1],
+                           fullscr=fullscr)
+    return scrwin
+
+
+def open_serial(port='/dev/ttyUSB0'):
+    """Opens the serial port of the scanner"""
+    import serial
+    ser = serial.Serial(port, 115200, timeout=.05)
+    ser.flushInput()
+    return ser
+
+
+class KeyboardSerial(object):
+    """Emulates the serial port with the keyboard. psychopy timestamps key
+    presses when its events are pumped, which happens in the main thread, so
+    the presentation loop pumps the port (see SerialReader.pump) every
+    PUMP_INTERVAL while it waits; the presses are returned with these
+    timestamps, on the clock of core.getTime. There is nothing to read, so
+    SerialReader starts no thread for it."""
+    keys = ['1', '2', '5']
+
+    def __init__(self):
+        self.clock = core.Clock()
+        self.clock.reset(-core.getTime())
+
+    def pump(self):
+        return [(t, key) for key, t in
+                event.getKeys(self.keys, timeStamped=self.clock)]
+
+    def close(self):
+        pass
+
+
+def open_keyboard(scrwin, clock):
+    """Waits for Enter, then starts the scanner emulator, which sends the
+    triggers as '5' key presses.
+
+    Returns
+    -------
+    port : KeyboardSerial
+    t_trigger : float
+        time of the first trigger, as returned by core.getTime
+    """
+    from psychopy.hardware.emulator import launchScan
+    with span('trigger'):
+        event.waitKeys(keyList=['return'])
+    # XXX: set up TR here
+    MR_settings = {
+        'TR': 1,
+        'volumes': 280,
+        'sync': '5',
+        'skip': 3,
+        'sound': False,
+    }
+    launchScan(scrwin, MR_settings, globalClock=clock, mode='Test')
+    return KeyboardSerial(), core.getTime()
+
+
+def get_frame_interval(scrwin):
+    """Measures the frame interval of the window, falling back to the one
+    reported by the monitor if the measurement is unstable"""
+    rate = scrwin.getActualFrameRate()
+    if rate is None:
+        logging.warning("Could not measure the frame rate, using "
+                        "{0:.2f}Hz".format(1. / scrwin.monitorFramePeriod))
+        return scrwin.monitorFramePeriod
+    return 1. / rate
+
+
+def run(scrwin, info, stimuli, stim_hashes, pool, frame_interval, registry,
+        startup=None, config=None, res_dir=None):
+    """Presents a single run.
+
+    Arguments
+    ---------
+    scrwin : visual.Window
+        window to present the run in; it is left open
+    info : dict
+        participant's information, with the run number in 'run_nr'
+    stimuli : list
+        trials of this run, as stored in the schedule json
+    stim_hashes : dict
+        content hash of each stimulus (see manifest.manifest_hashes)
+    pool : ClipPool
+        pool of clips, shared across runs; clips in the pool are not loaded
+        again
+    frame_interval : float
+        duration of a frame in s, used to predict when flips land
+    registry : SessionRegistry
+        where the run is recorded as started, then completed or halted
+    startup : PhaseTimer or None
+        if given, the loading and the intro screen are timed, and the
+        startup report is logged
+    config : dict or None
+        configuration; defaults to config.json
+    res_dir : str or None
+        results directory; defaults to RESDIR
+
+    Returns
+    -------
+    metrics : dict
+        timing metrics of the run, as logged at its end
+    """
+    from timing import planned_onsets, Timeline, WaitStats, wait_until, \
+        FrameLog
+    config = get_config() if config is None else config
     run_nr = int(info['run_nr'])
     subj = info['subject_id']
-    fullscr = info['fullscr']
     time = core.Clock()
-    subj_dir = pjoin(RESDIR, 'sub-' + subj)
+    subj_dir = pjoin(RESDIR if res_dir is None else res_dir, 'sub-' + subj)
     if not pexists(subj_dir):
         os.makedirs(subj_dir)
+    timestamp = ptime.strftime(time_template)
     log_fn = config['log_template'].format(
         subj=subj,
         task_name=config['task_name'],
         runnr=run_nr,
-        timestamp=ptime.strftime(time_template),
+        timestamp=timestamp,
     )
     log_fn = pjoin(subj_dir, log_fn)
+    # save log of subjects
+    run_id = registry.start_run(subj, run_nr, log_fn=log_fn)
     log_responses = logging.LogFile(log_fn, level=logging.INFO)
+    # events are also written directly to a BIDS _events.tsv file, in the
+    # background; if the run was already presented, the file of this
+    # presentation is told apart by its acq entity
+    events_fn = pjoin(subj_dir, events_name(subj, run_nr,
+                                            config['task_name']))
+    if pexists(events_fn):
+        events_fn = pjoin(subj_dir, events_name(
+            subj, run_nr, config['task_name'], acq=timestamp))
+    events = EventWriter(events_fn)
+    events.start()
     # set up global key for quitting; if that happens, log will be moved to
     # {log_fn}__halted.txt
+    if 'quit experiment gracefully' in \
+            [k.name for k in event.globalKeys.values()]:
+        event.globalKeys.remove(key='q', modifiers=['ctrl'])
     event.globalKeys.add(key='q',
                          modifiers=['ctrl'],
                          func=move_halted_log,
-                         func_args=[log_fn],
+                         func_args=[log_fn, events, registry, run_id],
                          name='quit experiment gracefully')
-    # --- LOAD STIMULI ORDER FOR THIS PARTICIPANT ---
-    stim_json = pjoin(PWD, 'cfg',
-                      'sub-{0}_task-localizer_4runs.json'.format(subj))
-    # create stimulus order if not existing
-    if not os.path.exists(stim_json):
-        logging.warning("Creating stimulus order for {0}".format(subj))
-        MAKESTIMPY = pjoin(HERE, 'make_stim_order.py')
-        cmd = "python {cmd} --subid {subj} --output {output} " \
-              "--nruns 4".format(cmd=MAKESTIMPY, subj=subj,
-                                 output=dirname(stim_json))
-        logging.warning("Running '{0}'".format(cmd))
-        sp.check_call(cmd.split())
-    with open(stim_json, 'rb') as f:
-        stimuli = json.load(f)[str(run_nr)]
-    # ------------------------
-    print "Opening screen"
-    tbegin = time.getTime()
+    # check against the stimulus manifest that all clips are available,
+    # before we start opening and decoding them
+    for stim in stimuli:
+        if stim['stim_fn'] is not None and stim['stim_fn'] not in stim_hashes:
+            logging.warning("{0} is not in the stimulus manifest".format(
+                stim['stim_fn']))
     using_scanner = info['scanner?']
-    # Setting up visual
-    size = [1280, 1024]
-    scrwin = visual.Window(size=size,
-                           allowGUI=False, units='pix',
-                           screen=1, rgb=[-1, -1, -1],
-                           fullscr=fullscr)
     # load clips
     print "Loading stimuli"
     loading = visual.TextStim(scrwin,
@@ -148,104 +361,251 @@ def main(info):
                               height=31)
     loading.draw()
     scrwin.flip()
-    stimuli_clip = dict()
-    for stim in stimuli:
-        if stim['stim_type'] != 'fixation':
-            stim_fn = stim['stim_fn']
-            print("Loading {0}".format(stim_fn))
-            stimuli_clip[stim_fn] = \
-                visual.MovieStim3(scrwin, pjoin(PWD, stim_fn),
-                                  size=(1280, 940),
-                                  name=stim_fn,
-                                  noAudio=True, loop=True)
+    # only the first block is loaded now; the others are loaded in the
+    # background during the run. Clips in the pool (e.g., presented in a
+    # previous run of this session) are not loaded again
+    loader = ClipLoader(
+        stimuli,
+        prepare=lambda stim_fn: open_clip(
+            pjoin(PWD, stim_fn),
+            content_hash=stim_hashes.get(stim_fn),
+            cache_dir=FRAMECACHE),
+        finalize=lambda stim_fn, clip: PreparedMovieStim(
+            scrwin, pjoin(PWD, stim_fn), clip,
+            size=(1280, 940),
+            name=stim_fn,
+            noAudio=True, loop=True),
+        release=lambda movie: movie.detach(),
+        lookahead=config.get('lookahead_blocks', 1),
+        pool=pool,
+        clock=core.getTime)
+    with span('load clips'):
+        loader.preload()
     scrwin.flip()
+    if startup is not None:
+        startup.mark('loading clips')
     cross_hair = visual.TextStim(scrwin, text='+', height=31,
                                  pos=(0, 0), color='#FFFFFF')
     if using_scanner:
         intro_msg = "Waiting for trigger..."
     else:
         intro_msg = "Press Enter to start"
-    intro_msg = instructions + '\n' + intro_msg
+    intro_msg = config['instructions'] + '\n' + intro_msg
     intro = visual.TextStim(scrwin, text=intro_msg, height=31, wrapWidth=900)
     # Start of experiment
     intro.draw()
     scrwin.flip()
-    # open up serial port and wait for first trigger
+    if startup is not None:
+        startup.mark('intro')
+        for line in startup.report(exclude=['dialog']):
+            logging.exp("Startup: " + line)
+        for name, duration in startup.phases:
+            profiling.add('startup/' + name, duration)
+    # open up serial port and wait for first trigger; the port is read in a
+    # background thread, which timestamps each byte as it arrives
     if using_scanner:
-        ser_port = '/dev/ttyUSB0'
-        ser = serial.Serial(ser_port, 115200, timeout=.0001)
-        ser.flushInput()
-        trigger = ''
-        while trigger != '5':
-            trigger = ser.read()
+        ser = open_serial()
+        reader = SerialReader(ser, clock=core.getTime)
+        reader.start()
+        with span('trigger'):
+            t_trigger = reader.wait_for_trigger()
     else:
-        from psychopy.hardware.emulator import launchScan
-        event.waitKeys(keyList=['return'])
-        # XXX: set up TR here
-        MR_settings = {
-            'TR': 1,
-            'volumes': 280,
-            'sync': '5',
-            'skip': 3,
-            'sound': False,
-        }
-        vol = launchScan(scrwin, MR_settings, globalClock=time, mode='Test')
-
-        class FakeSerial(object):
-            @staticmethod
-            def read():
-                k = event.getKeys(['1', '2', '5'])
-                return k[-1] if k else ''
-
-        ser = FakeSerial()
+        ser, t_trigger = open_keyboard(scrwin, time)
+        reader = SerialReader(ser, clock=core.getTime)
+        reader.start()
 
     # set up timer for experiment starting from first trigger
     timer_exp = core.Clock()
-    trunbegin = timer_exp.getTime()
+    timer_exp.reset(t_trigger - core.getTime())
     # setup bids log
-    logbids("onset\tduration\tstim_type\trepetition")
-    # duration will be filled later
-    template_bids = '{onset:.3f}\t{duration:.3f}\t{stim_type}\t{stim_fn}\t' \
-                    '{repetition}'
-    # and now we just loop through the trials
-    for trial in stimuli:
-        stim_type = trial['stim_type']
-        stim_fn = trial['stim_fn']
-        duration = trial['duration']
-        logbids(template_bids.format(
-            onset=timer_exp.getTime(),
-            duration=duration,
-            stim_type=stim_type,
-            stim_fn=stim_fn,
-            repetition=trial.get('repetition', 0)),
-        )
-        trial_counter = core.CountdownTimer(duration)
-        if stim_type == 'fixation':
-            cross_hair.draw()
+    logbids("onset\tduration\tstim_type\tstim_fn\trepetition")
+    loader.start()
+    # onsets are planned against the trigger clock in advance, and each
+    # trial is presented on the frame nearest to its planned onset, so that
+    # lateness doesn't accumulate across trials
+    timeline = Timeline(planned_onsets(stimuli), frame_interval)
+    # waits sleep instead of spinning; we keep track of how late we wake up
+    # and of how much CPU we use
+    waits = WaitStats()
+    # optionally, every flip is recorded (see timing.FrameLog)
+    frame_log = FrameLog() if config.get('frame_log', False) else None
+
+    def flip(itrial, movie=None):
+        """Flips the window, and returns when the flip landed"""
+        if frame_log is not None:
+            t_target = timeline.next_flip(timer_exp.getTime())
+        with span('flip'):
             scrwin.flip()
-            logging.flush()
-            while trial_counter.getTime() > 0:
-                pass
-        else:
-            movie = stimuli_clip[stim_fn]
-            while trial_counter.getTime() > 0:
-                key = ser.read()
-                if key in ['1', '2']:
-                    logbids(template_bids.format(
-                        onset=timer_exp.getTime(),
-                        duration=0.,
-                        stim_type='button_press',
-                        stim_fn=None,
-                        repetition=0)
-                    )
-                if movie.status != visual.FINISHED:
-                    movie.draw()
-                    scrwin.flip()
-                else:
+        t_flip = timer_exp.getTime()
+        if frame_log is not None:
+            frame_log.record(
+                t_flip, t_target, itrial,
+                movie.current_frame() if movie is not None else -1)
+        return t_flip
+
+    def wait(t):
+        """Waits until t on the trigger clock, pumping the port every
+        PUMP_INTERVAL if it needs it (the keyboard), so that presses are
+        timestamped when they happen. If there is time, the stimulus of a
+        clip loaded in the background is created first, so that it isn't
+        created at its onset."""
+        with span('wait'):
+            if t - timer_exp.getTime() > FINALIZE_MARGIN:
+                with span('finalize'):
+                    loader.poll(limit=1)
+            if not reader.needs_pump:
+                wait_until(timer_exp.getTime, t, stats=waits, sleep=sleep)
+                return
+            now = timer_exp.getTime()
+            while now < t:
+                now = wait_until(timer_exp.getTime,
+                                 min(t, now + PUMP_INTERVAL), stats=waits,
+                                 sleep=sleep)
+                reader.pump()
+
+    def poll_responses():
+        """Logs the button presses received so far"""
+        with span('responses'):
+            log_button_presses(reader, t_trigger, events)
+    waits.start()
+    # and now we just loop through the trials; when profiling, the self time
+    # of the 'trial' span is the overhead of the loop itself
+    with span('trials'):
+        for itrial, trial in enumerate(stimuli):
+            with span('trial'):
+                loader.set_trial(itrial)
+                stim_type = trial['stim_type']
+                stim_fn = trial['stim_fn']
+                duration = trial['duration']
+                if stim_type == 'fixation':
+                    wait(timeline.ready_time(itrial))
                     cross_hair.draw()
-                    scrwin.flip()
-    logging.exp("Done in {0:.2f}s".format(timer_exp.getTime()))
+                    timeline.record_onset(itrial, flip(itrial))
+                else:
+                    with span('get clip'):
+                        movie = loader.get(itrial, stim_fn)
+                    with span('draw'):
+                        movie.draw()
+                    timeline.record_onset(itrial, flip(itrial, movie))
+                log_event(events, timeline.actual[itrial], duration,
+                          stim_type, stim_fn, trial.get('repetition', 0))
+                if stim_type == 'fixation':
+                    poll_responses()
+                    loader.poll()
+                    wait(timeline.ready_time(itrial + 1))
+                    continue
+                while not timeline.due(itrial + 1, timer_exp.getTime()):
+                    poll_responses()
+                    if movie.status == visual.FINISHED:
+                        cross_hair.draw()
+                        timeline.flipped(flip(itrial))
+                        continue
+                    to_next_frame = movie.time_to_next_frame()
+                    if to_next_frame > 0:
+                        # nothing new to show: rather than flipping the
+                        # same frame, sleep until the next movie frame (or
+                        # the next trial); button presses are timestamped
+                        # by the serial reader in the meantime
+                        wait(min(timer_exp.getTime() + to_next_frame,
+                                 timeline.ready_time(itrial + 1)))
+                        continue
+                    with span('draw'):
+                        movie.draw()
+                    timeline.flipped(flip(itrial, movie))
+    waits.stop()
+    log_button_presses(reader, t_trigger, events)
+    reader.stop()
+    ser.close()
+    events.close()
+    metrics = {
+        'duration': timer_exp.getTime(),
+        'n_triggers': reader.n_triggers,
+        'onsets': timeline.summary(),
+        'waits': waits.summary(),
+    }
+    logging.exp("Done in {0:.2f}s".format(metrics['duration']))
+    logging.exp("Received {0} triggers".format(reader.n_triggers))
+    for itrial, (planned, actual) in enumerate(zip(timeline.onsets,
+                                                   timeline.actual)):
+        logging.exp("Onset of trial {0}: planned {1:.3f}s, actual {2:.3f}s, "
+                    "error {3:+.1f}ms".format(itrial, planned, actual,
+                                              (actual - planned) * 1000))
+    logging.exp("Onset error: mean {mean_error:+.4f}s, "
+                "max {max_abs_error:.4f}s, "
+                "final {final_error:+.4f}s".format(**metrics['onsets']))
+    logging.exp("CPU utilisation {cpu_utilisation:.1%}; wake-up latency over "
+                "{n_waits} waits: mean {mean_latency:.5f}s, "
+                "99th percentile {p99_latency:.5f}s, "
+                "max {max_latency:.5f}s".format(**metrics['waits']))
+    if frame_log is not None:
+        frame_log.save(log_fn.replace('.txt', '_frames.npz'), frame_interval)
+        frames = metrics['frames'] = frame_log.summary(frame_interval)
+        logging.exp("{n_flips} flips, {dropped} dropped frames; inter-flip "
+                    "intervals of 1, 2, ... frames: {ifi_hist}".format(
+                        **frames))
+        for itrial in sorted(frames['fps']):
+            logging.exp("Trial {0}: {1:.2f} movie frames/s".format(
+                itrial, frames['fps'][itrial]))
+    loader.stop()
+    for itrial, stim_fn, waited in loader.late:
+        logging.warning("Clip {0} of trial {1} was not ready at its onset "
+                        "(delayed it by {2:.3f}s)".format(stim_fn, itrial,
+                                                         waited))
+    metrics['late_clips'] = loader.late
+    metrics['pool'] = pool.stats()
+    logging.exp("Clip pool: {hits} hits, {misses} misses, {evictions} "
+                "evictions, {clips} clips ({nbytes} bytes) in the "
+                "pool".format(**metrics['pool']))
     logging.flush()
+    logging.root.removeTarget(log_responses)
+    registry.finish_run(run_id)
+    metrics['log_fn'] = log_fn
+    metrics['events_fn'] = events.fn
+    return metrics
+
+
+def main(info):
+    """Presents run info['run_nr'] or, if info['session?'] is set, all the
+    runs from info['run_nr'] to the last one in the same window"""
+    config = get_config()
+    load_psychopy()
+    subj = info['subject_id']
+    first_run = int(info['run_nr'])
+    nruns = config.get('nruns', 4)
+    if not 1 <= first_run <= nruns:
+        raise SystemExit("Run {0} doesn't exist: there are {1} runs".format(
+            first_run, nruns))
+    # --- LOAD STIMULI ORDER FOR THIS PARTICIPANT ---
+    # (while the window is opening)
+    prepared = in_background(prepare_subject, subj, nruns)
+    # ------------------------
+    load_movie_modules()
+    STARTUP.mark('movie modules')
+    scrwin = open_window(info['fullscr'])
+    STARTUP.mark('window')
+    frame_interval = get_frame_interval(scrwin)
+    STARTUP.mark('frame interval')
+    experiment, stim_hashes = prepared()
+    STARTUP.mark('schedule')
+    if info.get('session?'):
+        run_nrs = range(first_run, len(experiment) + 1)
+    else:
+        run_nrs = [first_run]
+    # clips that were presented are kept in a pool, within a memory budget
+    # and a number of clips (i.e., of open readers), so that they don't need
+    # to be loaded again if presented again
+    pool = ClipPool(config.get('clip_pool_mb', POOL_MB) * 2 ** 20,
+                    size_of=clip_nbytes,
+                    evict=lambda clip: clip.close(),
+                    max_clips=config.get('clip_pool_max', POOL_MAX_CLIPS))
+    registry = open_registry()
+    for irun, run_nr in enumerate(run_nrs):
+        run_info = dict(info, run_nr=run_nr)
+        with span('run'):
+            run(scrwin, run_info, experiment.run(run_nr), stim_hashes,
+                pool, frame_interval, registry,
+                startup=STARTUP if irun == 0 else None)
+    registry.close()
     scrwin.close()
     core.quit()
 
@@ -255,40 +615,74 @@ def parse_args():
 
     parser.add_argument('--subject', '-s', type=str,
                         help='subject id')
+    nruns = get_config().get('nruns', 4)
     parser.add_argument('--runnr', '-r', type=int,
-                        help='run nr',
-                        choices=range(1, 5))
+                        help='run nr (default: the next run of the '
+                             'subject in the registry)',
+                        choices=range(1, nruns + 1))
     parser.add_argument('--no-scanner', action='store_false',
                         help='do not listen to the serial port')
     parser.add_argument('--no-fullscreen', action='store_false',
                         help='do not run in fullscreen')
+    parser.add_argument('--session', action='store_true',
+                        help='present all the runs from --runnr to the last '
+                             'one, keeping the window and the clips loaded')
+    profiling.add_profile_args(parser)
     return parser.parse_args()
 
 
 if __name__ == '__main__':
     parsed = parse_args()
+    profiling.configure_from_args('run_localizer', parsed, t0=T_START)
+    STARTUP.mark('arguments')
+    load_psychopy()
+    STARTUP.mark('psychopy')
     # ask info to experimenter if no args passed
 
     if parsed.subject is None:
+        # fill in the last subject, and the run that comes next for them
+        registry = open_registry()
+        last = registry.last_session()
+        subject_id = last['subject_id'] if last is not None else 'sidXXXXXX'
+        nruns = get_config().get('nruns', 4)
+        run_nr = registry.next_run(subject_id, nruns)
+        if run_nr is None:
+            print("All {0} runs of {1} were completed".format(nruns,
+                                                              subject_id))
+            run_nr = nruns
         info = {
-            'subject_id': lastinfo['subject_id'],
-            'run_nr': 1,
+            'subject_id': subject_id,
+            'run_nr': run_nr,
             'scanner?': True,
             'fullscr': True,
+            'session?': False,
         }
         infdlg = gui.DlgFromDict(dictionary=info,
                                  title="Movie Presentation",
                                  order=['subject_id', 'run_nr', 'scanner?',
-                                        'fullscr']
+                                        'fullscr', 'session?']
                                  )
+        registry.close()
         if not infdlg.OK:
             core.quit()
+        STARTUP.mark('dialog')
     else:
+        runnr = parsed.runnr
+        if runnr is None:
+            registry = open_registry()
+            nruns = get_config().get('nruns', 4)
+            runnr = registry.next_run(parsed.subject, nruns)
+            registry.close()
+            if runnr is None:
+                raise SystemExit("All {0} runs of {1} were completed; use "
+                                 "--runnr to present one again".format(
+                                     nruns, parsed.subject))
         info = {
             'subject_id': parsed.subject,
-            'run_nr': parsed.runnr,
+            'run_nr': runnr,
             'scanner?': parsed.no_scanner,
             'fullscr': parsed.no_fullscreen,
+            'session?': parsed.session,
         }
 
     main(info)
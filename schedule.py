@@ -0,0 +1,419 @@
+"""Array-backed representation of the stimulus order.
+
+All the runs of an experiment are stored in a single structured array of
+shape (nruns, ntrials), with categorical codes for the stimulus type (0 is
+fixation), an index into the list of stimuli for the filename (-1 for
+fixation), float32 durations and a repetition flag. Runs are created,
+shuffled, injected with repetitions and validated with array operations over
+all runs at once; conversion to the json format (a dictionary of lists of
+trial dictionaries, see make_stim_order) only happens when loading or saving.
+"""
+import numpy as np
+
+FIXATION = 'fixation'
+# number of clips in each block
+BLOCK_LENGTH = 6
+STIM_DURATION = 3.
+FIXATION_DURATION = 18.
+# version of the generator, part of the key of cached stimulus orders (see
+# schedulecache.py); bump it whenever a change to this module changes the
+# orders generated for the same inputs
+GENERATOR_VERSION = 1
+TRIAL_DTYPE = np.dtype([('stim_type', 'u2'), ('stim_idx', 'i4'),
+                        ('duration', 'f4'), ('repetition', 'u1')])
+
+
+def _rng(rng):
+    """Returns the numpy global random state if rng is None"""
+    return np.random if rng is None else rng
+
+
+def stimulus_table(stimuli):
+    """Flattens a dictionary of stimuli per category.
+
+    Returns
+    -------
+    categories : tuple
+        'fixation' followed by the sorted categories; the position of each
+        category is its code
+    files : tuple
+        stimulus filenames, grouped by category
+    table : array (ncategories, max number of stimuli per category)
+        indices into files of the stimuli of each category, padded with -1
+    """
+    categories = sorted(stimuli)
+    files = []
+    max_stims = max([len(stimuli[cat]) for cat in categories] or [0])
+    table = -np.ones((len(categories), max_stims), dtype='i4')
+    for icat, cat in enumerate(categories):
+        stims = list(stimuli[cat])
+        table[icat, :len(stims)] = np.arange(len(files),
+                                             len(files) + len(stims))
+        files.extend(stims)
+    return (FIXATION,) + tuple(categories), tuple(files), table
+
+
+def run_layout(ncategories):
+    """Returns the number of trials in a run and the position of the three
+    fixations"""
+    half = ncategories * BLOCK_LENGTH
+    return 2 * half + 3, np.array([0, half + 1, 2 * half + 2])
+
+
+def get_rand_categories(categories, n, count_categories, rng=None):
+    """Returns a random sample of categories. If n > len(categories),
+    then all categories are returned plus some random categories. Also, if
+    count_categories is passed, the priority goes to those categories with
+    min(count_categories), in oder to counterbalance across runs.
+
+    Arguments
+    ---------
+    categories : list
+    n : int
+        number of categories to return
+    count_categories : array or None
+        number of times each category was sampled so far; updated in place
+    rng : np.random.RandomState or None
+        random state; if None, numpy's global random state is used
+
+    Returns
+    -------
+    sample_categories : list
+    count_categories : array
+    """
+    rng = _rng(rng)
+    categories = list(categories)
+    n_categories = len(categories)
+    if count_categories is None:
+        count_categories = np.zeros(n_categories, dtype=int)
+    idx_min_cat = np.where(count_categories == count_categories.min())[0]
+    if n <= len(idx_min_cat):
+        rand_idx_cat = rng.permutation(idx_min_cat)[:n]
+        sample_categories = [categories[i] for i in rand_idx_cat]
+        for i in rand_idx_cat:
+            count_categories[i] += 1
+        return sample_categories, count_categories
+    else:
+        # first fill with the minimum
+        sample_categories = [categories[i] for i in idx_min_cat]
+        for i in idx_min_cat:
+            count_categories[i] += 1
+        n_ = n - len(sample_categories)
+        # then fill with multiples of n_
+        for _ in range(n_ // n_categories):
+            sample_categories += categories
+            # add one to all categories
+            count_categories += 1
+        # finally fill the remainder
+        idx_sample_categories_ = \
+            rng.permutation(n_categories)[:n_ % n_categories]
+        for idx in idx_sample_categories_:
+            count_categories[idx] += 1
+        sample_categories += [categories[idx]
+                              for idx in idx_sample_categories_]
+        rng.shuffle(sample_categories)
+        return sample_categories, count_categories
+
+
+class Schedule(object):
+    """Stimulus order of all the runs of an experiment.
+
+    Arguments
+    ---------
+    categories : tuple
+        names of the stimulus type codes; categories[0] is fixation
+    stimuli : tuple
+        stimulus filenames indexed by stim_idx
+    runs : array (nruns, ntrials) of TRIAL_DTYPE
+    """
+    __slots__ = ('categories', 'stimuli', 'runs')
+
+    def __init__(self, categories, stimuli, runs):
+        self.categories = tuple(categories)
+        self.stimuli = tuple(stimuli)
+        self.runs = runs
+
+    @property
+    def nruns(self):
+        return self.runs.shape[0]
+
+    def __len__(self):
+        return self.nruns
+
+    def __eq__(self, other):
+        return isinstance(other, Schedule) and \
+            self.to_json() == other.to_json()
+
+    def __ne__(self, other):
+        return not self == other
+
+    def copy(self):
+        return Schedule(self.categories, self.stimuli, self.runs.copy())
+
+    @classmethod
+    def create(cls, stimuli, nruns, rng=None, orders=None):
+        """Creates nruns runs according to Pitcher et al., 2011. Each run
+        consists of
+            - fixation (18s)
+            - randomized block of categories
+            - fixation (18s)
+            - inverted block of categories
+            - fixation (18s)
+        Each block contains six clips of the same category, drawn without
+        replacement for each run.
+
+        Arguments
+        ---------
+        stimuli : dict
+            dictionary containing lists of stimuli for each category
+        nruns : int
+            number of runs
+        rng : np.random.RandomState or None
+            random state; if None, numpy's global random state is used
+        orders : array (nruns, ncategories) or None
+            order of the categories in the first half of each run, as
+            indices into the sorted categories (see ordersearch.py); if
+            None, the orders are random
+
+        Returns
+        -------
+        schedule : Schedule
+        """
+        rng = _rng(rng)
+        categories, files, table = stimulus_table(stimuli)
+        ncat = len(categories) - 1
+        if table.shape[1] < 2 * BLOCK_LENGTH or \
+                (table[:, 2 * BLOCK_LENGTH - 1] < 0).any():
+            raise ValueError("Each category needs at least {0} "
+                             "stimuli".format(2 * BLOCK_LENGTH))
+        ntrials, fixations = run_layout(ncat)
+        runs = np.zeros((nruns, ntrials), dtype=TRIAL_DTYPE)
+        allruns = np.arange(nruns)[:, np.newaxis]
+        # randomize categories
+        if orders is None:
+            order = rng.rand(nruns, ncat).argsort(axis=1)
+        else:
+            order = np.asarray(orders, dtype=int)
+            if order.shape != (nruns, ncat) or \
+                    (np.sort(order, axis=1) != np.arange(ncat)).any():
+                raise ValueError("orders must be a permutation of the "
+                                 "categories for each run")
+        # shuffle the stimuli of each category, independently for each run;
+        # the padding is sorted last
+        keys = rng.rand(nruns, ncat, table.shape[1])
+        keys[:, table < 0] = 2.
+        picks = keys.argsort(axis=2)[:, :, :2 * BLOCK_LENGTH]
+        shuffled = table[np.arange(ncat)[np.newaxis, :, np.newaxis], picks]
+        # the first 6 of each category go in the first block, the next 6 in
+        # the inverted block
+        half = ncat * BLOCK_LENGTH
+        for start, order_, stims in (
+                (1, order, shuffled[allruns, order, :BLOCK_LENGTH]),
+                (half + 2, order[:, ::-1],
+                 shuffled[allruns, order[:, ::-1], BLOCK_LENGTH:])):
+            block = runs[:, start:start + half]
+            block['stim_type'] = np.repeat(order_ + 1, BLOCK_LENGTH, axis=1)
+            block['stim_idx'] = stims.reshape(nruns, half)
+            block['duration'] = STIM_DURATION
+        runs[:, fixations] = (0, -1, FIXATION_DURATION, 0)
+        return cls(categories, files, runs)
+
+    def inject_attention_check(self, nchecks=None, rng=None):
+        """Returns a copy of the schedule with nchecks repeated trials in
+        each run. The categories of the repetitions are counterbalanced
+        across runs (see get_rand_categories), and in each run the
+        repetitions are split between the two halves of the run, with the
+        categories assigned to each half at random. A repetition is never
+        the first trial of a block, and never follows another repetition.
+
+        Arguments
+        ---------
+        nchecks : int or None
+            number of repetitions in each run; by default, one for each
+            category
+        rng : np.random.RandomState or None
+            random state; if None, numpy's global random state is used
+
+        Returns
+        -------
+        schedule : Schedule
+            the schedule with injected trials
+        """
+        rng = _rng(rng)
+        injected = self.copy()
+        runs = injected.runs
+        nruns, ntrials = runs.shape
+        ncat = len(self.categories) - 1
+        nslots = 2 * ncat
+        if nchecks is None:
+            nchecks = ncat
+        allruns = np.arange(nruns)[:, np.newaxis]
+        stim_type = runs['stim_type'].astype(int)
+
+        # find all the blocks in one pass; each category has a block (slot)
+        # in each half of the run, in which the repetitions can go anywhere
+        # but on the first trial
+        changes = stim_type[:, 1:] != stim_type[:, :-1]
+        is_start = np.zeros((nruns, ntrials), dtype=bool)
+        is_start[:, 1:] = changes
+        is_end = np.zeros((nruns, ntrials), dtype=bool)
+        is_end[:, :-1] = changes
+        is_end[:, -1] = True
+        is_start &= stim_type > 0
+        is_end &= stim_type > 0
+        starts = np.nonzero(is_start)[1]
+        if len(starts) != nruns * nslots:
+            raise ValueError("Runs must have one block per category in each "
+                             "half")
+        starts = starts.reshape(nruns, nslots)
+        ends = np.nonzero(is_end)[1].reshape(nruns, nslots)
+        block_slot = 2 * (stim_type[allruns, starts] - 1) + \
+            (starts >= ntrials // 2)
+        if (np.sort(block_slot, axis=1) != np.arange(nslots)).any():
+            raise ValueError("Runs must have one block per category in each "
+                             "half")
+        slot_start = np.empty((nruns, nslots), dtype=int)
+        slot_start[allruns, block_slot] = starts
+        # number of trials where a repetition can go
+        slot_len = np.empty((nruns, nslots), dtype=int)
+        slot_len[allruns, block_slot] = ends - starts
+
+        # categories to check in each run, counterbalanced across runs
+        codes = range(1, ncat + 1)
+        if nchecks % ncat == 0:
+            check_cat = np.tile(codes, (nruns, nchecks // ncat))
+        else:
+            check_cat = np.empty((nruns, nchecks), dtype=int)
+            count_categories = np.zeros(ncat, dtype=int)
+            for irun in range(nruns):
+                check_cat[irun], count_categories = get_rand_categories(
+                    codes, nchecks, count_categories, rng)
+        # sort the checks by a random ranking of the categories, and
+        # alternate the halves, so that the categories are randomly split
+        # in two groups, and a category checked twice gets one repetition in
+        # each half
+        rank = rng.rand(nruns, ncat + 1)[allruns, check_cat]
+        order = np.argsort(rank, axis=1, kind='mergesort')
+        check_cat = check_cat[allruns, order]
+        half = (np.arange(nchecks) + rng.randint(2, size=(nruns, 1))) % 2
+        check_slot = 2 * (check_cat - 1) + half
+
+        # number of checks in each slot, and rank of each check in its slot
+        counts = np.bincount((check_slot + nslots * allruns).ravel(),
+                             minlength=nruns * nslots).reshape(nruns, nslots)
+        if (2 * counts - 1 > slot_len).any():
+            raise ValueError("Too many checks for the length of the blocks")
+        order = np.argsort(check_slot, axis=1, kind='mergesort')
+        sorted_slot = check_slot[allruns, order]
+        idx = np.arange(nchecks)
+        first = np.where(np.concatenate(
+            [np.ones((nruns, 1), dtype=bool),
+             sorted_slot[:, 1:] != sorted_slot[:, :-1]], axis=1), idx, 0)
+        slot_rank = np.empty((nruns, nchecks), dtype=int)
+        slot_rank[allruns, order] = idx - np.maximum.accumulate(first, axis=1)
+
+        # pick non-adjacent trials in each slot: a sorted random sample of
+        # `count` out of slot_len - count + 1 trials, spread apart by adding
+        # the rank
+        max_count = max(counts.max(), 1)
+        max_len = slot_len.max()
+        keys = rng.rand(nruns, nslots, max_len)
+        keys[np.arange(max_len) >= (slot_len - counts + 1)[..., np.newaxis]] \
+            = 2.
+        picked = keys.argsort(axis=2)[..., :max_count]
+        picked[np.arange(max_count) >= counts[..., np.newaxis]] = max_len
+        picked.sort(axis=2)
+        offsets = picked + np.arange(max_count)
+        check = slot_start[allruns, check_slot] + 1 + \
+            offsets[allruns, check_slot, slot_rank]
+
+        runs['stim_idx'][allruns, check] = runs['stim_idx'][allruns,
+                                                            check - 1]
+        runs['repetition'][allruns, check] = 1
+        return injected
+
+    def validate(self):
+        """Checks that the runs follow the design.
+
+        Returns
+        -------
+        problems : list
+            (run number, description) of each problem found; empty if the
+            schedule is valid
+        """
+        runs = self.runs
+        stim_type = runs['stim_type']
+        stim_idx = runs['stim_idx']
+        repetition = runs['repetition'].astype(bool)
+        is_fix = stim_type == 0
+        stim_category = np.zeros(len(self.stimuli) + 1,
+                                 dtype=stim_type.dtype)
+        stim_category[stim_idx[~is_fix]] = stim_type[~is_fix]
+        problems = []
+
+        def check(bad, description):
+            for irun in np.nonzero(bad)[0]:
+                problems.append((irun + 1, description))
+
+        check(is_fix.sum(axis=1) != 3, 'not 3 fixations')
+        check((stim_type != stim_type[:, ::-1]).any(axis=1),
+              'blocks are not in palindromic order')
+        check((is_fix != (stim_idx < 0)).any(axis=1),
+              'fixations with a stimulus or clips without')
+        check((np.where(is_fix, FIXATION_DURATION, STIM_DURATION) !=
+               runs['duration']).any(axis=1), 'wrong durations')
+        check(((stim_category[stim_idx] != stim_type) & ~is_fix).any(axis=1),
+              'stimuli of the wrong category')
+        previous = np.roll(stim_idx, 1, axis=1)
+        check((repetition & ((previous != stim_idx) | is_fix)).any(axis=1),
+              'repetitions not repeating the previous clip')
+        # besides repetitions, each clip is presented once per run
+        unique = np.sort(np.where(is_fix | repetition, -1 - np.arange(
+            stim_idx.shape[1]), stim_idx), axis=1)
+        check((np.diff(unique, axis=1) == 0).any(axis=1),
+              'clips presented more than once')
+        return sorted(problems)
+
+    def run(self, irun):
+        """Returns run irun (starting from 1) as a list of trial
+        dictionaries"""
+        return self._trials(self.runs[irun - 1])
+
+    def _trials(self, run):
+        trials = []
+        for stim_type, stim_idx, duration, repetition in run.tolist():
+            trial = {
+                'stim_type': self.categories[stim_type],
+                'duration': duration,
+                'stim_fn': self.stimuli[stim_idx] if stim_idx >= 0 else None,
+            }
+            if repetition:
+                trial['repetition'] = 1
+            trials.append(trial)
+        return trials
+
+    def to_json(self):
+        """Returns the experiment in the json format, i.e. a dictionary
+        mapping run numbers (from 1) to lists of trials"""
+        return {irun + 1: self._trials(run)
+                for irun, run in enumerate(self.runs)}
+
+    @classmethod
+    def from_json(cls, exp):
+        """Creates a schedule from an experiment in the json format; runs
+        must all have the same number of trials"""
+        run_nrs = sorted(exp, key=int)
+        trials = [trial for irun in run_nrs for trial in exp[irun]]
+        categories = (FIXATION,) + tuple(sorted(
+            set(t['stim_type'] for t in trials) - set([FIXATION])))
+        stimuli = tuple(sorted(set(t['stim_fn'] for t in trials
+                                   if t['stim_fn'] is not None)))
+        cat_code = {cat: i for i, cat in enumerate(categories)}
+        stim_code = {fn: i for i, fn in enumerate(stimuli)}
+        stim_code[None] = -1
+        runs = np.array(
+            [(cat_code[t['stim_type']], stim_code[t['stim_fn']],
+              t['duration'], t.get('repetition', 0)) for t in trials],
+            dtype=TRIAL_DTYPE)
+        return cls(categories, stimuli,
+                   runs.reshape(len(run_nrs), -1))
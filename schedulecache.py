@@ -0,0 +1,139 @@
+"""Content-addressed cache of generated stimulus orders.
+
+A stimulus order is a deterministic function of the subject id, the number
+of runs, the set of stimuli (their filenames and content hashes in the
+manifest), the version of the generator (schedule.GENERATOR_VERSION), the
+seed, and the generation options; the cache key is a hash of all of them,
+and the random state of the generator is seeded from it. Generated orders
+are stored in the cache directory under their key, so asking again for the
+same subject returns the stored file, and any change to the stimuli or to
+the generator gives a new key. Concurrent requests for the same key are
+serialised with a lock file, so that only the first one generates.
+"""
+import hashlib
+import json
+import os
+from os.path import join as pjoin, exists as pexists
+from schedule import GENERATOR_VERSION
+try:
+    import fcntl
+except ImportError:
+    # no locking on Windows; writes are still atomic
+    fcntl = None
+
+PWD = os.path.dirname(os.path.abspath(__file__))
+CACHE_DIR = pjoin(PWD, 'cache', 'schedules')
+
+
+def stimuli_digest(stimuli, hashes=None):
+    """Returns a hash of a dictionary of stimuli per category.
+
+    Arguments
+    ---------
+    stimuli : dict
+        dictionary containing lists of stimuli for each category
+    hashes : dict or None
+        content hash of each stimulus (see manifest.manifest_hashes); if
+        None, only the filenames are hashed
+    """
+    digest = hashlib.sha1()
+    for cat in sorted(stimuli):
+        for fn in sorted(stimuli[cat]):
+            digest.update('{0}\t{1}\t{2}\n'.format(
+                cat, fn, hashes.get(fn, '') if hashes else '').encode('utf-8'))
+    return digest.hexdigest()
+
+
+def schedule_key(subid, nruns, digest, seed=0, nchecks=None, orders=None):
+    """Returns the cache key of a stimulus order.
+
+    Arguments
+    ---------
+    subid : str
+        subject id
+    nruns : int
+        number of runs
+    digest : str
+        hash of the stimuli (see stimuli_digest)
+    seed : int
+        base seed
+    nchecks : int or None
+        number of attention checks per run
+    orders : array or None
+        category orders, if not random
+    """
+    params = {
+        'version': GENERATOR_VERSION,
+        'subid': str(subid),
+        'nruns': int(nruns),
+        'stimuli': digest,
+        'seed': int(seed),
+        'nchecks': nchecks,
+        'orders': orders.tolist() if hasattr(orders, 'tolist') else orders,
+    }
+    return hashlib.sha1(
+        json.dumps(params, sort_keys=True).encode('utf-8')).hexdigest()
+
+
+def key_seed(key):
+    """Returns the seed of the random state for a cache key"""
+    return int(key[:8], 16)
+
+
+def cache_fn(cache_dir, key):
+    return pjoin(cache_dir, key + '.json')
+
+
+def _lock(cache_dir, key):
+    """Returns an open lock file for key, locked exclusively (or None if
+    locking is not available)"""
+    if fcntl is None:
+        return None
+    f = open(pjoin(cache_dir, key + '.lock'), 'ab')
+    fcntl.flock(f.fileno(), fcntl.LOCK_EX)
+    return f
+
+
+def get_or_create(cache_dir, key, create):
+    """Returns the cached file for key, creating it if needed.
+
+    Arguments
+    ---------
+    cache_dir : str
+        cache directory
+    key : str
+        cache key (see schedule_key)
+    create : callable
+        called without arguments if the key is not cached; returns the
+        experiment to store, as a json-serialisable object
+
+    Returns
+    -------
+    fn : str
+        cached file
+    cached : bool
+        whether the file was already in the cache
+    """
+    fn = cache_fn(cache_dir, key)
+    if pexists(fn):
+        return fn, True
+    if not pexists(cache_dir):
+        try:
+            os.makedirs(cache_dir)
+        except OSError:
+            # created by another process in the meantime
+            pass
+    lock = _lock(cache_dir, key)
+    try:
+        # someone else may have created it while we were waiting
+        if pexists(fn):
+            return fn, True
+        exp = create()
+        tmp_fn = '{0}.{1}.tmp'.format(fn, os.getpid())
+        with open(tmp_fn, 'wb') as f:
+            json.dump(exp, f, indent=True)
+        os.rename(tmp_fn, fn)
+        return fn, False
+    finally:
+        if lock is not None:
+            lock.close()
@@ -0,0 +1,181 @@
+"""Compact binary format for stimulus orders, with random access to runs.
+
+The file starts with a header (magic, format version, number of runs,
+categories and stimuli, size of the string table), followed by
+    - the string table: the categories (fixation first) and the stimulus
+      filenames, each stored once, as the offsets of their ends followed
+      by their utf-8 bytes
+    - the run index: the file offsets of the start of each run, followed by
+      the end of the last one
+    - the trials of all the runs, as packed little-endian records of
+      schedule.TRIAL_DTYPE, where the stimulus type and filename are
+      indices into the string table
+A single run is read by seeking to its index entry and then to its trials,
+without reading the other runs. The conversion to and from the json format
+goes through schedule.Schedule, and is lossless.
+"""
+import argparse
+import json
+import os
+import struct
+import time
+import numpy as np
+from schedule import Schedule, TRIAL_DTYPE
+
+MAGIC = b'LOCSCHED'
+FORMAT_VERSION = 2
+# magic, version, nruns, ncategories, nstimuli, size of the string bytes
+HEADER = struct.Struct('<8s5I')
+# trials as stored in the file, for each format version; version 1 stored
+# the stimulus type in a byte, and is still read
+FILE_DTYPES = {
+    1: np.dtype([('stim_type', 'u1'), ('stim_idx', '<i4'),
+                 ('duration', '<f4'), ('repetition', 'u1')]),
+    2: np.dtype([('stim_type', '<u2'), ('stim_idx', '<i4'),
+                 ('duration', '<f4'), ('repetition', 'u1')]),
+}
+FILE_DTYPE = FILE_DTYPES[FORMAT_VERSION]
+SCHEDULE_EXT = '.sched'
+
+
+def _encode(s):
+    return s if isinstance(s, bytes) else s.encode('utf-8')
+
+
+def is_schedule_file(fn):
+    """Whether fn is in the binary format"""
+    with open(fn, 'rb') as f:
+        return f.read(len(MAGIC)) == MAGIC
+
+
+def save_schedule_file(schedule, fn, overwrite=False):
+    """Saves a Schedule in the binary format"""
+    if os.path.exists(fn) and not overwrite:
+        raise ValueError("{0} exists, not overwriting".format(fn))
+    strings = [_encode(s) for s in schedule.categories + schedule.stimuli]
+    ends = np.cumsum([len(s) for s in strings]).astype('<u4')
+    nbytes = int(ends[-1])
+    runs = schedule.runs.astype(FILE_DTYPE)
+    nruns, ntrials = runs.shape
+    start = HEADER.size + ends.nbytes + nbytes + 8 * (nruns + 1)
+    index = (start + FILE_DTYPE.itemsize * ntrials *
+             np.arange(nruns + 1)).astype('<u8')
+    with open(fn, 'wb') as f:
+        f.write(HEADER.pack(MAGIC, FORMAT_VERSION, nruns,
+                            len(schedule.categories), len(schedule.stimuli),
+                            nbytes))
+        f.write(ends.tobytes())
+        f.write(b''.join(strings))
+        f.write(index.tobytes())
+        f.write(runs.tobytes())
+
+
+class ScheduleFile(object):
+    """Stimulus order stored in the binary format. Only the header and the
+    string table are read when opening; runs are read when requested. Has
+    the same run() and len() as schedule.Schedule.
+
+    Arguments
+    ---------
+    fn : str
+        file in the binary format (see save_schedule_file)
+    """
+    def __init__(self, fn):
+        self.fn = fn
+        with open(fn, 'rb') as f:
+            header = f.read(HEADER.size)
+            if len(header) < HEADER.size or \
+                    header[:len(MAGIC)] != MAGIC:
+                raise ValueError("{0} is not a schedule file".format(fn))
+            _, version, nruns, ncat, nstims, nbytes = HEADER.unpack(header)
+            if version not in FILE_DTYPES:
+                raise ValueError("{0} has format version {1}, expected "
+                                 "{2}".format(fn, version, FORMAT_VERSION))
+            ends = np.frombuffer(f.read(4 * (ncat + nstims)), dtype='<u4')
+            data = f.read(nbytes)
+        starts = np.concatenate([[0], ends[:-1]]).astype(int)
+        strings = [data[i:j].decode('utf-8')
+                   for i, j in zip(starts, ends.astype(int))]
+        self.categories = tuple(strings[:ncat])
+        self.stimuli = tuple(strings[ncat:])
+        self.nruns = nruns
+        self._dtype = FILE_DTYPES[version]
+        self._index = HEADER.size + 4 * (ncat + nstims) + nbytes
+
+    def __len__(self):
+        return self.nruns
+
+    def _read(self, f, first, last):
+        """Reads the trials of runs first to last - 1 (from 0), and returns
+        them with the offsets of each run into them"""
+        f.seek(self._index + 8 * first)
+        offsets = np.frombuffer(f.read(8 * (last - first + 1)),
+                                dtype='<u8').astype(int)
+        f.seek(offsets[0])
+        data = np.frombuffer(f.read(offsets[-1] - offsets[0]),
+                             dtype=self._dtype)
+        return data, (offsets - offsets[0]) // self._dtype.itemsize
+
+    def run_array(self, irun):
+        """Returns the trials of run irun (starting from 1) as an array of
+        schedule.TRIAL_DTYPE"""
+        if not 1 <= irun <= self.nruns:
+            raise IndexError("run {0} out of range".format(irun))
+        with open(self.fn, 'rb') as f:
+            data, _ = self._read(f, irun - 1, irun)
+        return data.astype(TRIAL_DTYPE)
+
+    def run(self, irun):
+        """Returns run irun (starting from 1) as a list of trial
+        dictionaries"""
+        return Schedule(self.categories, self.stimuli,
+                        self.run_array(irun)[np.newaxis]).run(1)
+
+    def load(self):
+        """Reads all the runs, and returns them as a Schedule"""
+        with open(self.fn, 'rb') as f:
+            data, offsets = self._read(f, 0, self.nruns)
+        lengths = np.diff(offsets)
+        if len(lengths) and (lengths != lengths[0]).any():
+            raise ValueError("{0}: runs have different numbers of "
+                             "trials".format(self.fn))
+        runs = data.astype(TRIAL_DTYPE).reshape(self.nruns, -1)
+        return Schedule(self.categories, self.stimuli, runs)
+
+
+def load_schedule_file(fn):
+    """Loads a Schedule saved in the binary format"""
+    return ScheduleFile(fn).load()
+
+
+def main():
+    parsed = parse_args()
+    tstart = time.time()
+    if is_schedule_file(parsed.input):
+        schedule = load_schedule_file(parsed.input)
+        with open(parsed.output, 'wb') as f:
+            json.dump(schedule.to_json(), f, indent=True)
+    else:
+        with open(parsed.input, 'rb') as f:
+            schedule = Schedule.from_json(json.load(f))
+        save_schedule_file(schedule, parsed.output, overwrite=True)
+    print("Converted {0} runs in {1:.3f}s: {2} ({3} bytes) -> {4} ({5} "
+          "bytes)".format(len(schedule), time.time() - tstart,
+                          parsed.input, os.path.getsize(parsed.input),
+                          parsed.output, os.path.getsize(parsed.output)))
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description=__doc__)
+
+    parser.add_argument('input', type=str,
+                        help='stimulus order, in the json or the binary '
+                             'format')
+    parser.add_argument('output', type=str,
+                        help='converted stimulus order, in the other '
+                             'format')
+    return parser.parse_args()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,154 @@
+"""Threaded reader for the serial port of the scanner.
+
+A background thread reads the port one byte at a time and timestamps each
+byte as it arrives, so that button presses are not quantised to the frame
+rate of the presentation loop and bytes arriving during fixation are not
+delayed. Events are pushed into a deque (whose append and popleft are
+atomic), which the presentation loop drains without taking a lock.
+"""
+from collections import deque
+import os
+import select
+import threading
+from timeit import default_timer
+
+
+class PtySerial(object):
+    """Serial-like device backed by a pseudo-terminal: bytes written with
+    write() (or to the master end, see `name`) are returned by read(). Used
+    to emulate the scanner's serial port."""
+    def __init__(self, timeout=0.05):
+        self.timeout = timeout
+        self._master, self._slave = os.openpty()
+        # name of the slave end, which can be opened as a serial port
+        self.name = os.ttyname(self._slave)
+        try:
+            import tty
+            tty.setraw(self._slave)
+        except Exception:
+            pass
+
+    def write(self, data):
+        return os.write(self._master, data)
+
+    def read(self, size=1):
+        """Reads up to size bytes, waiting at most self.timeout seconds;
+        returns an empty string on timeout"""
+        ready, _, _ = select.select([self._slave], [], [], self.timeout)
+        if not ready:
+            return ''
+        return os.read(self._slave, size)
+
+    def flushInput(self):
+        while select.select([self._slave], [], [], 0)[0]:
+            os.read(self._slave, 1024)
+
+    def close(self):
+        for fd in (self._master, self._slave):
+            try:
+                os.close(fd)
+            except OSError:
+                pass
+
+
+class SerialReader(object):
+    """Reads a serial port in a background thread.
+
+    Arguments
+    ---------
+    port : object
+        serial port, e.g. serial.Serial or PtySerial; its read() must return
+        within a short timeout. If it has a pump() method, it is called from
+        the main thread by pump(), drain() and wait_for_trigger(), for ports
+        that need the main thread to produce their bytes (e.g. the
+        keyboard). pump() may return (time, byte) events, which are
+        recorded with their own timestamps instead of the time they are
+        read. Ports without read() are only pumped, and no thread is
+        started for them.
+    clock : callable
+        returns the current time in s; used to timestamp each byte
+    trigger : str
+        byte sent by the scanner at each TR
+    """
+    def __init__(self, port, clock=default_timer, trigger='5'):
+        self.port = port
+        self.clock = clock
+        self.trigger = trigger
+        self.events = deque()
+        self.n_triggers = 0
+        self.trigger_time = None
+        self._triggered = threading.Event()
+        self._stop = threading.Event()
+        self._thread = None
+        self._pump = getattr(port, 'pump', None)
+
+    def start(self):
+        if not hasattr(self.port, 'read'):
+            return
+        self._thread = threading.Thread(target=self._run,
+                                        name='SerialReader')
+        self._thread.daemon = True
+        self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+
+    def _record(self, t, byte):
+        if byte == self.trigger:
+            if self.trigger_time is None:
+                self.trigger_time = t
+                self._triggered.set()
+            self.n_triggers += 1
+        self.events.append((t, byte))
+
+    def _run(self):
+        while not self._stop.is_set():
+            data = self.port.read()
+            if not data:
+                continue
+            t = self.clock()
+            for byte in data:
+                self._record(t, byte)
+
+    @property
+    def needs_pump(self):
+        """Whether the port needs pump() to be called regularly"""
+        return self._pump is not None
+
+    def pump(self):
+        """Calls the pump() of the port, if any, recording the events it
+        returns"""
+        if self._pump is None:
+            return
+        for t, byte in self._pump() or ():
+            self._record(t, byte)
+
+    def wait_for_trigger(self, timeout=None, poll=0.01):
+        """Waits for the first trigger, and returns the time it arrived.
+        Returns None if timeout expires first."""
+        tstart = default_timer()
+        while not self._triggered.wait(poll if self._pump else timeout):
+            self.pump()
+            if timeout is not None and default_timer() - tstart > timeout:
+                return None
+        return self.trigger_time
+
+    def reset(self):
+        """Forgets the events and triggers received so far"""
+        self.events.clear()
+        self.n_triggers = 0
+        self.trigger_time = None
+        self._triggered.clear()
+
+    def drain(self):
+        """Returns the (time, byte) events received since the last call"""
+        self.pump()
+        events = []
+        while True:
+            try:
+                events.append(self.events.popleft())
+            except IndexError:
+                return events
@@ -0,0 +1,685 @@
+"""Headless simulation of the presentation loop, in accelerated time.
+
+run_localizer.run is executed unchanged, with psychopy, the movie stimuli
+and the serial port of the scanner replaced by fakes that share a virtual
+clock running `speed` times faster than real time:
+    - the window flips on the retraces of a virtual monitor, and misses
+      some of them at random (dropped frames)
+    - clips take a virtual decode time to open, longer for a random
+      fraction of them (slow decodes), in the loader thread as usual
+    - the scanner sends a trigger every TR, and the participant presses a
+      button after each repetition (with some misses), and at random (false
+      alarms); with Scenario(keyboard=True), the triggers and presses come
+      from the keyboard instead, as with run_localizer.py --no-scanner
+The run writes the same log and BIDS _events.tsv files as in the scanner,
+and its timing metrics (onset errors, wake-up latencies, dropped frames,
+late clips, clip pool) are returned, together with what was injected, so
+that changes to the schedule or the loader can be compared automatically.
+
+Real time is still spent in the loop and in the loader thread, so timing
+errors of the host are magnified by `speed`; keep it low enough for the
+frame interval (e.g. 20 for a 60 Hz monitor) when measuring timing.
+
+The fakes are installed as module globals of run_localizer for the duration
+of simulate_run, and restored afterwards, also when the run fails: only one
+simulation can run at a time in a process.
+"""
+import argparse
+import json
+import os
+from os.path import join as pjoin, exists as pexists
+import threading
+import time
+from timeit import default_timer
+import numpy as np
+import run_localizer
+import profiling
+from cliploader import ClipPool, POOL_MB, POOL_MAX_CLIPS
+from make_stim_order import get_stimuli, generate_schedule, load_schedule, \
+    STIMDIR
+from registry import SessionRegistry
+from schedule import STIM_DURATION
+from timing import planned_onsets
+
+PWD = os.path.dirname(os.path.abspath(__file__))
+# psychopy's status constants
+NOT_STARTED, PLAYING, FINISHED = 0, 1, -1
+# psychopy's logging levels
+LEVELS = {run_localizer.BIDS: 'BIDS', 20: 'INFO', 22: 'EXP', 30: 'WARNING'}
+# held while the fakes are installed in run_localizer
+_installed = threading.Lock()
+
+
+class Scenario(object):
+    """What is simulated, and what goes wrong.
+
+    Arguments
+    ---------
+    speed : float
+        how many times faster than real time the virtual clock runs
+    frame_interval : float
+        frame interval of the virtual monitor, in s
+    drop_rate : float
+        probability that a flip misses its retrace
+    max_drop : int
+        a flip that misses its retrace lands 1 to max_drop frames late
+    decode_time : float
+        time to open a clip, in s
+    slow_rate : float
+        fraction of the clips that take slow_time to open instead
+    slow_time : float
+        time to open a slow clip, in s
+    clip_fps : float
+        frame rate of the clips
+    clip_mb : float
+        memory held by each clip, in MB, for the clip pool
+    trigger_delay : float
+        time from opening the serial port to the first trigger, in s
+    tr : float
+        interval between triggers, in s
+    rt : float
+        mean response time to a repetition, in s
+    rt_sd : float
+        standard deviation of the response times, in s
+    miss_rate : float
+        fraction of the repetitions without a response
+    false_alarm_rate : float
+        rate of presses not responding to a repetition, per s
+    keyboard : bool
+        the triggers and presses come from the keyboard (--no-scanner),
+        which is only read when the presentation loop pumps it, instead of
+        from the serial port
+    seed : int
+        seed of the random state of the injected events
+    """
+    def __init__(self, speed=20., frame_interval=1. / 60, drop_rate=0.,
+                 max_drop=1, decode_time=0.05, slow_rate=0., slow_time=1.,
+                 clip_fps=30., clip_mb=64., trigger_delay=1., tr=1.,
+                 rt=0.6, rt_sd=0.1, miss_rate=0., false_alarm_rate=0.,
+                 keyboard=False, seed=0):
+        self.speed = speed
+        self.frame_interval = frame_interval
+        self.drop_rate = drop_rate
+        self.max_drop = max_drop
+        self.decode_time = decode_time
+        self.slow_rate = slow_rate
+        self.slow_time = slow_time
+        self.clip_fps = clip_fps
+        self.clip_mb = clip_mb
+        self.trigger_delay = trigger_delay
+        self.tr = tr
+        self.rt = rt
+        self.rt_sd = rt_sd
+        self.miss_rate = miss_rate
+        self.false_alarm_rate = false_alarm_rate
+        self.keyboard = keyboard
+        self.seed = seed
+
+    def to_json(self):
+        return dict(self.__dict__)
+
+    def decode_times(self, trials, rng):
+        """Returns the time to open each clip of the trials"""
+        clips = sorted(set(trial['stim_fn'] for trial in trials
+                           if trial['stim_fn'] is not None))
+        slow = rng.rand(len(clips)) < self.slow_rate
+        return dict((fn, self.slow_time if is_slow else self.decode_time)
+                    for fn, is_slow in zip(clips, slow))
+
+    def button_presses(self, trials, rng):
+        """Returns the times of the button presses from the first trigger:
+        one after each repetition (unless missed), and false alarms"""
+        onsets = planned_onsets(trials)
+        presses = []
+        for onset, trial in zip(onsets, trials):
+            if trial.get('repetition', 0) and rng.rand() >= self.miss_rate:
+                presses.append(onset + max(0.1, rng.normal(self.rt,
+                                                           self.rt_sd)))
+        n_false = rng.poisson(self.false_alarm_rate * onsets[-1])
+        presses.extend(rng.uniform(0, onsets[-1], n_false))
+        return sorted(presses)
+
+
+class VirtualClock(object):
+    """Clock running speed times faster than real time. Sleeps spin for
+    their last `spin` seconds of real time, as time.sleep overshoots by
+    more than a frame once accelerated. The real time spent sleeping by the
+    thread that created the clock is kept in `slept`."""
+    def __init__(self, speed=1., spin=0.0005):
+        self.speed = float(speed)
+        self.spin = spin
+        self.slept = 0.
+        self._t0 = default_timer()
+        self._thread = threading.current_thread()
+
+    def getTime(self):
+        return (default_timer() - self._t0) * self.speed
+
+    def sleep(self, duration):
+        if duration <= 0:
+            return
+        tstart = default_timer()
+        t_end = tstart + duration / self.speed
+        remaining = t_end - default_timer()
+        if remaining > self.spin:
+            time.sleep(remaining - self.spin)
+        while default_timer() < t_end:
+            pass
+        if threading.current_thread() is self._thread:
+            self.slept += default_timer() - tstart
+
+
+class FakeCore(object):
+    """Stand-in for psychopy.core"""
+    def __init__(self, clock):
+        self.getTime = clock.getTime
+        core = self
+
+        class Clock(object):
+            """psychopy.core.Clock on the virtual clock"""
+            def __init__(self):
+                self._t_reset = core.getTime()
+
+            def getTime(self):
+                return core.getTime() - self._t_reset
+
+            def reset(self, newT=0.):
+                self._t_reset = core.getTime() + newT
+        self.Clock = Clock
+
+    def quit(self):
+        raise SystemExit
+
+
+class FakeLogFile(object):
+    def __init__(self, fn, level=20):
+        self.level = level
+        self._f = open(fn, 'wb')
+
+    def write(self, t, level, msg):
+        if level >= self.level:
+            self._f.write('{0:.4f} \t{1} \t{2}\n'.format(
+                t, LEVELS.get(level, level), msg))
+
+    def flush(self):
+        self._f.flush()
+
+    def close(self):
+        self._f.close()
+
+
+class FakeLogging(object):
+    """Stand-in for psychopy.logging, writing log files in the same format
+    (so that convert_logs.py reads them)"""
+    INFO = 20
+    EXP = 22
+    WARNING = 30
+
+    def __init__(self, clock):
+        self.clock = clock
+        self.root = self
+        self.warnings = []
+        self._targets = []
+        self._lock = threading.Lock()
+
+    def LogFile(self, fn, level=INFO):
+        target = FakeLogFile(fn, level)
+        self._targets.append(target)
+        return target
+
+    def removeTarget(self, target):
+        self._targets.remove(target)
+        target.close()
+
+    def log(self, msg, level, t=None, obj=None):
+        t = self.clock.getTime() if t is None else t
+        with self._lock:
+            for target in self._targets:
+                target.write(t, level, msg)
+
+    def exp(self, msg, t=None, obj=None):
+        self.log(msg, self.EXP, t)
+
+    def warning(self, msg, t=None, obj=None):
+        self.warnings.append(msg)
+        self.log(msg, self.WARNING, t)
+
+    def flush(self):
+        with self._lock:
+            for target in self._targets:
+                target.flush()
+
+
+class FakeGlobalKeys(object):
+    def __init__(self):
+        self._keys = dict()
+
+    def values(self):
+        return self._keys.values()
+
+    def add(self, key, func, modifiers=(), func_args=(), name=None):
+        self._keys[key] = (func, func_args, name)
+
+    def remove(self, key, modifiers=()):
+        self._keys.pop(key, None)
+
+
+class FakeEvent(object):
+    """Stand-in for psychopy.event"""
+    def __init__(self):
+        self.globalKeys = FakeGlobalKeys()
+
+
+class FakeTextStim(object):
+    def __init__(self, win, text='', **kwargs):
+        self.win = win
+        self.text = text
+
+    def draw(self):
+        pass
+
+
+class FakeVisual(object):
+    """Stand-in for psychopy.visual"""
+    NOT_STARTED = NOT_STARTED
+    PLAYING = PLAYING
+    FINISHED = FINISHED
+    TextStim = FakeTextStim
+
+
+class FakeWindow(object):
+    """Window whose flips land on the retraces of a virtual monitor; with
+    probability drop_rate, a flip misses 1 to max_drop retraces"""
+    def __init__(self, clock, scenario, rng):
+        self.clock = clock
+        self.frame_interval = scenario.frame_interval
+        self.drop_rate = scenario.drop_rate
+        self.max_drop = scenario.max_drop
+        self.rng = rng
+        self.n_flips = 0
+        self.dropped = 0
+
+    def flip(self):
+        now = self.clock.getTime()
+        retrace = int(now / self.frame_interval) + 1
+        if self.drop_rate and self.rng.rand() < self.drop_rate:
+            late = self.rng.randint(1, self.max_drop + 1)
+            retrace += late
+            self.dropped += late
+        t_flip = retrace * self.frame_interval
+        self.clock.sleep(t_flip - self.clock.getTime())
+        self.n_flips += 1
+        return t_flip
+
+    def close(self):
+        pass
+
+
+class FakeClip(object):
+    """Opened clip: only its frame rate, duration and size in memory"""
+    def __init__(self, filename, fps, duration, nbytes):
+        self.filename = filename
+        self.fps = fps
+        self.duration = duration
+        self.nframes = int(round(fps * duration))
+        self.nbytes = nbytes
+
+    def close(self):
+        pass
+
+
+class FakeMovie(object):
+    """Movie stimulus playing a FakeClip in a loop from its first draw,
+    with the interface of moviestim.PreparedMovieStim"""
+    def __init__(self, clock, win, filename, clip, **kwargs):
+        self.clock = clock
+        self.win = win
+        self.filename = filename
+        self.clip = clip
+        self.status = NOT_STARTED
+        self._t_start = None
+        self._frame = -1
+
+    def _elapsed_frames(self):
+        return int((self.clock.getTime() - self._t_start) * self.clip.fps)
+
+    def draw(self):
+        if self._t_start is None:
+            self._t_start = self.clock.getTime()
+            self.status = PLAYING
+        self._frame = self._elapsed_frames()
+
+    def time_to_next_frame(self):
+        if self._t_start is None or self.status != PLAYING:
+            return 0.
+        # same criterion as PreparedMovieStim: half a retrace after the
+        # frame is due
+        t_next = self._t_start + (self._frame + 1) / float(self.clip.fps)
+        return max(0., t_next + self.win.frame_interval / 2. -
+                   self.clock.getTime())
+
+    def current_frame(self):
+        if self._frame < 0:
+            return -1
+        return self._frame % self.clip.nframes
+
+    def detach(self):
+        self.clip = None
+        self.status = FINISHED
+
+
+class _FakeScanner(object):
+    """Scanner and button box: a trigger every TR from trigger_delay after
+    the port is opened, and button presses ('1') at the given times from the
+    first trigger"""
+    def __init__(self, clock, scenario, presses, duration):
+        self.clock = clock
+        self.t_trigger = t_trigger = clock.getTime() + scenario.trigger_delay
+        ntriggers = int(np.ceil(duration / scenario.tr)) + 1
+        events = [(t_trigger + i * scenario.tr, '5')
+                  for i in range(ntriggers)]
+        events += [(t_trigger + t, '1') for t in presses]
+        self._events = sorted(events)
+        self._next = 0
+
+    def close(self):
+        pass
+
+
+class FakeSerial(_FakeScanner):
+    """Serial port of the scanner, returning each byte when it is due"""
+    def __init__(self, clock, scenario, presses, duration, timeout=0.05):
+        super(FakeSerial, self).__init__(clock, scenario, presses, duration)
+        self.timeout = timeout
+
+    def read(self, size=1):
+        if self._next >= len(self._events):
+            self.clock.sleep(self.timeout)
+            return ''
+        t, byte = self._events[self._next]
+        wait = t - self.clock.getTime()
+        if wait > self.timeout:
+            self.clock.sleep(self.timeout)
+            return ''
+        self.clock.sleep(wait)
+        self._next += 1
+        return byte
+
+    def flushInput(self):
+        pass
+
+
+class FakeKeyboard(_FakeScanner):
+    """Keyboard emulating the serial port (run_localizer.KeyboardSerial):
+    there is nothing to read, and the keys pressed so far are returned,
+    timestamped with the current time as psychopy does, when pumped"""
+    def pump(self):
+        now = self.clock.getTime()
+        keys = []
+        while self._next < len(self._events) and \
+                self._events[self._next][0] <= now:
+            keys.append((now, self._events[self._next][1]))
+            self._next += 1
+        return keys
+
+
+class Simulation(object):
+    """Fakes for one run of run_localizer.run, and what they injected"""
+    def __init__(self, trials, scenario):
+        self.scenario = scenario
+        rng = np.random.RandomState(scenario.seed)
+        self.decode_times = scenario.decode_times(trials, rng)
+        self.presses = scenario.button_presses(trials, rng)
+        self.duration = planned_onsets(trials)[-1]
+        self.clock = VirtualClock(scenario.speed)
+        self.window = FakeWindow(self.clock, scenario, rng)
+        self.logging = FakeLogging(self.clock)
+        self.n_opened = 0
+        self.modules = {
+            'visual': FakeVisual(),
+            'event': FakeEvent(),
+            'logging': self.logging,
+            'core': FakeCore(self.clock),
+            'open_clip': self.open_clip,
+            'clip_nbytes': lambda clip: clip.nbytes,
+            'PreparedMovieStim': self.make_movie,
+            'sleep': self.clock.sleep,
+            'open_serial': self.open_serial,
+            'open_keyboard': self.open_keyboard,
+        }
+
+    def open_clip(self, filename, content_hash=None, cache_dir=None):
+        stim_fn = os.path.relpath(filename, run_localizer.PWD)
+        self.clock.sleep(self.decode_times.get(stim_fn,
+                                               self.scenario.decode_time))
+        self.n_opened += 1
+        return FakeClip(filename, self.scenario.clip_fps, STIM_DURATION,
+                        int(self.scenario.clip_mb * 2 ** 20))
+
+    def make_movie(self, win, filename, clip, **kwargs):
+        return FakeMovie(self.clock, win, filename, clip, **kwargs)
+
+    def open_serial(self):
+        return FakeSerial(self.clock, self.scenario, self.presses,
+                          self.duration)
+
+    def open_keyboard(self, scrwin, clock):
+        keyboard = FakeKeyboard(self.clock, self.scenario, self.presses,
+                                self.duration)
+        self.clock.sleep(keyboard.t_trigger - self.clock.getTime())
+        return keyboard, keyboard.t_trigger
+
+    def install(self):
+        """Replaces psychopy and the hardware in run_localizer with the
+        fakes; returns what was replaced"""
+        replaced = dict((name, getattr(run_localizer, name))
+                        for name in self.modules)
+        for name, value in self.modules.items():
+            setattr(run_localizer, name, value)
+        return replaced
+
+    def injected(self):
+        """Returns what the fakes injected during the run"""
+        slow = [fn for fn, t in sorted(self.decode_times.items())
+                if t != self.scenario.decode_time]
+        return {
+            'flips': self.window.n_flips,
+            'dropped_frames': self.window.dropped,
+            'clips_opened': self.n_opened,
+            'slow_clips': slow,
+            'button_presses': len(self.presses),
+        }
+
+
+def press_delays(events_fn, presses):
+    """Returns the delay of each button press in an _events.tsv file from
+    the press injected at the same rank"""
+    with open(events_fn, 'rb') as f:
+        f.readline()
+        logged = [float(row.split('\t')[0]) for row in f
+                  if row.split('\t')[2] == 'button_press']
+    return [t - t_press for t, t_press in zip(sorted(logged), presses)]
+
+
+def simulate_run(trials, out_dir, subject_id='sim', run_nr=1,
+                 scenario=None, pool=None, config=None):
+    """Presents a run with run_localizer.run in a simulation.
+
+    Arguments
+    ---------
+    trials : list
+        trials of the run, as stored in the schedule json
+    out_dir : str
+        results directory, where the logs, the events and the session
+        registry are written
+    subject_id : str
+    run_nr : int
+    scenario : Scenario or None
+        what is simulated; defaults to Scenario()
+    pool : ClipPool or None
+        clip pool; pass the same pool to successive runs to simulate a
+        session
+    config : dict or None
+        configuration; defaults to config.json, with the frame log enabled
+
+    Returns
+    -------
+    metrics : dict
+        metrics of the run (see run_localizer.run), with the scenario, what
+        was injected ('injected'), the warnings logged, the real time taken
+        ('real_time'), the real time the loop was busy (not sleeping or
+        waiting for a flip) per trial ('loop_time_per_trial'), and the delay
+        of each logged button press from the injected one ('press_delays')
+    """
+    scenario = Scenario() if scenario is None else scenario
+    if config is None:
+        config = dict(run_localizer.get_config(), frame_log=True)
+    if pool is None:
+        pool = ClipPool(config.get('clip_pool_mb', POOL_MB) * 2 ** 20,
+                        size_of=lambda clip: clip.nbytes,
+                        max_clips=config.get('clip_pool_max',
+                                             POOL_MAX_CLIPS))
+    if not pexists(out_dir):
+        os.makedirs(out_dir)
+    sim = Simulation(trials, scenario)
+    hashes = dict((trial['stim_fn'], 'sim') for trial in trials
+                  if trial['stim_fn'] is not None)
+    info = {'subject_id': subject_id, 'run_nr': run_nr,
+            'scanner?': not scenario.keyboard}
+    if not _installed.acquire(False):
+        raise RuntimeError("Another simulation is running in this process")
+    registry = SessionRegistry(pjoin(out_dir, 'sessions.sqlite'))
+    replaced = dict()
+    tstart = default_timer()
+    try:
+        replaced.update(sim.install())
+        metrics = run_localizer.run(
+            sim.window, info, trials, hashes, pool, scenario.frame_interval,
+            registry, config=config, res_dir=out_dir)
+    finally:
+        for name, value in replaced.items():
+            setattr(run_localizer, name, value)
+        registry.close()
+        _installed.release()
+    metrics['real_time'] = default_timer() - tstart
+    metrics['loop_time_per_trial'] = \
+        (metrics['real_time'] - sim.clock.slept) / len(trials)
+    metrics['scenario'] = scenario.to_json()
+    metrics['injected'] = sim.injected()
+    metrics['warnings'] = sim.logging.warnings
+    metrics['press_delays'] = press_delays(metrics['events_fn'], sim.presses)
+    return metrics
+
+
+def main():
+    parsed = parse_args()
+    profiling.configure_from_args('simulate', parsed)
+    if parsed.schedule is not None:
+        experiment = load_schedule(parsed.schedule)
+    else:
+        nruns = run_localizer.get_config().get('nruns', 4)
+        experiment, _ = generate_schedule(
+            parsed.subject, get_stimuli(parsed.stimdir), nruns,
+            seed=parsed.seed)
+    scenario = Scenario(
+        speed=parsed.speed, frame_interval=1. / parsed.refresh,
+        drop_rate=parsed.drop_rate, max_drop=parsed.max_drop,
+        decode_time=parsed.decode_time, slow_rate=parsed.slow_rate,
+        slow_time=parsed.slow_time, miss_rate=parsed.miss_rate,
+        false_alarm_rate=parsed.false_alarm_rate, keyboard=parsed.keyboard,
+        seed=parsed.seed)
+    config = dict(run_localizer.get_config(), frame_log=True)
+    if parsed.lookahead is not None:
+        config['lookahead_blocks'] = parsed.lookahead
+    pool = ClipPool(config.get('clip_pool_mb', POOL_MB) * 2 ** 20,
+                    size_of=lambda clip: clip.nbytes,
+                    max_clips=config.get('clip_pool_max',
+                                         POOL_MAX_CLIPS))
+    results = []
+    for run_nr in parsed.runnr:
+        with profiling.span('run'):
+            metrics = simulate_run(experiment.run(run_nr), parsed.output,
+                                   parsed.subject, run_nr, scenario, pool,
+                                   config)
+        onsets = metrics['onsets']
+        print("run {0}: {1:.1f}s in {2:.1f}s real; onset error mean "
+              "{3:+.4f}s, max {4:.4f}s; {5} dropped frames ({6} injected); "
+              "{7} late clips; {8} triggers; presses logged up to {9:.3f}s "
+              "late; events in {10}".format(
+                  run_nr, metrics['duration'], metrics['real_time'],
+                  onsets['mean_error'], onsets['max_abs_error'],
+                  metrics['frames']['dropped'],
+                  metrics['injected']['dropped_frames'],
+                  len(metrics['late_clips']), metrics['n_triggers'],
+                  max(metrics['press_delays'] or [0.]),
+                  metrics['events_fn']))
+        results.append(metrics)
+    if parsed.metrics is not None:
+        with open(parsed.metrics, 'wb') as f:
+            json.dump(results, f, indent=True, sort_keys=True)
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description=__doc__)
+
+    parser.add_argument('--subject', '-s', type=str,
+                        help='subject id',
+                        default='sim')
+    parser.add_argument('--runnr', '-r', type=int, nargs='+',
+                        help='runs to present, in the same session',
+                        default=[1])
+    parser.add_argument('--schedule', type=str,
+                        help='stimulus order to present (default: generate '
+                             'one for --subject)')
+    parser.add_argument('--stimdir', '-d', type=str,
+                        help='directory containing stimuli',
+                        default=STIMDIR)
+    parser.add_argument('--output', '-o', type=str,
+                        help='results directory',
+                        default=pjoin(PWD, 'sim'))
+    parser.add_argument('--metrics', type=str,
+                        help='save the metrics of each run to this json '
+                             'file')
+    parser.add_argument('--speed', type=float,
+                        help='how many times faster than real time',
+                        default=20.)
+    parser.add_argument('--refresh', type=float,
+                        help='refresh rate of the monitor (Hz)',
+                        default=60.)
+    parser.add_argument('--drop-rate', type=float,
+                        help='probability that a flip misses its retrace',
+                        default=0.)
+    parser.add_argument('--max-drop', type=int,
+                        help='maximum number of retraces missed',
+                        default=1)
+    parser.add_argument('--decode-time', type=float,
+                        help='time to open a clip (s)',
+                        default=0.05)
+    parser.add_argument('--slow-rate', type=float,
+                        help='fraction of the clips that are slow to open',
+                        default=0.)
+    parser.add_argument('--slow-time', type=float,
+                        help='time to open a slow clip (s)',
+                        default=1.)
+    parser.add_argument('--miss-rate', type=float,
+                        help='fraction of repetitions without a response',
+                        default=0.)
+    parser.add_argument('--false-alarm-rate', type=float,
+                        help='button presses per s not responding to a '
+                             'repetition',
+                        default=0.)
+    parser.add_argument('--keyboard', action='store_true',
+                        help='triggers and presses from the keyboard, as '
+                             'with run_localizer.py --no-scanner')
+    parser.add_argument('--lookahead', type=int,
+                        help='lookahead_blocks (default: from config.json)')
+    parser.add_argument('--seed', type=int,
+                        help='seed of the stimulus order and of the '
+                             'injected events',
+                        default=0)
+    profiling.add_profile_args(parser)
+    return parser.parse_args()
+
+
+if __name__ == '__main__':
+    main()
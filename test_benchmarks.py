@@ -0,0 +1,24 @@
+"""Test module for benchmarks"""
+from .benchmarks import run_benchmarks, compare, benchmark_id
+
+
+def test_run_benchmarks():
+    results = run_benchmarks([2], [12], [2], repeat=1, presentation=False,
+                             verbose=False)
+    assert results['grid']['runs'] == [2]
+    times = results['times']
+    assert benchmark_id('create_experiment', categories=2, stimuli=12,
+                        runs=2) == 'create_experiment[categories=2,runs=2,' \
+                                   'stimuli=12]'
+    assert 'create_experiment[categories=2,runs=2,stimuli=12]' in times
+    assert 'get_stimuli_manifest[categories=2,stimuli=12]' in times
+    assert all(t > 0 for t in times.values())
+
+
+def test_compare():
+    baseline = {'times': {'a': 1., 'b': 1., 'c': 1., 'd': 1.}}
+    current = {'times': {'a': 1.1, 'b': 1.5, 'c': 0.5, 'e': 1.}}
+    rows, missing = compare(baseline, current, threshold=0.2)
+    assert [(row[0], row[4]) for row in rows] == [
+        ('a', 'ok'), ('b', 'regression'), ('c', 'improvement')]
+    assert missing == ['d']
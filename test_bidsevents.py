@@ -0,0 +1,58 @@
+"""Test module for bidsevents"""
+import json
+import time
+from .bidsevents import EventWriter, sidecar_fn, events_name, COLUMNS
+
+
+def _read(fn):
+    with open(fn, 'rb') as f:
+        return [line.rstrip('\n').split('\t') for line in f]
+
+
+def test_events_name():
+    assert events_name('01', 2) == 'sub-01_task-localizer_run-2_events.tsv'
+    assert events_name('01', 2, acq='20171102T142349') == \
+        'sub-01_task-localizer_acq-20171102T142349_run-2_events.tsv'
+
+
+def test_event_writer(tmpdir):
+    fn = str(tmpdir.join(events_name('test', 1)))
+    writer = EventWriter(fn, flush_interval=10, queue_size=4)
+    writer.start()
+    with open(sidecar_fn(fn), 'rb') as f:
+        assert sorted(json.load(f)) == sorted(COLUMNS)
+    writer.add(0., 18., 'fixation')
+    writer.add(18., 3., 'faces', 'stimuli/faces/face_1.mp4')
+    writer.add(21., 3., 'faces', 'stimuli/faces/face_1.mp4', 1)
+    # nothing is written until the writer flushes
+    assert _read(fn) == [list(COLUMNS)]
+    writer.flush()
+    rows = _read(fn)
+    assert len(rows) == 4
+    assert rows[1] == ['0.000', '18.000', 'fixation', 'n/a', '0']
+    # a button press received after a later trial is sorted on close
+    writer.add(24., 3., 'faces', 'stimuli/faces/face_2.mp4')
+    writer.add(22.5, 0., 'button_press')
+    # once the queue is full, it is flushed rather than overwritten
+    for onset in range(27, 42, 3):
+        writer.add(onset, 3., 'faces', 'stimuli/faces/face_3.mp4')
+    assert len(_read(fn)) == 8
+    writer.close()
+    rows = _read(fn)
+    assert [row[0] for row in rows[1:6]] == \
+        ['0.000', '18.000', '21.000', '22.500', '24.000']
+    assert len(rows) == 11
+    assert writer.n_events == 10
+
+
+def test_event_writer_background(tmpdir):
+    fn = str(tmpdir.join('events.tsv'))
+    writer = EventWriter(fn, flush_interval=0.01)
+    writer.start()
+    writer.add(0., 18., 'fixation')
+    for _ in range(100):
+        if writer.n_events:
+            break
+        time.sleep(0.01)
+    assert len(_read(fn)) == 2
+    writer.close()
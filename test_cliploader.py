@@ -0,0 +1,163 @@
+"""Test module for cliploader"""
+import threading
+import time
+from .cliploader import split_blocks, ClipLoader, ClipPool
+
+
+def _run(ncat=3, nstim=2):
+    fixation = {'stim_type': 'fixation', 'stim_fn': None, 'duration': 18.}
+    run = [fixation]
+    for icat in range(ncat):
+        for istim in range(nstim):
+            run.append({'stim_type': 'cat{0}'.format(icat),
+                        'stim_fn': 'cat{0}_{1}.mp4'.format(icat, istim),
+                        'duration': 3.})
+    run.append(fixation)
+    return run
+
+
+def test_split_blocks():
+    run = _run()
+    # a repetition doesn't add a clip to the block
+    run.insert(2, dict(run[1]))
+    blocks, trial_block = split_blocks(run)
+    assert blocks == [['cat0_0.mp4', 'cat0_1.mp4'],
+                      ['cat1_0.mp4', 'cat1_1.mp4'],
+                      ['cat2_0.mp4', 'cat2_1.mp4']]
+    assert trial_block == [0, 0, 0, 0, 1, 1, 2, 2, 3]
+
+
+def test_clip_loader():
+    run = _run()
+    prepared = []
+    released = []
+    gate = threading.Event()
+
+    def prepare(stim_fn):
+        if stim_fn.startswith('cat2'):
+            gate.wait()
+        prepared.append(stim_fn)
+        return stim_fn.upper()
+
+    loader = ClipLoader(run, prepare, lambda fn, p: (fn, p),
+                        release=released.append, lookahead=1)
+    loader.preload()
+    assert prepared == ['cat0_0.mp4', 'cat0_1.mp4']
+    loader.start()
+    loader.set_trial(0)
+    assert loader.get(1, 'cat0_0.mp4') == ('cat0_0.mp4', 'CAT0_0.MP4')
+    # the next block is loaded in the background, but not further
+    while len(prepared) < 4:
+        time.sleep(0.001)
+    time.sleep(0.01)
+    assert len(prepared) == 4
+    loader.set_trial(3)
+    # prepared in the background, but its stimulus is only created at its
+    # onset: it counts as late
+    assert loader.get(3, 'cat1_0.mp4') == ('cat1_0.mp4', 'CAT1_0.MP4')
+    assert [late[:2] for late in loader.late] == [(3, 'cat1_0.mp4')]
+    # created beforehand by poll
+    loader.poll(limit=1)
+    loader.poll()
+    assert loader.get(4, 'cat1_1.mp4') == ('cat1_1.mp4', 'CAT1_1.MP4')
+    assert len(loader.late) == 1
+    del loader.late[:]
+    # the first block is released once we move on
+    assert released == [('cat0_0.mp4', 'CAT0_0.MP4'),
+                        ('cat0_1.mp4', 'CAT0_1.MP4')]
+    assert 'cat0_1.mp4' not in loader.loaded()
+    # cat2 isn't ready at its onset, and it is recorded
+    threading.Timer(0.05, gate.set).start()
+    loader.set_trial(5)
+    loader.get(5, 'cat2_0.mp4')
+    assert [late[:2] for late in loader.late] == [(5, 'cat2_0.mp4')]
+    loader.stop()
+    assert sorted(prepared) == sorted(sum(loader.blocks, []))
+
+
+def test_clip_pool():
+    evicted = []
+    pool = ClipPool(10, size_of=len, evict=evicted.append)
+    assert pool.take('a') is None
+    pool.put('a', 'aaaa')
+    pool.put('b', 'bbbb')
+    assert pool.take('a') == 'aaaa'
+    pool.put('a', 'aaaa')
+    # b is now the least recently used
+    pool.put('c', 'cccc')
+    assert evicted == ['bbbb']
+    assert 'b' not in pool
+    assert pool.nbytes == 8
+    assert pool.stats() == {'hits': 1, 'misses': 1, 'evictions': 1,
+                            'clips': 2, 'nbytes': 8}
+    pool.clear()
+    assert sorted(evicted) == ['aaaa', 'bbbb', 'cccc']
+    assert len(pool) == 0
+    # at most max_clips clips, whatever their size
+    evicted = []
+    pool = ClipPool(100, size_of=len, evict=evicted.append, max_clips=2)
+    for clip in ['a', 'b', 'c']:
+        pool.put(clip, clip)
+    assert evicted == ['a']
+    assert len(pool) == 2
+
+
+def test_clip_loader_pool():
+    run = _run()
+    prepared = []
+    released = []
+
+    def prepare(stim_fn):
+        prepared.append(stim_fn)
+        return stim_fn.upper()
+
+    pool = ClipPool(100, size_of=lambda clip: 1)
+    for _ in range(2):
+        loader = ClipLoader(run, prepare, lambda fn, p: (fn, p),
+                            release=released.append, pool=pool)
+        loader.preload()
+        for itrial, trial in enumerate(run):
+            loader.set_trial(itrial)
+            if trial['stim_fn'] is not None:
+                loader.get(itrial, trial['stim_fn'])
+        loader.stop()
+    # the second run is served from the pool
+    assert len(prepared) == 6
+    assert pool.hits == 6
+    assert len(pool) == 6
+    assert len(released) == 12
+
+
+def test_clip_loader_budget():
+    # 4 blocks of 2 clips of 1 byte, loaded as far ahead as the budget
+    # allows
+    run = _run(ncat=4)
+    pool = ClipPool(3, size_of=lambda clip: 1)
+    held = []
+
+    def check():
+        with loader._cond:
+            nloaded = len(set(loader._prepared) | set(loader._clips))
+        held.append(nloaded + len(pool))
+        assert pool.nbytes + pool.nbytes_in_use <= pool.budget
+
+    def prepare(stim_fn):
+        check()
+        return stim_fn.upper()
+
+    for _ in range(2):
+        loader = ClipLoader(run, prepare, lambda fn, p: (fn, p), pool=pool,
+                            lookahead=4)
+        loader.preload()
+        loader.start()
+        for itrial, trial in enumerate(run):
+            loader.set_trial(itrial)
+            if trial['stim_fn'] is not None:
+                assert loader.get(itrial, trial['stim_fn'])[0] == \
+                    trial['stim_fn']
+            time.sleep(0.01)
+            check()
+        loader.stop()
+    assert max(held) <= 3
+    assert len(pool) == 3
+    assert pool.nbytes_in_use == 0
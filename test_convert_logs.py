@@ -0,0 +1,85 @@
+"""Test module for convert_logs"""
+import os
+from .convert_logs import convert_tree, find_logs, parse_log, \
+    parse_log_name
+
+LOG = """\
+3.2001 \tINFO \tsome other message
+3.3002 \tBIDS \tonset\tduration\tstim_type\trepetition
+3.3003 \tBIDS \t0.000\t18.000\tfixation\tNone\t0
+21.3003 \tBIDS \t18.000\t3.000\tfaces\t./stimuli/faces/face_1.mp4\t0
+23.4003 \tBIDS \t20.491\t0.000\tbutton_press\tnull\t0
+24.3023 \tBIDS \t21.002\t3.000\tfaces\t./stimuli/faces/face_1.mp4\t1
+27.3023 \tBIDS \t24.102\t18.000\tfixation\tNone\t0
+"""
+
+
+def _write_log(res_dir, subj, name, content=LOG):
+    subj_dir = os.path.join(res_dir, 'sub-' + subj)
+    if not os.path.exists(subj_dir):
+        os.makedirs(subj_dir)
+    fn = os.path.join(subj_dir, name)
+    with open(fn, 'wb') as f:
+        f.write(content)
+    return fn
+
+
+def _read(fn):
+    with open(fn, 'rb') as f:
+        return [line.rstrip('\n').split('\t') for line in f]
+
+
+def test_convert_tree(tmpdir):
+    res_dir = str(tmpdir)
+    fn = _write_log(res_dir, 'a', 'sub-a_task-localizer_run-1_20171102T'
+                                  '142349.txt')
+    _write_log(res_dir, 'a', 'sub-a_task-localizer_run-2_20171102T'
+                             '143349__halted.txt')
+    _write_log(res_dir, 'b', 'sub-b_task-localizer_run-1_20171102T'
+                             '142349.txt', content='0.1 \tINFO \tnothing\n')
+    # run 1 of a was presented again, but halted
+    _write_log(res_dir, 'a', 'sub-a_task-localizer_run-1_20171102T'
+                             '150000__halted.txt')
+    assert len(find_logs(res_dir)) == 4
+    assert len(list(parse_log(fn))) == 5
+    assert parse_log_name(fn) == ('a', 'localizer', 1, '20171102T142349',
+                                  False)
+
+    reports = convert_tree(res_dir, n_jobs=2)
+    statuses = [report['status'] for report in reports]
+    assert statuses == ['warning', 'skipped', 'warning', 'error']
+    report = reports[0]
+    # events files have the BIDS name of the run
+    assert os.path.basename(report['events']) == \
+        'sub-a_task-localizer_run-1_events.tsv'
+    assert reports[1]['events'] == report['events']
+    assert reports[1]['problems'] == \
+        ['run converted from ' + os.path.basename(fn)]
+    assert report['n_trials'] == 4
+    assert report['n_button_presses'] == 1
+    assert report['problems'] == \
+        ['trial at 21.002s lasted 3.100s instead of 3.000s']
+    assert 'run was halted' in reports[2]['problems']
+    assert os.path.basename(reports[2]['events']) == \
+        'sub-a_task-localizer_run-2_events.tsv'
+
+    rows = _read(report['events'])
+    assert rows[0] == ['onset', 'duration', 'stim_type', 'stim_fn',
+                       'repetition']
+    assert rows[1:] == [
+        ['0.000', '18.000', 'fixation', 'n/a', '0'],
+        ['18.000', '3.002', 'faces', './stimuli/faces/face_1.mp4', '0'],
+        ['20.491', '0.000', 'button_press', 'n/a', '0'],
+        ['21.002', '3.100', 'faces', './stimuli/faces/face_1.mp4', '1'],
+        ['24.102', '18.000', 'fixation', 'n/a', '0'],
+    ]
+    assert os.path.exists(report['events'].replace('.tsv', '.json'))
+
+    # existing files are skipped, unless asked otherwise
+    reports = convert_tree(res_dir, n_jobs=1)
+    assert [r['status'] for r in reports] == \
+        ['skipped', 'skipped', 'skipped', 'error']
+    out_dir = str(tmpdir.join('out'))
+    reports = convert_tree(res_dir, out_dir=out_dir, n_jobs=1)
+    assert reports[0]['events'].startswith(os.path.join(out_dir, 'sub-a'))
+    assert _read(reports[0]['events']) == rows
@@ -0,0 +1,63 @@
+"""Test module for framecache"""
+import numpy as np
+from .framecache import save_frames, load_frames, is_cached, MemmapClip, \
+    cache_key, resample
+
+
+def _frames(n, size):
+    for i in range(n):
+        yield np.full((size[1], size[0], 3), i, dtype=np.uint8)
+
+
+def test_save_frames(tmpdir):
+    cache_dir = str(tmpdir)
+    size = (8, 6)
+    key = cache_key('abc', size)
+    assert key == 'abc_8x6'
+    assert not is_cached(cache_dir, key)
+    # fewer frames than requested are padded with the last one
+    save_frames(cache_dir, key, _frames(3, size), 5, size, 25.)
+    assert is_cached(cache_dir, key)
+    frames, meta = load_frames(cache_dir, key)
+    assert frames.shape == (5, 6, 8, 3)
+    assert meta['fps'] == 25.
+    assert list(frames[:, 0, 0, 0]) == [0, 1, 2, 2, 2]
+    # and more frames are truncated
+    save_frames(cache_dir, key, _frames(10, size), 4, size, 25.)
+    frames, meta = load_frames(cache_dir, key)
+    assert list(frames[:, 0, 0, 0]) == [0, 1, 2, 3]
+
+
+def test_memmap_clip(tmpdir):
+    cache_dir = str(tmpdir)
+    size = (8, 6)
+    save_frames(cache_dir, 'k', _frames(30, size), 30, size, 10.)
+    clip = MemmapClip(cache_dir, 'k')
+    assert clip.duration == 3.
+    assert clip.size == size
+    assert clip.get_frame(0.)[0, 0, 0] == 0
+    assert clip.get_frame(1.05)[0, 0, 0] == 10
+    assert clip.get_frame(10.)[0, 0, 0] == 29
+    # frames are views into the memory map, not copies
+    frame = clip.get_frame(0.5)
+    assert isinstance(frame.base, np.memmap) or \
+        isinstance(frame, np.memmap)
+    assert not frame.flags.writeable
+    # prefetching the start of the clip, or past its end
+    clip.prefetch()
+    clip.prefetch(10.)
+
+
+class _Clip(object):
+    """Clip of 1 s at 10 fps whose frames are their timestamps"""
+    duration = 1.
+
+    def get_frame(self, t):
+        return t
+
+
+def test_resample():
+    # resampled at 4 fps, stopping at the end of the clip
+    assert list(resample(_Clip(), 4., 12)) == [0., .25, .5, .75]
+    # and trimmed
+    assert list(resample(_Clip(), 4., 2)) == [0., .25]
@@ -1,13 +1,24 @@
 """Test module for make_stim_order"""
 import pytest
 from .make_stim_order import get_stimuli, create_run, \
-    inject_attention_check, create_experiment
+    inject_attention_check, create_experiment, generate_batch, \
+    generate_subject, make_schedule, load_schedule, out_fn
+from .manifest import update_manifest
 
 
-def test_get_stimuli():
+def test_get_stimuli(tmpdir, monkeypatch):
     # smoketest
     stimuli = get_stimuli()
     assert len(stimuli) > 0
+    # the same stimuli as from a manifest, without hashing them
+    assert stimuli == get_stimuli(
+        manifest_fn=str(tmpdir.join('manifest.json')))
+    from . import manifest
+
+    def no_hash(fn):
+        raise AssertionError("{0} was hashed".format(fn))
+    monkeypatch.setattr(manifest, 'file_hash', no_hash)
+    assert get_stimuli() == stimuli
 
 
 def test_create_run():
@@ -84,3 +95,62 @@ def test_inject_attention_check():
     for run in exp_inj.itervalues():
         assert sum(map(lambda x: x.get('repetition', 0), run)) == 5
 
+
+def test_generate_batch(tmpdir):
+    stimuli = get_stimuli()
+    subids = ['b01', 'b02', 'b03']
+    out_dir = str(tmpdir)
+    done, failed = generate_batch(subids, stimuli, 2, out_dir, n_jobs=2)
+    assert not failed
+    assert sorted(done) == subids
+    contents = dict()
+    for subid, fn in done.iteritems():
+        with open(fn, 'rb') as f:
+            contents[subid] = f.read()
+    # same seeds -> same schedules, regardless of the number of jobs
+    done, failed = generate_batch(subids, stimuli, 2, out_dir,
+                                  overwrite=True, n_jobs=1)
+    for subid, fn in done.iteritems():
+        with open(fn, 'rb') as f:
+            assert f.read() == contents[subid], subid
+    assert contents['b01'] != contents['b02']
+    # existing files are reported as failures, not raised
+    done, failed = generate_batch(subids, stimuli, 2, out_dir, n_jobs=2)
+    assert not done
+    assert sorted(failed) == subids
+
+
+def test_generate_subject_cache(tmpdir):
+    stimuli = get_stimuli()
+    cache_dir = str(tmpdir.join('cache'))
+    fn = generate_subject('c01', stimuli, 2, str(tmpdir), cache_dir=cache_dir)
+    with open(fn, 'rb') as f:
+        content = f.read()
+    # without cache, the same schedule is generated
+    fn = generate_subject('c01', stimuli, 2, str(tmpdir), overwrite=True)
+    with open(fn, 'rb') as f:
+        assert f.read() == content
+    # a different set of stimuli gives a different schedule
+    stimuli_ = {cat: stims + [cat + '/new.mp4']
+                for cat, stims in stimuli.items()}
+    fn = generate_subject('c01', stimuli_, 2, str(tmpdir), overwrite=True,
+                          cache_dir=cache_dir)
+    with open(fn, 'rb') as f:
+        assert f.read() != content
+    assert len(tmpdir.join('cache').listdir('*.json')) == 2
+
+
+def test_make_schedule(tmpdir):
+    manifest = update_manifest('stimuli')
+    cache_dir = str(tmpdir.join('cache'))
+    schedule = make_schedule('m01', 2, manifest, out_dir=str(tmpdir),
+                             cache_dir=cache_dir)
+    assert len(schedule) == 2
+    assert schedule.validate() == []
+    fn = str(tmpdir.join(out_fn('m01', 2)))
+    assert load_schedule(fn) == schedule
+    # from the cache, and without the cache
+    assert make_schedule('m01', 2, manifest, cache_dir=cache_dir) == schedule
+    assert make_schedule('m01', 2, manifest, cache_dir=None) == schedule
+    with pytest.raises(ValueError):
+        make_schedule('m01', 2, manifest, out_dir=str(tmpdir))
@@ -0,0 +1,84 @@
+"""Test module for manifest"""
+import os
+from os.path import join as pjoin
+from .manifest import update_manifest, manifest_stimuli, load_manifest
+
+
+def _touch(fn, content='x'):
+    with open(fn, 'wb') as f:
+        f.write(content)
+
+
+def test_update_manifest(tmpdir):
+    stim_dir = str(tmpdir.mkdir('stimuli'))
+    for cat in ['faces', 'bodies']:
+        os.mkdir(pjoin(stim_dir, cat))
+        for i in range(3):
+            _touch(pjoin(stim_dir, cat, '{0}_{1}.mp4'.format(cat, i)), cat)
+    manifest_fn = str(tmpdir.join('manifest.json'))
+    manifest = update_manifest(stim_dir, manifest_fn)
+    assert load_manifest(manifest_fn) == manifest
+    stimuli = manifest_stimuli(manifest, start=str(tmpdir))
+    assert sorted(stimuli) == ['bodies', 'faces']
+    assert stimuli['faces'] == ['stimuli/faces/faces_{0}.mp4'.format(i)
+                                for i in range(3)]
+    files = manifest['categories']['faces']['files']
+    assert files['faces_0.mp4']['size'] == 5
+    assert files['faces_0.mp4']['hash'] == files['faces_1.mp4']['hash']
+
+
+def test_update_manifest_incremental(tmpdir, monkeypatch):
+    from . import manifest as manifest_mod
+    stim_dir = str(tmpdir.mkdir('stimuli'))
+    for cat in ['faces', 'bodies']:
+        os.mkdir(pjoin(stim_dir, cat))
+        _touch(pjoin(stim_dir, cat, 'a.mp4'))
+    manifest_fn = str(tmpdir.join('manifest.json'))
+    update_manifest(stim_dir, manifest_fn)
+
+    hashed = []
+    file_hash = manifest_mod.file_hash
+
+    def counting_hash(fn):
+        hashed.append(fn)
+        return file_hash(fn)
+    monkeypatch.setattr(manifest_mod, 'file_hash', counting_hash)
+
+    # nothing changed, nothing is hashed
+    update_manifest(stim_dir, manifest_fn)
+    assert hashed == []
+    # a new file in faces: only that one is hashed
+    _touch(pjoin(stim_dir, 'faces', 'b.mp4'))
+    os.utime(pjoin(stim_dir, 'faces'), (0, 1))
+    manifest = update_manifest(stim_dir, manifest_fn)
+    assert hashed == [pjoin(stim_dir, 'faces', 'b.mp4')]
+    assert sorted(manifest['categories']['faces']['files']) == \
+        ['a.mp4', 'b.mp4']
+    # a clip overwritten in place: the directory mtime doesn't change, but
+    # the clip is hashed again
+    old_hash = manifest['categories']['faces']['files']['a.mp4']['hash']
+    del hashed[:]
+    _touch(pjoin(stim_dir, 'faces', 'a.mp4'), 'new content')
+    os.utime(pjoin(stim_dir, 'faces'), (0, 1))
+    manifest = update_manifest(stim_dir, manifest_fn)
+    assert hashed == [pjoin(stim_dir, 'faces', 'a.mp4')]
+    assert manifest['categories']['faces']['files']['a.mp4']['hash'] != \
+        old_hash
+    assert load_manifest(manifest_fn) == manifest
+    # removing a category
+    os.remove(pjoin(stim_dir, 'bodies', 'a.mp4'))
+    os.rmdir(pjoin(stim_dir, 'bodies'))
+    os.utime(stim_dir, (0, 1))
+    manifest = update_manifest(stim_dir, manifest_fn)
+    assert sorted(manifest['categories']) == ['faces']
+    assert load_manifest(manifest_fn) == manifest
+
+
+def test_dangling_symlink(tmpdir):
+    stim_dir = str(tmpdir.mkdir('stimuli'))
+    os.mkdir(pjoin(stim_dir, 'faces'))
+    os.symlink('../.git/annex/objects/SHA256E-s1--abc.mp4',
+               pjoin(stim_dir, 'faces', 'a.mp4'))
+    manifest = update_manifest(stim_dir)
+    entry = manifest['categories']['faces']['files']['a.mp4']
+    assert entry['hash'].startswith('link-')
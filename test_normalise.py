@@ -0,0 +1,51 @@
+"""Test module for normalise"""
+import os
+from os.path import join as pjoin
+import numpy as np
+from .framecache import save_frames, cache_key
+from .manifest import update_manifest, save_manifest, load_manifest
+from .normalise import clip_changes, cached_decode_cost, normalise_stimuli
+
+
+def test_clip_changes():
+    source = {'size': [1920, 1080], 'fps': 25., 'duration': 3.4}
+    assert clip_changes(source, (1280, 940), 30., 3.) == [
+        'resized 1920x1080 -> 1280x940', 'resampled 25 -> 30 fps',
+        'trimmed 3.40 -> 3 s']
+    source = {'size': [1280, 940], 'fps': 30., 'duration': 2.5}
+    assert clip_changes(source, (1280, 940), 30., 3.) == [
+        'padded 2.50 -> 3 s']
+    source['duration'] = 3.
+    assert clip_changes(source, (1280, 940), 30., 3.) == []
+
+
+def test_normalise_stimuli(tmpdir):
+    stim_dir = str(tmpdir.mkdir('stimuli'))
+    os.mkdir(pjoin(stim_dir, 'faces'))
+    with open(pjoin(stim_dir, 'faces', 'a.mp4'), 'wb') as f:
+        f.write('not a movie')
+    manifest_fn = str(tmpdir.join('manifest.json'))
+    cache_dir = str(tmpdir.join('cache'))
+    size = (8, 6)
+    manifest = update_manifest(stim_dir, manifest_fn)
+    info = manifest['categories']['faces']['files']['a.mp4']
+    key = cache_key(info['hash'], size)
+    frames = (np.zeros((6, 8, 3), dtype=np.uint8) for _ in range(30))
+    save_frames(cache_dir, key, frames, 30, size, 10.)
+    assert cached_decode_cost(cache_dir, key) >= 0.
+    info['normalised'] = {
+        'key': key, 'size': list(size), 'fps': 10., 'duration': 3.,
+        'nframes': 30, 'changes': [],
+        'decode_ms_per_frame': {'before': 1., 'after': .1}}
+    save_manifest(manifest, manifest_fn)
+    # normalised with the same settings: skipped
+    results = normalise_stimuli(stim_dir, cache_dir, manifest_fn, size,
+                                fps=10., duration=3., n_jobs=1)
+    assert [r[1] for r in results] == ['unchanged']
+    # other settings: normalised again, which fails for this file and drops
+    # the entry from the manifest
+    results = normalise_stimuli(stim_dir, cache_dir, manifest_fn, size,
+                                fps=30., duration=3., n_jobs=1)
+    assert [r[1] for r in results] == ['failed']
+    files = load_manifest(manifest_fn)['categories']['faces']['files']
+    assert 'normalised' not in files['a.mp4']
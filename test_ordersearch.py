@@ -0,0 +1,49 @@
+"""Test module for ordersearch"""
+import random
+import numpy as np
+from .ordersearch import williams_square, initial_orders, random_orders, \
+    imbalance, anneal, search_orders
+
+
+def test_williams_square():
+    for n in (4, 5, 6):
+        square = williams_square(n)
+        assert len(square) == (n if n % 2 == 0 else 2 * n)
+        # every category follows every other one equally often
+        trans = np.zeros((n, n), dtype=int)
+        for row in square:
+            np.add.at(trans, (row[:-1], row[1:]), 1)
+        off_diagonal = trans[~np.eye(n, dtype=bool)]
+        assert (off_diagonal == off_diagonal[0]).all()
+        assert (np.diag(trans) == 0).all()
+        # runs are mirrored, so a full square is perfectly balanced
+        assert imbalance(square) == 0
+
+
+def test_anneal_improves():
+    rng = random.Random(0)
+    orders = random_orders(5, 4, 10, np.random.RandomState(0))
+    start = imbalance(orders)
+    best, score = anneal(orders, budget=None, max_iter=5000, rng=rng)
+    assert best.shape == (10, 4, 5)
+    assert (np.sort(best, axis=2) == np.arange(5)).all()
+    assert abs(score - imbalance(best)) < 1e-6
+    assert score < start
+    # reproducible with a number of iterations
+    best2, score2 = anneal(orders, budget=None, max_iter=5000,
+                           rng=random.Random(0))
+    assert (best == best2).all()
+    assert imbalance(initial_orders(5, 4, 10, rng)) <= start
+    # a single category can't be reordered
+    orders = initial_orders(1, 4, 2, rng)
+    best, score = anneal(orders, budget=None, max_iter=10, rng=rng)
+    assert (best == orders).all()
+    assert score == imbalance(orders)
+
+
+def test_search_orders():
+    orders, score = search_orders(4, 4, budget=None, max_iter=2000,
+                                  restarts=2, n_jobs=2)
+    assert orders.shape == (1, 4, 4)
+    # 4 runs of 4 categories can be perfectly balanced
+    assert score == 0
@@ -0,0 +1,66 @@
+"""Test module for profiling"""
+import json
+import pytest
+from . import profiling
+from .make_stim_order import get_stimuli, generate_subject
+from .profiling import Profiler, PhaseTimer, NULL_SPAN, format_report
+
+
+def test_profiler(tmpdir):
+    now = [0.]
+    profiler = Profiler('test', enabled=True, clock=lambda: now[0])
+    for _ in range(2):
+        with profiler.span('outer'):
+            now[0] += 1.
+            with profiler.span('inner'):
+                now[0] += 2.
+    profiler.add('phase', 0.5)
+    with pytest.raises(ZeroDivisionError):
+        with profiler.span('failing'):
+            1 / 0
+    report = profiler.report()
+    spans = dict((s['path'], s) for s in report['spans'])
+    assert sorted(spans) == ['failing', 'outer', 'outer/inner', 'phase']
+    assert spans['outer']['count'] == 2
+    assert spans['outer']['total'] == 6.
+    assert spans['outer']['self'] == 2.
+    assert spans['outer/inner']['mean'] == 2.
+    assert [s['path'] for s in report['timeline']] == \
+        ['outer', 'outer', 'phase', 'failing']
+    assert report['total'] == 6.
+    fn = profiler.save(str(tmpdir))
+    with open(fn, 'rb') as f:
+        assert json.load(f)['spans'] == report['spans']
+    assert len(format_report(report)) == len(spans) + 2
+    # nothing is recorded when disabled
+    profiler = Profiler('test')
+    assert profiler.span('outer') is NULL_SPAN
+    with profiler.span('outer'):
+        profiler.add('phase', 0.5)
+    assert profiler.report()['spans'] == []
+
+
+def test_phase_timer():
+    now = [10.]
+    timer = PhaseTimer(t0=9., clock=lambda: now[0])
+    assert timer.mark('imports') == 1.
+    now[0] = 15.
+    timer.mark('dialog')
+    now[0] = 15.5
+    timer.mark('window')
+    assert timer.phases == [('imports', 1.), ('dialog', 5.), ('window', .5)]
+    assert timer.total() == 6.5
+    lines = timer.report(exclude=['dialog'])
+    assert len(lines) == 4
+    assert 'not counted' in lines[1]
+    assert lines[-1].split() == ['total', '1.500s']
+
+
+def test_generate_subject_spans(tmpdir, monkeypatch):
+    profiler = Profiler('test', enabled=True)
+    monkeypatch.setattr(profiling, 'PROFILER', profiler)
+    with profiling.span('generate'):
+        generate_subject('001', get_stimuli(), 4, str(tmpdir))
+    paths = [s['path'] for s in profiler.report()['spans']]
+    assert paths == ['generate', 'generate/create', 'generate/inject',
+                     'generate/save', 'generate/validate']
@@ -0,0 +1,53 @@
+"""Test module for registry"""
+import pytest
+from .registry import SessionRegistry
+
+
+def test_runs(tmpdir):
+    fn = str(tmpdir.join('sessions.sqlite'))
+    registry = SessionRegistry(fn)
+    assert registry.last_session() is None
+    assert registry.next_run('sid01') == 1
+    run_id = registry.start_run('sid01', 1, log_fn='run1.txt')
+    # started but not completed: present it again
+    assert registry.next_run('sid01') == 1
+    registry.finish_run(run_id)
+    assert registry.next_run('sid01') == 2
+    run_id = registry.start_run('sid01', 2)
+    registry.finish_run(run_id, 'halted')
+    assert registry.next_run('sid01') == 2
+    registry.start_run('sid02', 1)
+    registry.close()
+
+    # persisted
+    registry = SessionRegistry(fn)
+    last = registry.last_session()
+    assert (last['subject_id'], last['run_nr'], last['status']) == \
+        ('sid02', 1, 'started')
+    assert [r['run_nr'] for r in registry.runs('sid01')] == [1, 2]
+    assert [r['log_fn'] for r in registry.runs('sid01', 'completed')] == \
+        ['run1.txt']
+    assert [r['run_nr'] for r in registry.runs('sid01', 'halted')] == [2]
+    with pytest.raises(ValueError):
+        registry.finish_run(run_id, 'done')
+    # all the runs completed
+    registry.finish_run(registry.start_run('sid01', 2))
+    assert registry.next_run('sid01') == 3
+    assert registry.next_run('sid01', nruns=2) is None
+    assert registry.next_run('sid01', nruns=3) == 3
+
+
+def test_import_tsv(tmpdir):
+    tsv = tmpdir.join('subjectlog.tsv')
+    tsv.write('subject_id\trun_nr\ttimestamp\n'
+              'sid01\t1\t2018-01-01T10:00:00\n'
+              'sid01\t2\t2018-01-01T10:05:00\n'
+              'sid02\t1\t2018-01-02T10:00:00\n')
+    registry = SessionRegistry(str(tmpdir.join('sessions.sqlite')))
+    assert registry.import_tsv(str(tsv)) == 3
+    # only once
+    assert registry.import_tsv(str(tsv)) == 0
+    assert registry.next_run('sid01') == 3
+    assert registry.next_run('sid02') == 2
+    assert registry.last_session()['subject_id'] == 'sid02'
+    assert len(registry.runs('sid01', 'imported')) == 2
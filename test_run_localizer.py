@@ -0,0 +1,28 @@
+"""Test module for run_localizer"""
+import os
+import subprocess
+import sys
+
+
+def test_import_is_headless():
+    # importing has no side effects and doesn't need psychopy
+    from . import run_localizer
+    assert 'psychopy' not in sys.modules
+    assert 'moviestim' not in sys.modules
+    assert run_localizer.core is None
+    assert run_localizer.STARTUP.phases == []
+    assert run_localizer._config is None
+    assert os.path.exists(run_localizer.CONFIG_FN)
+    assert run_localizer.get_config()['nruns'] > 0
+
+
+def test_import_is_light():
+    # the schedule and timing modules (and numpy) are imported when used;
+    # checked in a new interpreter, as other tests import them
+    code = ('import sys, run_localizer; '
+            'print(sorted(set(sys.modules) & set(["numpy", "timing", '
+            '"make_stim_order", "schedulefile", "cProfile"])))')
+    out = subprocess.check_output(
+        [sys.executable, '-c', code],
+        cwd=os.path.dirname(os.path.abspath(__file__)))
+    assert out.strip() == '[]'
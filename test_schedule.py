@@ -0,0 +1,102 @@
+"""Test module for schedule"""
+import numpy as np
+import pytest
+from .schedule import Schedule, BLOCK_LENGTH
+
+
+def make_stimuli(ncat=5, nstims=14):
+    return {'cat{0}'.format(i): ['cat{0}/{1:02d}.mp4'.format(i, j)
+                                 for j in range(nstims + i)]
+            for i in range(ncat)}
+
+
+def test_create_validate():
+    stimuli = make_stimuli()
+    rng = np.random.RandomState(0)
+    schedule = Schedule.create(stimuli, 200, rng)
+    assert schedule.runs.shape == (200, 3 + 2 * 5 * BLOCK_LENGTH)
+    assert schedule.validate() == []
+    runs = schedule.to_json()
+    assert sorted(runs) == range(1, 201)
+    assert runs[1][0] == {'stim_type': 'fixation', 'duration': 18.,
+                          'stim_fn': None}
+    # the category order and the clips change across runs
+    assert len(set(tuple(run['stim_type'][1::BLOCK_LENGTH][:5])
+                   for run in schedule.runs)) > 1
+    assert runs[1] != runs[2]
+    # same seed, same schedule
+    assert Schedule.create(stimuli, 200, np.random.RandomState(0)) == schedule
+
+    with pytest.raises(ValueError):
+        Schedule.create(make_stimuli(nstims=11), 1)
+
+
+def test_inject_validate():
+    stimuli = make_stimuli()
+    schedule = Schedule.create(stimuli, 100, np.random.RandomState(1))
+    injected = schedule.inject_attention_check(
+        rng=np.random.RandomState(2))
+    assert injected != schedule
+    assert not schedule.runs['repetition'].any()
+    assert injected.validate() == []
+    repetition = injected.runs['repetition'].astype(bool)
+    assert (repetition.sum(axis=1) == 5).all()
+    # one repetition per category per run, never on the first trial of a
+    # block
+    for run, rep in zip(injected.runs, repetition):
+        assert sorted(run['stim_type'][rep]) == range(1, 6)
+        assert (run['stim_type'][np.nonzero(rep)[0] - 1] ==
+                run['stim_type'][rep]).all()
+    # both halves of the run get repetitions
+    ntrials = injected.runs.shape[1]
+    first = repetition[:, :ntrials // 2].sum(axis=1)
+    assert set(first) <= set([2, 3])
+
+    # broken schedules are reported
+    broken = injected.copy()
+    broken.runs['stim_idx'][3, 5] = broken.runs['stim_idx'][3, 1]
+    broken.runs['repetition'][3, 5] = 0
+    broken.runs['duration'][7, 0] = 3.
+    assert [irun for irun, _ in broken.validate()] == [4, 8]
+
+
+def test_json_roundtrip():
+    schedule = Schedule.create(make_stimuli(), 4, np.random.RandomState(3))
+    schedule = schedule.inject_attention_check(
+        rng=np.random.RandomState(3))
+    exp = schedule.to_json()
+    loaded = Schedule.from_json(exp)
+    assert loaded.to_json() == exp
+    assert loaded.validate() == []
+    # json keys are strings
+    exp_str = {str(irun): run for irun, run in exp.items()}
+    assert Schedule.from_json(exp_str).to_json() == exp
+    assert loaded.run(2) == exp[2]
+
+
+def test_inject_counterbalanced():
+    stimuli = make_stimuli(ncat=4)
+    schedule = Schedule.create(stimuli, 10, np.random.RandomState(4))
+    for nchecks in (1, 6, 12):
+        injected = schedule.inject_attention_check(
+            nchecks, rng=np.random.RandomState(nchecks))
+        assert injected.validate() == []
+        repetition = injected.runs['repetition'].astype(bool)
+        assert (repetition.sum(axis=1) == nchecks).all()
+        # repetitions never follow each other
+        assert not (repetition[:, 1:] & repetition[:, :-1]).any()
+        # categories are counterbalanced across the experiment
+        counts = np.bincount(injected.runs['stim_type'][repetition])[1:]
+        assert counts.max() - counts.min() <= 1, nchecks
+    with pytest.raises(ValueError):
+        schedule.inject_attention_check(28)
+
+
+def test_create_orders():
+    orders = np.array([[0, 1, 2], [2, 1, 0]])
+    schedule = Schedule.create(make_stimuli(ncat=3), 2, orders=orders)
+    assert schedule.validate() == []
+    blocks = schedule.runs['stim_type'][:, 1:3 * BLOCK_LENGTH:BLOCK_LENGTH]
+    assert (blocks == orders + 1).all()
+    with pytest.raises(ValueError):
+        Schedule.create(make_stimuli(ncat=3), 2, orders=[[0, 1, 1]] * 2)
@@ -0,0 +1,51 @@
+"""Test module for schedulecache"""
+import threading
+import time
+from .schedulecache import stimuli_digest, schedule_key, get_or_create
+
+
+def test_schedule_key():
+    stimuli = {'a': ['a/1.mp4', 'a/2.mp4'], 'b': ['b/1.mp4']}
+    digest = stimuli_digest(stimuli)
+    assert digest == stimuli_digest({'b': ['b/1.mp4'],
+                                     'a': ['a/2.mp4', 'a/1.mp4']})
+    # content changes invalidate the key
+    hashes = {'a/1.mp4': 'x', 'a/2.mp4': 'y', 'b/1.mp4': 'z'}
+    assert stimuli_digest(stimuli, hashes) != digest
+    hashes2 = dict(hashes, **{'b/1.mp4': 'w'})
+    assert stimuli_digest(stimuli, hashes) != stimuli_digest(stimuli, hashes2)
+    key = schedule_key('01', 4, digest)
+    assert key == schedule_key('01', 4, digest, seed=0)
+    for other in (schedule_key('02', 4, digest),
+                  schedule_key('01', 2, digest),
+                  schedule_key('01', 4, stimuli_digest(stimuli, hashes)),
+                  schedule_key('01', 4, digest, seed=1),
+                  schedule_key('01', 4, digest, nchecks=2)):
+        assert other != key
+
+
+def test_get_or_create(tmpdir):
+    cache_dir = str(tmpdir.join('cache'))
+    calls = []
+
+    def create():
+        calls.append(1)
+        time.sleep(0.2)
+        return {1: [{'stim_type': 'fixation'}]}
+
+    results = []
+
+    def request():
+        results.append(get_or_create(cache_dir, 'abc', create))
+
+    threads = [threading.Thread(target=request) for _ in range(4)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    # concurrent requests: only one generates
+    assert len(calls) == 1
+    assert len(set(fn for fn, _ in results)) == 1
+    assert sorted(cached for _, cached in results) == [False] + [True] * 3
+    fn, cached = get_or_create(cache_dir, 'abc', create)
+    assert cached and len(calls) == 1
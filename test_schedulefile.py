@@ -0,0 +1,76 @@
+"""Test module for schedulefile"""
+import json
+import numpy as np
+import pytest
+from .make_stim_order import get_stimuli, load_schedule, generate_subject
+from . import schedulefile
+from .schedule import Schedule, TRIAL_DTYPE, FIXATION
+from .schedulefile import ScheduleFile, save_schedule_file, \
+    load_schedule_file, is_schedule_file
+
+
+def test_schedule_file(tmpdir):
+    schedule = Schedule.create(get_stimuli(), 6, np.random.RandomState(0))
+    schedule = schedule.inject_attention_check(rng=np.random.RandomState(1))
+    fn = str(tmpdir.join('exp.sched'))
+    save_schedule_file(schedule, fn)
+    assert is_schedule_file(fn)
+    with pytest.raises(ValueError):
+        save_schedule_file(schedule, fn)
+    # lossless, also through the json format
+    assert load_schedule_file(fn) == schedule
+    json_fn = str(tmpdir.join('exp.json'))
+    with open(json_fn, 'wb') as f:
+        json.dump(load_schedule_file(fn).to_json(), f)
+    assert not is_schedule_file(json_fn)
+    assert load_schedule(json_fn) == schedule
+    assert load_schedule(fn) == schedule
+    # single runs
+    sched_file = ScheduleFile(fn)
+    assert len(sched_file) == 6
+    for irun in range(1, 7):
+        assert sched_file.run(irun) == schedule.run(irun)
+    with pytest.raises(IndexError):
+        sched_file.run(7)
+    with pytest.raises(ValueError):
+        ScheduleFile(json_fn)
+
+
+def test_many_categories(tmpdir, monkeypatch):
+    # more categories than fit in a byte
+    categories = (FIXATION,) + tuple('cat{0}'.format(i) for i in range(300))
+    stimuli = tuple(cat + '.mp4' for cat in categories[1:])
+    runs = np.zeros((1, 300), dtype=TRIAL_DTYPE)
+    runs['stim_type'] = np.arange(1, 301)
+    runs['stim_idx'] = np.arange(300)
+    runs['duration'] = 3.
+    schedule = Schedule(categories, stimuli, runs)
+    assert Schedule.from_json(schedule.to_json()) == schedule
+    fn = str(tmpdir.join('exp.sched'))
+    save_schedule_file(schedule, fn)
+    assert load_schedule_file(fn) == schedule
+    assert ScheduleFile(fn).run(1)[-1]['stim_type'] == 'cat299'
+    # files in the previous format version are still read
+    schedule = Schedule.create(get_stimuli(), 2, np.random.RandomState(0))
+    monkeypatch.setattr(schedulefile, 'FORMAT_VERSION', 1)
+    monkeypatch.setattr(schedulefile, 'FILE_DTYPE',
+                        schedulefile.FILE_DTYPES[1])
+    save_schedule_file(schedule, fn, overwrite=True)
+    monkeypatch.undo()
+    assert load_schedule_file(fn) == schedule
+
+
+def test_generate_subject_binary(tmpdir):
+    stimuli = get_stimuli()
+    out_dir = str(tmpdir)
+    fn = generate_subject('001', stimuli, 4, out_dir, binary=True)
+    assert fn.endswith('.sched')
+    json_fn = generate_subject('001', stimuli, 4, out_dir)
+    assert load_schedule(fn) == load_schedule(json_fn)
+    # also when copied from the cache
+    cache_dir = str(tmpdir.mkdir('cache'))
+    fn = generate_subject('002', stimuli, 4, out_dir, binary=True,
+                          cache_dir=cache_dir)
+    assert is_schedule_file(fn)
+    assert load_schedule(fn) == load_schedule(
+        generate_subject('002', stimuli, 4, out_dir))
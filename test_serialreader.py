@@ -0,0 +1,79 @@
+"""Test module for serialreader"""
+import time
+from .serialreader import PtySerial, SerialReader
+
+
+def test_serial_reader():
+    port = PtySerial(timeout=0.01)
+    reader = SerialReader(port, clock=time.time)
+    reader.start()
+    try:
+        assert reader.wait_for_trigger(timeout=0.05) is None
+        tstart = time.time()
+        port.write('5')
+        t_trigger = reader.wait_for_trigger(timeout=1)
+        assert tstart <= t_trigger <= time.time()
+        time.sleep(0.05)
+        t_press = time.time()
+        port.write('1')
+        time.sleep(0.05)
+        port.write('5')
+        time.sleep(0.05)
+        events = reader.drain()
+        assert [byte for _, byte in events] == ['5', '1', '5']
+        # bytes are timestamped when they arrive, not when drained
+        assert abs(events[1][0] - t_press) < 0.02
+        assert reader.n_triggers == 2
+        assert reader.trigger_time == t_trigger
+        assert reader.drain() == []
+    finally:
+        reader.stop()
+        port.close()
+
+
+def test_pump():
+    port = PtySerial(timeout=0.01)
+    pumped = []
+
+    def pump():
+        pumped.append(1)
+        if len(pumped) == 3:
+            port.write('5')
+    port.pump = pump
+    reader = SerialReader(port, clock=time.time)
+    reader.start()
+    try:
+        assert reader.wait_for_trigger(timeout=1) is not None
+        assert len(pumped) >= 3
+    finally:
+        reader.stop()
+        port.close()
+
+
+class _Keys(object):
+    """Port that is only pumped, like the keyboard"""
+    def __init__(self, presses):
+        self.presses = presses
+
+    def pump(self):
+        return self.presses.pop(0) if self.presses else []
+
+    def close(self):
+        pass
+
+
+def test_pump_timestamps():
+    port = _Keys([[(1., '1'), (2., '5')], [], [(3., '2')]])
+    reader = SerialReader(port, clock=time.time)
+    assert reader.needs_pump
+    # there is nothing to read in a thread
+    reader.start()
+    assert reader._thread is None
+    reader.pump()
+    assert reader.trigger_time == 2.
+    # pumped events keep their timestamps
+    assert reader.drain() == [(1., '1'), (2., '5')]
+    reader.pump()
+    assert reader.drain() == [(3., '2')]
+    assert reader.n_triggers == 1
+    port.close()
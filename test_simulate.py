@@ -0,0 +1,86 @@
+"""Test module for simulate"""
+import os
+import sys
+from .convert_logs import parse_log
+from .registry import SessionRegistry
+from .simulate import Scenario, simulate_run
+
+
+def _trials():
+    trials = [{'stim_type': 'fixation', 'stim_fn': None, 'duration': 1.,
+               'repetition': 0}]
+    for cat in ['faces', 'houses']:
+        trials += [
+            {'stim_type': cat, 'stim_fn': 'stimuli/{0}/a.mp4'.format(cat),
+             'duration': 1., 'repetition': 0},
+            {'stim_type': cat, 'stim_fn': 'stimuli/{0}/a.mp4'.format(cat),
+             'duration': 1., 'repetition': 1},
+            {'stim_type': 'fixation', 'stim_fn': None, 'duration': 1.,
+             'repetition': 0},
+        ]
+    return trials
+
+
+def _events(fn):
+    with open(fn, 'rb') as f:
+        f.readline()
+        return [row.rstrip('\n').split('\t') for row in f]
+
+
+def test_simulate_run(tmpdir):
+    trials = _trials()
+    scenario = Scenario(speed=20., rt_sd=0., trigger_delay=0.1)
+    metrics = simulate_run(trials, str(tmpdir), 'sim', 1, scenario)
+    assert 'psychopy' not in sys.modules
+    # the run is faster than real time
+    assert metrics['duration'] >= 7.
+    assert metrics['real_time'] < metrics['duration']
+    assert metrics['n_triggers'] >= 7
+    # all the trials and a press after each repetition are in the events
+    assert os.path.basename(metrics['events_fn']) == \
+        'sub-sim_task-localizer_run-1_events.tsv'
+    events = _events(metrics['events_fn'])
+    stim_types = [row[2] for row in events]
+    assert stim_types.count('button_press') == 2
+    assert [t for t in stim_types if t != 'button_press'] == \
+        [trial['stim_type'] for trial in trials]
+    assert metrics['injected']['button_presses'] == 2
+    assert metrics['injected']['clips_opened'] == 2
+    assert metrics['late_clips'] == []
+    assert metrics['onsets']['max_abs_error'] < 0.25
+    assert max(metrics['press_delays']) < 0.1
+    assert metrics['frames']['n_flips'] > 0
+    # the log has the same events, and the run is in the registry
+    assert len(list(parse_log(metrics['log_fn']))) == len(events)
+    registry = SessionRegistry(str(tmpdir.join('sessions.sqlite')))
+    assert registry.next_run('sim') == 2
+    registry.close()
+
+
+def test_simulate_slow_clips(tmpdir):
+    # the second block takes longer to open than the first one lasts
+    scenario = Scenario(speed=50., trigger_delay=0.1, slow_rate=1.,
+                        slow_time=5.)
+    metrics = simulate_run(_trials(), str(tmpdir), 'sim', 1, scenario)
+    assert len(metrics['injected']['slow_clips']) == 2
+    late = metrics['late_clips']
+    assert [stim_fn for _, stim_fn, _ in late] == ['stimuli/houses/a.mp4']
+    # waited in simulated time
+    assert late[0][2] > 1.
+    assert metrics['warnings']
+
+
+def test_simulate_keyboard(tmpdir):
+    # presses during fixation are timestamped when they happen, not at the
+    # next trial
+    scenario = Scenario(speed=20., trigger_delay=0.1, keyboard=True,
+                        false_alarm_rate=2., seed=1)
+    trials = _trials()
+    for trial in trials:
+        if trial['stim_type'] == 'fixation':
+            trial['duration'] = 3.
+    metrics = simulate_run(trials, str(tmpdir), 'sim', 1, scenario)
+    assert metrics['n_triggers'] >= 10
+    delays = metrics['press_delays']
+    assert len(delays) == metrics['injected']['button_presses'] > 2
+    assert -0.01 < min(delays) and max(delays) < 0.1
@@ -0,0 +1,98 @@
+"""Test module for timing"""
+import math
+import time
+import numpy as np
+from .timing import planned_onsets, Timeline, WaitStats, wait_until, \
+    FrameLog
+
+
+def test_planned_onsets():
+    trials = [{'duration': 18.}, {'duration': 3.}, {'duration': 3.}]
+    assert list(planned_onsets(trials)) == [0., 18., 21., 24.]
+
+
+def test_timeline_no_drift():
+    # emulate a 60Hz display where every frame takes a bit of work, as in
+    # the presentation loop
+    frame = 1 / 60.
+    trials = [{'duration': 3.}] * 20
+    timeline = Timeline(planned_onsets(trials), frame)
+    now = [0.]
+
+    def flip():
+        # lands on the next retrace
+        now[0] = (math.floor(now[0] / frame + 1e-9) + 1) * frame
+        return now[0]
+
+    for itrial in range(len(trials)):
+        if itrial % 2:
+            # fixation-like: wait, then flip once
+            now[0] = max(now[0], timeline.ready_time(itrial))
+            timeline.record_onset(itrial, flip())
+            now[0] = max(now[0], timeline.ready_time(itrial + 1))
+        else:
+            now[0] += 0.004
+            timeline.record_onset(itrial, flip())
+            while True:
+                now[0] += 0.004
+                if timeline.due(itrial + 1, now[0]):
+                    break
+                timeline.flipped(flip())
+    errors = timeline.errors()
+    assert not np.isnan(errors).any()
+    # every trial starts within a frame of its planned onset, and the error
+    # doesn't grow over the run
+    assert np.abs(errors).max() <= frame
+    assert abs(errors[-1]) <= frame
+    assert timeline.summary()['n'] == 20
+
+
+def test_wait_until():
+    stats = WaitStats()
+    stats.start()
+    for _ in range(5):
+        target = time.time() + 0.02
+        now = wait_until(time.time, target, stats=stats)
+        assert now >= target
+    stats.stop()
+    summary = stats.summary()
+    assert summary['n_waits'] == 5
+    assert 0 <= summary['max_latency'] < 0.01
+    # we slept for most of the time
+    assert summary['cpu_utilisation'] < 0.5
+    # waiting for the past returns immediately
+    assert wait_until(time.time, 0) > 0
+    # with a clock that only advances when sleeping
+    now = [0.]
+
+    def sleep(duration):
+        now[0] += duration
+    assert wait_until(lambda: now[0], 10., spin=0., sleep=sleep) == 10.
+
+
+def test_frame_log(tmpdir):
+    frame = 0.01
+    log = FrameLog(capacity=8)
+    # trial 0: a movie at half the refresh rate, with a late flip
+    for i, (t, target) in enumerate([(0., 0.), (.02, .02), (.04, .04),
+                                     (.07, .06), (.09, .09)]):
+        log.record(t, target, 0, i)
+    # trial 1: fixation
+    log.record(.1, .1, 1)
+    assert log.count == 6
+    summary = log.summary(frame, max_frames=3)
+    assert summary['n_flips'] == 6
+    assert summary['dropped'] == 1
+    assert summary['ifi_hist'] == [1, 3, 1]
+    assert summary['fps'] == {0: 4 / .09}
+    log.save(str(tmpdir.join('frames.npz')), frame)
+    saved = np.load(str(tmpdir.join('frames.npz')))
+    assert list(saved['trial']) == [0] * 5 + [1]
+    assert saved['frame_interval'] == frame
+    # the oldest flips are overwritten
+    for i in range(5):
+        log.record(.11 + i * .01, .11 + i * .01, 2, i)
+    data = log.data()
+    assert len(data) == 8
+    assert list(data['trial']) == [0] * 2 + [1] + [2] * 5
+    assert np.all(np.diff(data['t_flip']) > 0)
@@ -0,0 +1,253 @@
+"""Timing utilities for the presentation loop.
+
+The onsets of all trials are computed in advance from the schedule, relative
+to the first trigger, so that lateness in one trial doesn't accumulate over
+the following ones. Flips are assumed to land on vertical retraces spaced by
+the frame interval of the monitor, which lets us predict when the next flip
+will land and present each trial on the frame nearest to its planned onset.
+
+Waiting is done with wait_until, which sleeps for most of the wait and
+only spins for the last moment, instead of keeping a core busy.
+"""
+import math
+import os
+import time
+import numpy as np
+
+# how long before the target wait_until stops sleeping and starts spinning;
+# time.sleep can overshoot by about a scheduler tick
+SPIN = 0.001
+
+
+def cpu_time():
+    """Returns the user + system CPU time of this process"""
+    times = os.times()
+    return times[0] + times[1]
+
+
+class WaitStats(object):
+    """Collects wake-up latencies of wait_until and the CPU utilisation of
+    the process between start() and stop()"""
+    def __init__(self):
+        self.latencies = []
+        self._cpu = None
+        self._wall = None
+        self.cpu = 0.
+        self.wall = 0.
+
+    def start(self):
+        self._cpu = cpu_time()
+        self._wall = time.time()
+
+    def stop(self):
+        self.cpu += cpu_time() - self._cpu
+        self.wall += time.time() - self._wall
+
+    def record(self, latency):
+        self.latencies.append(latency)
+
+    def summary(self):
+        latencies = np.asarray(self.latencies)
+        if not len(latencies):
+            latencies = np.array([np.nan])
+        return {
+            'cpu_utilisation': self.cpu / self.wall if self.wall else np.nan,
+            'n_waits': len(self.latencies),
+            'mean_latency': latencies.mean(),
+            'p99_latency': np.percentile(latencies, 99),
+            'max_latency': latencies.max(),
+        }
+
+
+def wait_until(clock, t, spin=SPIN, stats=None, sleep=time.sleep):
+    """Waits until clock() >= t, sleeping until spin seconds before t and
+    spinning for the rest, so that we wake up on time without keeping a
+    core busy.
+
+    Arguments
+    ---------
+    clock : callable
+        returns the current time in s
+    t : float
+        time to wait for
+    spin : float
+        how long before t to stop sleeping
+    stats : WaitStats or None
+        if given, the wake-up latency (clock() - t) is recorded
+    sleep : callable
+        sleep(duration), in the time of clock
+
+    Returns
+    -------
+    now : float
+        clock() when done waiting
+    """
+    now = clock()
+    while now < t:
+        remaining = t - now
+        if remaining > spin:
+            sleep(remaining - spin)
+        now = clock()
+    if stats is not None:
+        stats.record(now - t)
+    return now
+
+
+def planned_onsets(trials):
+    """Returns the planned onsets of the trials, relative to the start of the
+    run, followed by the planned end of the run (so that trial i spans
+    onsets[i] to onsets[i + 1])"""
+    durations = [trial['duration'] for trial in trials]
+    return np.concatenate([[0.], np.cumsum(durations)])
+
+
+class Timeline(object):
+    """Planned and actual onsets of the trials of a run.
+
+    Arguments
+    ---------
+    onsets : array-like
+        planned onsets followed by the planned end of the run, as returned
+        by planned_onsets
+    frame_interval : float
+        duration of a frame in s
+    """
+    # how far into a frame we want to be before drawing and flipping, so
+    # that the flip doesn't land on the retrace we are waiting for
+    margin = 0.1
+
+    def __init__(self, onsets, frame_interval):
+        self.onsets = np.asarray(onsets, dtype=float)
+        self.frame_interval = frame_interval
+        self.last_flip = None
+        self.actual = np.empty(len(self.onsets) - 1)
+        self.actual.fill(np.nan)
+
+    def flipped(self, t):
+        """Records that a flip landed at time t"""
+        self.last_flip = t
+
+    def record_onset(self, itrial, t):
+        """Records that the first frame of trial itrial landed at time t"""
+        self.actual[itrial] = t
+        self.last_flip = t
+
+    def next_flip(self, now):
+        """Predicts when a flip issued at time now will land"""
+        if self.last_flip is None:
+            return now
+        nframes = max(1, int(math.ceil((now - self.last_flip) /
+                                       self.frame_interval)))
+        return self.last_flip + nframes * self.frame_interval
+
+    def due(self, itrial, now):
+        """Whether a flip issued now lands on the frame nearest to the
+        onset of trial itrial (or later)"""
+        return self.next_flip(now) >= \
+            self.onsets[itrial] - self.frame_interval / 2.
+
+    def ready_time(self, itrial):
+        """Returns the time from which a flip lands on the frame nearest to
+        the onset of trial itrial; for the end of the run, returns the
+        planned end itself"""
+        onset = self.onsets[itrial]
+        if self.last_flip is None or itrial == len(self.actual):
+            return onset
+        nframes = max(1, int(round((onset - self.last_flip) /
+                                   self.frame_interval)))
+        return self.last_flip + (nframes - 1 + self.margin) * \
+            self.frame_interval
+
+    def errors(self):
+        """Returns actual minus planned onset for each trial"""
+        return self.actual - self.onsets[:-1]
+
+    def summary(self):
+        errors = self.errors()
+        errors = errors[~np.isnan(errors)]
+        if not len(errors):
+            return {'n': 0, 'mean_error': np.nan, 'max_abs_error': np.nan,
+                    'final_error': np.nan}
+        return {
+            'n': len(errors),
+            'mean_error': errors.mean(),
+            'max_abs_error': np.abs(errors).max(),
+            'final_error': errors[-1],
+        }
+
+
+class FrameLog(object):
+    """Preallocated ring buffer of flips, recording for each flip when it
+    landed, when it was expected to land, the trial, and the movie frame
+    shown (-1 if none). Once full, the oldest flips are overwritten.
+
+    Arguments
+    ---------
+    capacity : int
+        maximum number of flips kept
+    """
+    dtype = np.dtype([('t_flip', 'f8'), ('t_target', 'f8'),
+                      ('trial', 'i4'), ('frame', 'i4')])
+
+    def __init__(self, capacity=1 << 15):
+        self._buffer = np.zeros(capacity, dtype=self.dtype)
+        self._t_flip = self._buffer['t_flip']
+        self._t_target = self._buffer['t_target']
+        self._trial = self._buffer['trial']
+        self._frame = self._buffer['frame']
+        self.capacity = capacity
+        self.count = 0
+
+    def record(self, t_flip, t_target, trial, frame=-1):
+        i = self.count % self.capacity
+        self._t_flip[i] = t_flip
+        self._t_target[i] = t_target
+        self._trial[i] = trial
+        self._frame[i] = frame
+        self.count += 1
+
+    def data(self):
+        """Returns the recorded flips in chronological order"""
+        if self.count <= self.capacity:
+            return self._buffer[:self.count].copy()
+        return np.roll(self._buffer, -(self.count % self.capacity))
+
+    def save(self, fn, frame_interval):
+        data = self.data()
+        np.savez_compressed(fn, frame_interval=frame_interval,
+                            **{name: data[name] for name in data.dtype.names})
+
+    def summary(self, frame_interval, max_frames=8):
+        """Returns a summary of the flips.
+
+        Returns
+        -------
+        summary : dict
+            n_flips : number of flips
+            dropped : number of frames by which flips missed the retrace
+                they were expected to land on
+            ifi_hist : number of inter-flip intervals lasting 1, 2, ...,
+                max_frames or more frames
+            fps : for each trial with a movie, the number of distinct movie
+                frames shown per second
+        """
+        data = self.data()
+        late = np.round((data['t_flip'] - data['t_target']) /
+                        frame_interval)
+        ifi = np.round(np.diff(data['t_flip']) / frame_interval)
+        ifi_hist = np.bincount(np.clip(ifi, 1, max_frames).astype(int),
+                               minlength=max_frames + 1)[1:]
+        fps = dict()
+        for trial in np.unique(data['trial']):
+            trial_data = data[(data['trial'] == trial) & (data['frame'] >= 0)]
+            if len(trial_data) < 2:
+                continue
+            elapsed = trial_data['t_flip'][-1] - trial_data['t_flip'][0]
+            nframes = len(np.unique(trial_data['frame']))
+            fps[int(trial)] = (nframes - 1) / elapsed if elapsed > 0 else 0.
+        return {
+            'n_flips': len(data),
+            'dropped': int(late[late > 0].sum()),
+            'ifi_hist': ifi_hist.tolist(),
+            'fps': fps,
+        }